@@ -0,0 +1,292 @@
+'''
+A local stub of the endpoints of PetScan, Commons API, Wikidata API, Wikidata Query Service
+and Depictor used by No Depictor. Category trees, items and files are synthetic and derived
+deterministically from category names, so that runs can be compared.
+
+The services are served under path prefixes: /petscan, /commons, /wikidata, /query and /depictor.
+Request counters are available at /__stats.
+'''
+from argparse import ArgumentParser
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+import json
+import random
+import re
+import sys
+import time
+import zlib
+
+
+class MockState:
+
+    def __init__(self, args):
+        self.branching: int = args.branching
+        self.filesPerCategory: int = args.files
+        self.imageRatio: float = args.image_ratio
+        self.doneRatio: float = args.done_ratio
+        self.latency: float = args.latency
+        self.writeLatency: float = args.write_latency
+        self.rate429: float = args.rate_429
+        self.retryAfter: int = args.retry_after
+        self.petscanMaxDepth: Optional[int] = args.petscan_max_depth
+
+        self.lock = Lock()
+        self.requests = Counter()
+        self.bytesSent = 0
+        self.doneItems: set[str] = set()
+        self.doneFiles: set[str] = set()
+
+
+    def count(self, endpoint: str):
+        with self.lock:
+            self.requests[endpoint] += 1
+
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return zlib.crc32(value.encode('utf-8'))
+
+
+    def qIdFor(self, categoryName: str) -> str:
+        return f'Q{self.hash(categoryName) % 1_000_000_000 + 1}'
+
+
+    def hasImage(self, qId: str) -> bool:
+        return self.hash('image' + qId) % 1000 < self.imageRatio * 1000
+
+
+    def children(self, categoryName: str) -> list[str]:
+        # Categories of the synthetic tree are named "<parent>/<index>"
+        if categoryName.count('/') >= 6:
+            return []
+        return [f'{categoryName}/{i}' for i in range(self.branching)]
+
+
+    def files(self, categoryName: str) -> list[tuple[int, str]]:
+        base = self.hash(categoryName) % 100_000_000 * 1000
+        return [
+            (base + i, f'File:{categoryName} {i}.jpg')
+            for i in range(self.filesPerCategory)
+        ]
+
+
+    def isFileInitiallyDone(self, mId: str) -> bool:
+        return self.hash('done' + mId) % 1000 < self.doneRatio * 1000
+
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    state: MockState
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        self._handle('GET')
+
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+    def _handle(self, method: str):
+        url = urlsplit(self.path)
+        query = { key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items() }
+        body = b''
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        service = url.path.strip('/').split('/')[0]
+        if service == '__stats':
+            with self.state.lock:
+                self._sendJson({
+                    'requests': dict(self.state.requests),
+                    'bytes_sent': self.state.bytesSent,
+                    'done_items': len(self.state.doneItems),
+                    'done_files': len(self.state.doneFiles),
+                })
+            return
+
+        handler = {
+            'petscan': self._petscan,
+            'commons': self._commons,
+            'wikidata': self._wikidata,
+            'query': self._query,
+            'depictor': self._depictor,
+        }.get(service)
+        if handler is None:
+            self._sendJson({ 'error': 'unknown service' }, 404)
+            return
+
+        isWrite = service == 'depictor' and (query.get('action') == 'add-file' or b'item-done' in body)
+        time.sleep(self.state.writeLatency if isWrite else self.state.latency)
+        if random.random() < self.state.rate429:
+            self.state.count(f'{service}:429')
+            self._sendJson({ 'error': 'rate limited' }, 429, { 'Retry-After': str(self.state.retryAfter) })
+            return
+
+        handler(query, body)
+
+
+    def _petscan(self, query: dict, body: bytes):
+        self.state.count('petscan')
+        root = query.get('categories', '').replace('_', ' ')
+        depth = int(query.get('depth', 0))
+        items = []
+        level = [root]
+        for _ in range(depth + 1):
+            level = [child for parent in level for child in self.state.children(parent)]
+            items.extend(
+                { 'q': self.state.qIdFor(name), 'title': name.replace(' ', '_'), 'namespace': 14 }
+                for name in level
+            )
+        response = { 'n': 'result', 'a': { 'query_time_sec': 0 }, '*': [{ 'n': 'combination', 'a': { 'type': 'subset', '*': items } }] }
+        if self.state.petscanMaxDepth is not None and depth > self.state.petscanMaxDepth:
+            # Like a query of a large tree which broke off halfway
+            self.state.count('petscan:cut-short')
+            self._sendBody(json.dumps(response).encode('utf-8')[:-100])
+            return
+        self._sendJson(response)
+
+
+    def _commons(self, query: dict, body: bytes):
+        if query.get('list') == 'search':
+            self.state.count('commons:search')
+            match = re.search(r'incategory:"([^"]*)"', query.get('srsearch', ''))
+            categoryName = match.group(1).replace('_', ' ') if match else ''
+            offset = int(query.get('sroffset', 0))
+            limit = int(query.get('srlimit', 500))
+            files = self.state.files(categoryName)
+            if query.get('srsort') == 'create_timestamp_desc':
+                # Page IDs grow with creation time
+                files = files[::-1]
+            response = { 'query': { 'searchinfo': { 'totalhits': len(files) }, 'search': [
+                { 'ns': 6, 'pageid': pageId, 'title': title }
+                for pageId, title in files[offset:offset + limit]
+            ] } }
+            if offset + limit < len(files):
+                response['continue'] = { 'sroffset': offset + limit, 'continue': '-||' }
+            self._sendJson(response)
+
+        elif query.get('generator') == 'categorymembers':
+            self.state.count('commons:categorymembers')
+            categoryName = query.get('gcmtitle', '')[len('Category:'):]
+            self._sendJson({ 'query': { 'pages': [
+                { 'ns': 14, 'title': 'Category:' + child, 'pageprops': { 'wikibase_item': self.state.qIdFor(child) } }
+                for child in self.state.children(categoryName)
+            ] } })
+
+        elif 'categoryinfo' in query.get('prop', ''):
+            self.state.count('commons:categoryinfo')
+            # Categories never change while the mock server runs
+            self._sendJson({ 'query': { 'pages': [
+                { 'ns': 14, 'title': title, 'touched': '2024-01-01T00:00:00Z', 'categoryinfo': { 'files': len(self.state.files(title[len('Category:'):])) } }
+                for title in query.get('titles', '').split('|') if title
+            ] } })
+
+        else:
+            self.state.count('commons:other')
+            self._sendJson({ 'query': {} })
+
+
+    def _wikidata(self, query: dict, body: bytes):
+        self.state.count('wikidata:' + query.get('action', ''))
+        entities = {}
+        for qId in query.get('ids', '').split('|'):
+            claims = { 'P18': [{ 'mainsnak': { 'datavalue': { 'value': 'Example.jpg' } } }] } if self.state.hasImage(qId) else {}
+            entities[qId] = { 'id': qId, 'claims': claims }
+        self._sendJson({ 'entities': entities })
+
+
+    def _query(self, query: dict, body: bytes):
+        self.state.count('query:sparql')
+        sparql = query.get('query', '')
+        # Category names are the only string literals in the queries
+        names = [json.loads(f'"{literal}"') for literal in re.findall(r'"((?:[^"\\]|\\.)*)"', sparql)]
+        bindings = []
+        for name in names:
+            qId = self.state.qIdFor(name)
+            if self.state.hasImage(qId):
+                bindings.append({
+                    'item': { 'type': 'uri', 'value': f'http://www.wikidata.org/entity/{qId}' },
+                    'cat': { 'type': 'literal', 'value': name },
+                })
+        self._sendJson({ 'head': { 'vars': ['item', 'cat'] }, 'results': { 'bindings': bindings } })
+
+
+    def _depictor(self, query: dict, body: bytes):
+        request = json.loads(body) if body else query
+        action = request.get('action')
+        self.state.count('depictor:' + str(action))
+        with self.state.lock:
+            if action == 'items-done':
+                self._sendJson({ qId: qId in self.state.doneItems for qId in request.get('qids', []) })
+            elif action == 'files-exists':
+                self._sendJson({
+                    mId: mId in self.state.doneFiles or self.state.isFileInitiallyDone(mId)
+                    for mId in request.get('mids', [])
+                })
+            elif action == 'add-file':
+                self.state.doneFiles.add(request.get('mid'))
+                self._sendJson({ 'ok': 'Added' })
+            elif action == 'item-done':
+                self.state.doneItems.add(request.get('qid'))
+                self._sendJson({ 'ok': 'Added' })
+            else:
+                self._sendJson({ 'error': 'unknown action' }, 400)
+
+
+    def _sendJson(self, data, status: int = 200, headers: Optional[dict] = None):
+        self._sendBody(json.dumps(data).encode('utf-8'), status, headers)
+
+
+    def _sendBody(self, body: bytes, status: int = 200, headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.state.bytesSent += len(body)
+
+
+def addMockArguments(parser: ArgumentParser):
+    parser.add_argument('--branching', type=int, default=5, help='Number of subcategories of each category (default: 5)')
+    parser.add_argument('--files', type=int, default=20, help='Number of files found in each category (default: 20)')
+    parser.add_argument('--image-ratio', type=float, default=0.8, help='Fraction of items having an image (default: 0.8)')
+    parser.add_argument('--done-ratio', type=float, default=0.2, help='Fraction of files already done in Depictor (default: 0.2)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Latency of read requests in seconds (default: 0.05)')
+    parser.add_argument('--write-latency', type=float, default=0.1, help='Latency of Depictor writes in seconds (default: 0.1)')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='Fraction of requests rejected with HTTP 429 (default: 0)')
+    parser.add_argument('--petscan-max-depth', type=int, help='Cut short the responses of PetScan queries deeper than this (default: no limit)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After sent with HTTP 429, in seconds (default: 1)')
+
+
+def main():
+    parser = ArgumentParser(description='A local mock of the APIs used by No Depictor.')
+    parser.add_argument('--port', type=int, default=0, help='Port to listen on (default: any free port)')
+    addMockArguments(parser)
+    args = parser.parse_args()
+
+    MockHandler.state = MockState(args)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), MockHandler)
+    server.daemon_threads = True
+    # The harness reads the port from the first line of the output
+    print(f'Listening on port {server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
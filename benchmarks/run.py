@@ -0,0 +1,143 @@
+'''
+Runs No Depictor against the local mock of the APIs (see mock_server.py) and reports its throughput.
+
+Usage: python benchmarks/run.py [options] [-- extra arguments for No Depictor]
+'''
+from argparse import ArgumentParser, REMAINDER
+from urllib.request import urlopen
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where the peak memory isn't measured
+    resource = None
+
+from mock_server import addMockArguments
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')
+
+
+def main():
+    parser = ArgumentParser(description='Benchmark of No Depictor against a local mock of the APIs.')
+    parser.add_argument('--roots', type=int, default=2, help='Number of root categories with depth (default: 2)')
+    parser.add_argument('--depth', type=int, default=1, help='Depth of the root categories (default: 1)')
+    parser.add_argument('--leaves', type=int, default=5, help='Number of root categories without depth (default: 5)')
+    parser.add_argument('--rate-limits', type=str, help='JSON object overriding the rate limits of No Depictor')
+    parser.add_argument('--json', type=str, help='Write the results to this JSON file')
+    addMockArguments(parser)
+    parser.add_argument('extra', nargs=REMAINDER, help='Extra arguments for No Depictor, after "--"')
+    args = parser.parse_args()
+    if '--asyncio' in args.extra:
+        # The asyncio driver doesn't support api_overrides and would talk to the real services
+        parser.error('The asyncio driver cannot be benchmarked against the mock.')
+
+    mockArgs = [
+        '--branching', str(args.branching), '--files', str(args.files),
+        '--image-ratio', str(args.image_ratio), '--done-ratio', str(args.done_ratio),
+        '--latency', str(args.latency), '--write-latency', str(args.write_latency),
+        '--rate-429', str(args.rate_429), '--retry-after', str(args.retry_after),
+    ]
+    if args.petscan_max_depth is not None:
+        mockArgs += ['--petscan-max-depth', str(args.petscan_max_depth)]
+    mock = subprocess.Popen([sys.executable, MOCK_SERVER, *mockArgs], stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(mock.stdout.readline().split()[-1])
+        results = runBenchmark(args, f'http://127.0.0.1:{port}')
+    finally:
+        mock.terminate()
+        mock.wait()
+
+    printResults(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=4)
+
+
+def runBenchmark(args, mockUrl: str) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        categoryFile = os.path.join(directory, 'categories.txt')
+        with open(categoryFile, 'w', encoding='utf-8') as file:
+            for i in range(args.roots):
+                file.write(f'Bench {i}|{args.depth}\n')
+            for i in range(args.leaves):
+                file.write(f'Bench leaf {i}\n')
+
+        configFile = os.path.join(directory, 'config.json')
+        with open(configFile, 'w', encoding='utf-8') as file:
+            json.dump({
+                'api_overrides': {
+                    'petscan.wmcloud.org': mockUrl + '/petscan',
+                    'commons.wikimedia.org': mockUrl + '/commons',
+                    'www.wikidata.org': mockUrl + '/wikidata',
+                    'query.wikidata.org': mockUrl + '/query',
+                    'hay.toolforge.org': mockUrl + '/depictor',
+                },
+                'rate_limits': json.loads(args.rate_limits) if args.rate_limits else None,
+                'shard_db': os.path.join(directory, 'shards.sqlite3'),
+                # Nothing of the mock run may end up in the files of real runs, e.g. to be resumed
+                'journal_file': '-',
+                'work_file': os.path.join(directory, 'work.jsonl.gz'),
+                'cache_file': os.path.join(directory, 'cache.sqlite3'),
+            }, file)
+
+        extra = [arg for arg in args.extra if arg != '--']
+        command = [
+            sys.executable, '-m', 'no_depictor',
+            '--config', configFile,
+            '--categoryfile', categoryFile,
+            '--logfile', os.path.join(directory, 'no_depictor.log'),
+            '--user', 'Benchmark',
+            '--sessid', 'benchmark',
+            '--state-db', '-',
+            *extra,
+        ]
+
+        start = time.monotonic()
+        subprocess.run(command, cwd=REPOSITORY_ROOT, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.monotonic() - start
+        # The mock server is still running, so only No Depictor counts here
+        peakRssKib = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss if resource is not None else None
+
+    with urlopen(mockUrl + '/__stats') as response:
+        stats = json.load(response)
+
+    requests = stats['requests']
+    totalRequests = sum(requests.values())
+    marks = requests.get('depictor:add-file', 0)
+    categories = requests.get('depictor:item-done', 0)
+    return {
+        'arguments': extra,
+        'elapsed_sec': elapsed,
+        'categories_done': categories,
+        'files_marked': marks,
+        'categories_per_sec': categories / elapsed,
+        'marks_per_sec': marks / elapsed,
+        'requests_total': totalRequests,
+        'requests_per_mark': totalRequests / marks if marks else None,
+        'peak_rss_mib': peakRssKib / 1024 if peakRssKib is not None else None,
+        'requests': requests,
+    }
+
+
+def printResults(results: dict):
+    print(f'Elapsed:            {results["elapsed_sec"]:.2f} s')
+    print(f'Categories done:    {results["categories_done"]} ({results["categories_per_sec"]:.2f}/s)')
+    print(f'Files marked:       {results["files_marked"]} ({results["marks_per_sec"]:.2f}/s)')
+    requestsPerMark = results['requests_per_mark']
+    print(f'Requests:           {results["requests_total"]} ({requestsPerMark:.2f} per mark)' if requestsPerMark else f'Requests:           {results["requests_total"]}')
+    if results['peak_rss_mib'] is not None:
+        print(f'Peak memory (RSS):  {results["peak_rss_mib"]:.1f} MiB')
+    print('Requests by endpoint:')
+    for endpoint, count in sorted(results['requests'].items()):
+        print(f'  {endpoint:<28} {count}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,18 @@
-from datetime import datetime
-from io import TextIOWrapper
-from time import sleep
 from rich.console import Console
-from rich.status import Status
-from rich.markup import escape
-from urllib.parse import quote, unquote
-from requests import Session
+import os
 import sys
+import time
 
-from .clients import CommonsAPI, Depictor, PetScan, WikidataAPI
+from .clients import DEPICTOR_WRITES, DoneStore, RateLimiter
 from .config import getConfig
-from .data._category_descriptor import CategoryDescriptor
 from .interrupt_handler import interruptible, InterruptHandler
+from .journal import Journal
+from .output import logToFile, printDeduplicationSummary, printMetricsSummary
+from .pipeline import Deduplicator
+from .planning import planRootCategories
+from .runner import createClients, createLogWriter, createMetrics, createResponseCache, createSession, processRootCategory, resolveRootCategories, resumeFromJournal
+from .sharding import runSharded
+from .work_file import executeWorkFile, WorkFileWriter
 
 # General algorithm:
 # 1. Fetch subcategories of a given category using PetScan.
@@ -19,95 +20,160 @@ from .interrupt_handler import interruptible, InterruptHandler
 # 3. For these not done, search them on Commons to get a list of images not depicting the subject.
 # 4. For each list of files, check if they were done in Depictor (action=files-exists).
 # 5. For every of the undone files, mark them as not depicting the subject (action=add-file).
+# The steps are lazy stages of a pipeline, so processing starts before PetScan returns all the categories.
 
 def main():
     console = Console()
     try:
         args = getConfig(console)
 
-        rootCategories = getCategories(args, console)
+        command = args.get('command')
+        rootCategories = getCategories(args, console) if command != 'execute' else []
         rootCategories = [
             c if not c.startswith('Category:') else c[len('Category:'):]  # Remove 'Category:' prefix if present
             for c in rootCategories
         ]
 
-        session = Session()
-        session.headers.update({
-            'User-Agent': 'NoDepictor/1.0 (User:Msz2001)'
-        })
+        if args.get('asyncio'):
+            # The asyncio driver is a separate implementation of the main loop, without these features
+            unsupported = [name for name, used in (
+                ('--shards', (args.get('shards') or 1) > 1),
+                ('--watch', args.get('watch')),
+                ('--estimate', args.get('estimate')),
+                ('--resume', args.get('resume')),
+                (f'the {command} command', command),
+                ('--cache (use --no-cache to run without it)', args.get('cache') and not args.get('no_cache')),
+                ('api_overrides', args.get('api_overrides')),
+            ) if used]
+            if unsupported:
+                console.print(f'[bold red]The asyncio driver cannot be used with {", ".join(unsupported)}.')
+                sys.exit(1)
+
+        if args.get('watch') and ((args.get('shards') or 1) > 1 or args.get('state_db') == '-'):
+            console.print('[bold red]--watch needs the local state database and cannot be used with --shards.')
+            sys.exit(1)
+
+        if args.get('estimate') and args.get('watch'):
+            console.print('[bold red]--estimate cannot be used with --watch.')
+            sys.exit(1)
 
-        commons = CommonsAPI(session)
-        wikidata = WikidataAPI(session)
-        petscan = PetScan(session)
-        depictor = Depictor(args['user'], args['sessid'], session)
+        if command and ((args.get('shards') or 1) > 1 or args.get('watch') or args.get('estimate') or args.get('resume')):
+            console.print(f'[bold red]The {command} command cannot be used with --shards, --watch, --estimate or --resume.')
+            sys.exit(1)
+        workPath = args.get('work_file') or 'no_depictor_work.jsonl.gz'
+        if command == 'execute' and args.get('dry_run'):
+            console.print('[bold red]The execute command cannot be used with --dry-run.')
+            sys.exit(1)
+        if command == 'execute' and not os.path.exists(workPath):
+            console.print(f'[bold red]Error: Work file `{workPath}` not found, create it with the plan command.')
+            sys.exit(1)
+
+        journalPath = args.get('journal_file') or 'no_depictor.journal'
+        if args.get('resume') and ((args.get('shards') or 1) > 1 or args.get('estimate') or args.get('dry_run') or journalPath == '-'):
+            console.print('[bold red]--resume needs the journal and cannot be used with --shards, --estimate or --dry-run.')
+            sys.exit(1)
+
+        # Estimating only reads, so it doesn't need to be split between processes
+        if (args.get('shards') or 1) > 1 and not args.get('estimate'):
+            runSharded(rootCategories, args, console)
+            return
+
+        rateLimits = args.get('rate_limits')
+        if command == 'execute' and args.get('write_rate'):
+            # The rate still drops on errors and HTTP 429, but never grows over the one requested
+            writeRate = args['write_rate']
+            rateLimits = { **(rateLimits or {}), DEPICTOR_WRITES: { 'rate': writeRate, 'max_rate': writeRate, 'min_rate': writeRate / 10 } }
+        rateLimiter = RateLimiter(rateLimits)
+        responseCache = createResponseCache(args)
+        metricsPath = args.get('metrics_file')
+        metrics = createMetrics(metricsPath, args)
+        session = createSession(args, rateLimiter, responseCache, metrics)
+        stateDbPath = args.get('state_db') or 'no_depictor.sqlite3'
+        doneStore = DoneStore(stateDbPath) if stateDbPath != '-' else None
+        commons, wikidata, petscan, depictor = createClients(args, session, doneStore, args['user'], args['sessid'])
+        # Only the sequential driver records its writes
+        useJournal = journalPath != '-' and not (command or args.get('asyncio') or args.get('estimate') or args.get('dry_run'))
+        journal = Journal(journalPath) if useJournal else None
     except KeyboardInterrupt:
         console.print('[bold red]Interrupted by user.')
         sys.exit(1)
 
     logPath = args.get('logfile', 'no_depictor.log')
     try:
-        logFile = open(logPath, 'a', encoding='utf-8')
-        logToFile(logFile, 'INFO', f'Starting new run over {len(rootCategories)} root categories.')
+        logFile = createLogWriter(logPath, args)
+        if command == 'execute':
+            logToFile(logFile, 'INFO', f'Starting execution of {workPath}.')
+        else:
+            logToFile(logFile, 'INFO', f'Starting new run over {len(rootCategories)} root categories.')
     except Exception as e:
         console.print(f'[bold red]Failed to open log file `{logPath}` for writing: {e}')
         sys.exit(1)
 
     with console.status('Initializing') as status, InterruptHandler() as ih:
-        for rootCategory in interruptible(rootCategories, ih):
-            if '|' in rootCategory:
-                rootCategory, depth = rootCategory.split('|', 1)
-                rootCategory = unquote(rootCategory.strip())
-                console.rule(catlink(rootCategory))
-                depth = int(depth.strip())
-                status.update(status=f'Fetching subcategories for {catlink(rootCategory)} with depth {depth}')
-                logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
-                logToFile(logFile, 'INFO', f'Fetching subcategories for {catlink(rootCategory, False)} with depth {depth}')
-                
-                try:
-                    categories = petscan.getSubcategories(rootCategory, depth)
-                except Exception as e:
-                    console.print(f'[red]Failed to fetch subcategories for {catlink(rootCategory)}:[/red] {escape(str(e))}')
-                    logToFile(logFile, 'ERROR', f'Failed to fetch subcategories for {catlink(rootCategory, False)}: {str(e)}')
-                    continue
-            else:
-                rootCategory = unquote(rootCategory.strip())
-                console.rule(catlink(rootCategory))
-                status.update(status=f'Getting QID for {catlink(rootCategory)}')
-                logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
-                logToFile(logFile, 'INFO', f'Getting QID for {catlink(rootCategory, False)}')
-                try:
-                    categories = [wikidata.getItemForCommonsCategory(rootCategory)]
-                except Exception as e:
-                    console.print(f'[red]Failed to get QID for {catlink(rootCategory)}:[/red] {escape(str(e))}')
-                    logToFile(logFile, 'ERROR', f'Failed to get QID for {catlink(rootCategory, False)}: {str(e)}')
-                    continue
-
-            if not categories:
-                console.print(f'No subcategories of {catlink(rootCategory)} found.')
-                logToFile(logFile, 'WARN', 'No categories to process.')
-                continue
-
-            console.print(f'Found {len(categories)} categories in total.')
-            status.update(status=f'Finding categories already done in Depictor')
-
-            try:
-                undoneCategories = depictor.getUndoneCategories(categories)
-            except Exception as e:
-                console.print(f'[red]Failed to fetch check which categories of {catlink(rootCategory)} were done:[/red] {escape(str(e))}')
-                logToFile(logFile, 'ERROR', f'Failed to check which categories of were done in Depictor: {str(e)}')
-                continue
-
-            if not undoneCategories:
-                console.print(f'All categories of {catlink(rootCategory)} have already been done in Depictor.')
-                logToFile(logFile, 'INFO', 'All categories have already been done in Depictor.')
-                continue
-
-            console.print(f'Found {len(undoneCategories)} categories not done in Depictor.')
-            logToFile(logFile, 'INFO', f'Found {len(undoneCategories)} categories not done in Depictor.')
-            doWorkForUndoneCategories(undoneCategories, commons, depictor, wikidata, status, console, ih, logFile, args.get('dry_run', False))
+        if args.get('estimate'):
+            resolvedRoots = resolveRootCategories(rootCategories, wikidata, status, console, logFile)
+            planRootCategories(rootCategories, resolvedRoots, args, commons, petscan, wikidata, depictor, rateLimiter, status, console, ih, logFile)
+        elif command == 'execute':
+            executeWorkFile(workPath, depictor, status, console, ih, logFile)
+        elif args.get('asyncio'):
+            # Imported here, so that aiohttp is needed only when the asyncio driver is used
+            from .aio_driver import runAsync
+            runAsync(rootCategories, args, rateLimiter, doneStore, status, console, ih, logFile, metrics)
+        else:
+            watchInterval = (args.get('watch') or 0) * 60
+            workFile = WorkFileWriter(workPath) if command == 'plan' else None
+            resumed = set()
+            if journal is not None:
+                if args.get('resume'):
+                    resumed = resumeFromJournal(journal, args, depictor, status, console, ih, logFile)
+                elif journal.pendingCount:
+                    console.print(f'[yellow]The journal has {journal.pendingCount} unfinished categories from an interrupted run, use --resume to finish them first.')
+            while not ih.interrupted:
+                cycleStart = time.monotonic()
+                deduplicator = Deduplicator()
+                # The categories finished from the journal don't have to be discovered again
+                deduplicator.skip(resumed)
+                resumed = set()
+                resolvedRoots = resolveRootCategories(rootCategories, wikidata, status, console, logFile)
+                for rootCategory in interruptible(rootCategories, ih):
+                    processRootCategory(rootCategory, resolvedRoots, args, commons, petscan, wikidata, depictor, status, console, ih, logFile, deduplicator, journal, workFile)
+                printDeduplicationSummary(deduplicator, console, logFile)
+                if workFile is not None:
+                    workFile.close()
+                    console.print(f'Wrote {workFile.files} files in {workFile.categories} categories to `{workPath}`, mark them with the execute command.')
+                    logToFile(logFile, 'INFO', f'Wrote {workFile.files} files in {workFile.categories} categories to {workPath}.')
+
+                if not watchInterval or ih.interrupted:
+                    break
+                # Later cycles process only files uploaded since the previous ones
+                console.rule('Waiting for new uploads')
+                logToFile(logFile, 'INFO', 'Finished a cycle, waiting for the next one.')
+                nextCycle = cycleStart + watchInterval
+                while not ih.interrupted and time.monotonic() < nextCycle:
+                    status.update(status=f'Next cycle in {int(nextCycle - time.monotonic())} s, press Ctrl+C to stop')
+                    time.sleep(1)
+                if ih.interrupted:
+                    break
     
+    if journal is not None:
+        journal.close()
+        if journal.pendingCount:
+            console.print(f'Progress of {journal.pendingCount} unfinished categories is saved in `{journalPath}`, use --resume to continue.')
+
+    for host, (opened, requests) in session.getConnectionStats().items():
+        metrics.recordConnections(host, opened, requests)
+    printMetricsSummary(console, metrics)
+    metrics.close()
+    try:
+        metrics.export()
+    except OSError as e:
+        console.print(f'[bold red]Failed to write metrics to `{metricsPath}`: {e}')
     logToFile(logFile, 'INFO', 'Finished execution.')
     logFile.close()
+    if doneStore is not None:
+        doneStore.close()
+    if responseCache is not None:
+        responseCache.close()
 
 
 def getCategories(args: dict, console: Console) -> list[str]:
@@ -125,101 +191,5 @@ def getCategories(args: dict, console: Console) -> list[str]:
     sys.exit(1)
 
 
-def doWorkForUndoneCategories(
-        undoneCategories: list[CategoryDescriptor],
-        commons: CommonsAPI,
-        depictor: Depictor,
-        wikidata: WikidataAPI,
-        status: Status,
-        console: Console,
-        ih: InterruptHandler,
-        logFile: TextIOWrapper,
-        dryRun: bool = False
-    ):
-    for category in interruptible(undoneCategories, ih):
-        qId, catName = category
-
-        status.update(status=f'Checking if {catlink(catName)} ({qId}) has an image set on Wikidata (P18)')
-        try:
-            if not wikidata.hasImageClaim(qId):
-                console.print(f'[cyan]Skipping ({catlink(catName)}) ({qId}) because it has no image.[/cyan]')
-                logToFile(logFile, 'INFO', f'Skipped {catlink(catName, False)} ({qId}) because it has no image.')
-                continue
-        except Exception as e:
-            console.print(f'[red]Failed to check Wikidata item {qId} ({catlink(catName)}) for P18:[/red] {escape(str(e))}')
-            logToFile(logFile, 'ERROR', f'Failed to check Wikidata item {qId} ({catlink(catName, False)}) for P18: {str(e)}')
-            continue
-
-        status.update(status=f'Searching for files not depicting subject {qId} in {catlink(catName)}')
-        try:
-            files = list(commons.getFilesNotDepictingSubject(catName, qId))
-            undoneFiles = depictor.getUndoneFiles(files)
-        except Exception as e:
-            console.print(f'[red]Failed to fetch files for {catlink(catName)}:[/red] {escape(str(e))}')
-            logToFile(logFile, 'ERROR', f'Failed to fetch files for {catlink(catName, False)}: {str(e)}')
-            continue
-
-        if not undoneFiles:
-            console.print(f'No files to process in {catlink(catName)}.')
-            logToFile(logFile, 'WARN', f'No files to process in {catlink(catName, False)}.')
-            continue
-
-        i = -1 # To be able to print the "Interrupted" message even before first item
-        for i, (mId, fileName) in interruptible(enumerate(undoneFiles), ih):
-            status.update(status=f'Processing {catlink(catName)} ({i+1}/{len(undoneFiles)}): {pagelink(fileName)} ({mId})')
-            try:
-                if not dryRun:
-                    depictor.markFileAsNotDepictingSubject(mId, category)
-            except Exception as e:
-                console.print(f'[red]Failed to mark {pagelink(fileName)} ({mId}) as not depicting {qId}:[/red] {escape(str(e))}')
-                logToFile(logFile, 'ERROR', f'Failed to mark {pagelink(fileName, False)} ({mId}) as not depicting {qId}: {str(e)}')
-            
-            try:
-                sleep(0.5) # To avoid overloading the server
-            except KeyboardInterrupt:
-                ih.forceInterrupt() # Just in case if SIGINT gets somehow missed
-
-        # They won't be equal only if we interrupted the loop early
-        if i+1 < len(undoneFiles):
-            console.print(f'[yellow]Interrupted processing {catlink(catName)} after {i+1}/{len(undoneFiles)} files.')
-            logToFile(logFile, 'WARN', f'Interrupted processing {catlink(catName, False)} after {i+1}/{len(undoneFiles)} files.')
-        else:
-            status.update(status=f'Marking category {catlink(catName)} as done')
-            try:
-                if not dryRun:
-                    depictor.markCategoryAsDone(qId)
-                logToFile(logFile, 'INFO', f'Successfully processed category {catlink(catName, False)} ({qId}) with {len(undoneFiles)} files.')
-            except Exception as e:
-                console.print(f'[red]Failed to mark category {catlink(catName)} as done:[/red] {escape(str(e))}')
-                logToFile(logFile, 'ERROR', f'Failed to mark category {catlink(catName, False)} as done: {str(e)}')
-            console.print(f'Processed {catlink(catName)} with {len(undoneFiles)} files.')
-
-
-def catlink(categoryName: str, consoleFormat = True) -> str:
-    return pagelink('Category:' + categoryName, consoleFormat)
-
-
-def pagelink(pageName: str, consoleFormat = True) -> str:
-    urlencoded = quote(pageName.replace(' ', '_'), safe=':/')
-    displayName = pageName.replace('_', ' ')
-    if displayName.startswith('Category:') or displayName.startswith('File:'):
-        displayName = ':' + displayName
-    
-    if not consoleFormat:
-        return f'[[{displayName}]]'
-    return f'[[[link=https://commons.wikimedia.org/wiki/{urlencoded}]{displayName}[/link]]]'
-
-
-def logToFile(logFile: TextIOWrapper, type: str, message: str):
-    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] # Trim microseconds to milliseconds
-    prefix = f'* <!-- {now} | {type} --> '
-
-    lines = message.splitlines()
-    formattedMessage = prefix + lines[0].rstrip()
-    for line in lines[1:]:
-        formattedMessage += '\n*:' + ' ' * (len(prefix) - 2) + line.rstrip()
-
-    logFile.write(formattedMessage + '\n')
-    logFile.flush()
-
-main()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
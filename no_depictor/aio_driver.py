@@ -0,0 +1,361 @@
+from aiohttp import ClientSession, TCPConnector
+from collections import deque
+from rich.console import Console
+from rich.markup import escape
+from rich.status import Status
+from typing import AsyncIterator, Optional, TypeVar
+from urllib.parse import unquote
+import asyncio
+
+from .clients import DoneStore, Metrics, RateLimiter
+from .clients.aio import CommonsAPI, Depictor, PetScan, WikidataAPI, rateLimitingMiddleware
+from .data import CategoryDescriptor, FileCollection
+from .interrupt_handler import interruptible, InterruptHandler
+from .output import catlink, logToFile, LogWriter, pagelink, printDeduplicationSummary
+from .pipeline import Deduplicator, splitRootCategory
+
+
+def runAsync(
+        rootCategories: list[str],
+        args: dict,
+        rateLimiter: RateLimiter,
+        doneStore: Optional[DoneStore],
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        metrics: Optional[Metrics] = None
+    ):
+    '''
+    Runs the main algorithm on a single thread using asyncio. Read requests
+    for upcoming categories are issued concurrently (up to `workers` categories
+    at the same time), while files are marked one by one.
+    '''
+    asyncio.run(_run(rootCategories, args, rateLimiter, doneStore, status, console, ih, logFile, metrics))
+
+
+async def _run(
+        rootCategories: list[str],
+        args: dict,
+        rateLimiter: RateLimiter,
+        doneStore: Optional[DoneStore],
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        metrics: Optional[Metrics] = None
+    ):
+    concurrency = args.get('workers') or 16
+    async with ClientSession(
+        headers={ 'User-Agent': 'NoDepictor/1.0 (User:Msz2001)' },
+        # Every category in flight needs a search and a lookup in Depictor
+        connector=TCPConnector(limit=0, limit_per_host=2 * concurrency, keepalive_timeout=30, ttl_dns_cache=300),
+        middlewares=(rateLimitingMiddleware(rateLimiter, metrics=metrics),),
+    ) as session:
+        commons = CommonsAPI(session)
+        wikidata = WikidataAPI(session)
+        petscan = PetScan(session)
+        depictor = Depictor(
+            args['user'], args['sessid'], session, doneStore,
+            chunkSize=args.get('chunk_size') or 500,
+            maxWorkers=args.get('chunk_workers') or 4,
+            maxWritesInFlight=args.get('write_workers') or 4,
+        )
+
+        deduplicator = Deduplicator()
+        resolvedRoots = await _resolveRootCategories(rootCategories, wikidata, status, console, logFile)
+        for rootCategory in interruptible(rootCategories, ih):
+            rootCategory, categories = await _getCategoriesForRoot(rootCategory, args, resolvedRoots, commons, petscan, wikidata, status, console, logFile)
+            if categories is None:
+                continue
+
+            counts = _StageCounts()
+            duplicatesBefore = deduplicator.duplicates
+            try:
+                await _doWorkForUndoneCategories(
+                    _filterCategories(categories, deduplicator, depictor, wikidata, counts, status, console, logFile),
+                    commons, depictor, status, console, ih, logFile,
+                    args.get('dry_run', False), concurrency, args.get('whole_category', False)
+                )
+            except Exception as e:
+                # Only the lazy stages before discovery can raise here
+                console.print(f'[red]Failed to fetch categories of {catlink(rootCategory)}:[/red] {escape(str(e))}')
+                logToFile(logFile, 'ERROR', f'Failed to fetch categories of {catlink(rootCategory, False)}: {str(e)}')
+                continue
+
+            duplicates = deduplicator.duplicates - duplicatesBefore
+            if duplicates > 0:
+                console.print(f'Skipped {duplicates} categories of {catlink(rootCategory)} already processed under other roots.')
+                logToFile(logFile, 'INFO', f'Skipped {duplicates} categories already processed under other roots.')
+            if counts.total == 0:
+                if duplicates == 0:
+                    console.print(f'No subcategories of {catlink(rootCategory)} found.')
+                    logToFile(logFile, 'WARN', 'No categories to process.')
+            elif counts.undone == 0:
+                console.print(f'All categories of {catlink(rootCategory)} have already been done in Depictor.')
+                logToFile(logFile, 'INFO', 'All categories have already been done in Depictor.')
+            else:
+                console.print(f'Found {counts.total} categories in total, {counts.undone} of them not done in Depictor.')
+                logToFile(logFile, 'INFO', f'Found {counts.total} categories in total, {counts.undone} of them not done in Depictor.')
+        printDeduplicationSummary(deduplicator, console, logFile)
+
+
+class _StageCounts:
+    '''Counts categories passing through the stages of _filterCategories.'''
+
+    def __init__(self):
+        self.total = 0
+        self.undone = 0
+
+
+async def _filterCategories(
+        categories: AsyncIterator[CategoryDescriptor],
+        deduplicator: Deduplicator,
+        depictor: Depictor,
+        wikidata: WikidataAPI,
+        counts: _StageCounts,
+        status: Status,
+        console: Console,
+        logFile: LogWriter
+    ) -> AsyncIterator[CategoryDescriptor]:
+    '''
+    Yields categories not processed under other roots, not done in Depictor and having
+    an image, as they arrive. They are checked in batches of as many as Depictor checks
+    at once, so that the whole tree is never kept in memory.
+    '''
+    async for batch in _batched(categories, depictor.chunkSize * depictor.maxWorkers):
+        batch = list(deduplicator(batch))
+        counts.total += len(batch)
+        if not batch:
+            continue
+
+        status.update(status=f'Finding categories already done in Depictor')
+        undoneCategories = await depictor.getUndoneCategories(batch)
+        counts.undone += len(undoneCategories)
+
+        status.update(status=f'Checking which of {len(undoneCategories)} items have an image set on Wikidata (P18)')
+        errors: dict[str, Exception] = {}
+        def onError(qIds: list[str], error: Exception):
+            errors.update((qId, error) for qId in qIds)
+
+        itemsWithImage = await wikidata.getItemsWithImageClaim((cat.qId for cat in undoneCategories), onError=onError)
+        for category in undoneCategories:
+            qId, catName = category
+            if qId in itemsWithImage:
+                yield category
+            elif qId in errors:
+                console.print(f'[red]Failed to check Wikidata item {qId} ({catlink(catName)}) for P18:[/red] {escape(str(errors[qId]))}')
+                logToFile(logFile, 'ERROR', f'Failed to check Wikidata item {qId} ({catlink(catName, False)}) for P18: {str(errors[qId])}')
+            else:
+                console.print(f'[cyan]Skipping ({catlink(catName)}) ({qId}) because it has no image.[/cyan]')
+                logToFile(logFile, 'INFO', f'Skipped {catlink(catName, False)} ({qId}) because it has no image.')
+
+
+T = TypeVar('T')
+async def _batched(iterable: AsyncIterator[T], size: int) -> AsyncIterator[list[T]]:
+    batch = []
+    async for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _iterate(items: list[T]) -> AsyncIterator[T]:
+    for item in items:
+        yield item
+
+
+async def _resolveRootCategories(
+        rootCategories: list[str],
+        wikidata: WikidataAPI,
+        status: Status,
+        console: Console,
+        logFile: LogWriter
+    ) -> Optional[dict[str, CategoryDescriptor]]:
+    names = [unquote(c.strip()) for c in rootCategories if '|' not in c]
+    if not names:
+        return {}
+
+    status.update(status=f'Getting QIDs for {len(names)} categories')
+    try:
+        resolved, unresolved = await wikidata.getItemsForCommonsCategories(names)
+    except Exception as e:
+        console.print(f'[red]Failed to get QIDs for root categories, they will be resolved one by one:[/red] {escape(str(e))}')
+        logToFile(logFile, 'ERROR', f'Failed to get QIDs for root categories, they will be resolved one by one: {str(e)}')
+        return None
+
+    if unresolved:
+        console.print(f'[yellow]No items with an image found for {len(unresolved)} of {len(names)} categories.')
+        logToFile(logFile, 'WARN', f'No items with an image found for {len(unresolved)} of {len(names)} categories:\n' + '\n'.join(catlink(name, False) for name in unresolved))
+    return resolved
+
+
+async def _getCategoriesForRoot(
+        rootCategory: str,
+        args: dict,
+        resolvedRoots: Optional[dict[str, CategoryDescriptor]],
+        commons: CommonsAPI,
+        petscan: PetScan,
+        wikidata: WikidataAPI,
+        status: Status,
+        console: Console,
+        logFile: LogWriter
+    ) -> tuple[str, Optional[AsyncIterator[CategoryDescriptor]]]:
+    '''
+    Returns the name of the root category and a lazy iterator of its categories,
+    or None if the root couldn't be resolved. Errors of the tree query are raised
+    while iterating.
+    '''
+    if '|' in rootCategory:
+        try:
+            rootCategory, depth, treeSource = splitRootCategory(rootCategory, args.get('tree_source') or 'petscan')
+        except ValueError as e:
+            # A malformed line of the category file mustn't stop the others
+            console.print(f'[red]Skipping line `{escape(rootCategory)}` of the category file:[/red] {escape(str(e))}')
+            logToFile(logFile, 'ERROR', f'Skipping line "{rootCategory}" of the category file: {str(e)}')
+            return rootCategory, None
+        console.rule(catlink(rootCategory))
+        status.update(status=f'Fetching subcategories for {catlink(rootCategory)} with depth {depth} from {treeSource}')
+        logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
+        logToFile(logFile, 'INFO', f'Fetching subcategories for {catlink(rootCategory, False)} with depth {depth} from {treeSource}')
+
+        if treeSource == 'commons':
+            return rootCategory, commons.iterSubcategoryTree(rootCategory, depth)
+        return rootCategory, petscan.iterSubcategories(rootCategory, depth)
+
+    rootCategory = unquote(rootCategory.strip())
+    console.rule(catlink(rootCategory))
+    status.update(status=f'Getting QID for {catlink(rootCategory)}')
+    logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
+    logToFile(logFile, 'INFO', f'Getting QID for {catlink(rootCategory, False)}')
+    if resolvedRoots is not None:
+        if rootCategory not in resolvedRoots:
+            console.print(f'[red]Failed to get QID for {catlink(rootCategory)}:[/red] no item with an image found in Wikidata.')
+            logToFile(logFile, 'ERROR', f'Failed to get QID for {catlink(rootCategory, False)}: no item with an image found in Wikidata.')
+            return rootCategory, None
+        return rootCategory, _iterate([resolvedRoots[rootCategory]])
+
+    try:
+        category = await wikidata.getItemForCommonsCategory(rootCategory)
+    except Exception as e:
+        console.print(f'[red]Failed to get QID for {catlink(rootCategory)}:[/red] {escape(str(e))}')
+        logToFile(logFile, 'ERROR', f'Failed to get QID for {catlink(rootCategory, False)}: {str(e)}')
+        return rootCategory, None
+    return rootCategory, _iterate([category])
+
+
+async def _doWorkForUndoneCategories(
+        categoriesWithImage: AsyncIterator[CategoryDescriptor],
+        commons: CommonsAPI,
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        dryRun: bool,
+        concurrency: int,
+        wholeCategory: bool = False
+    ):
+    # Discovery runs up to `concurrency` categories ahead of the marking loop
+    pending: deque[tuple[CategoryDescriptor, asyncio.Task]] = deque()
+    exhausted = False
+
+    async def fillQueue():
+        nonlocal exhausted
+        while len(pending) < concurrency and not exhausted and not ih.interrupted:
+            try:
+                category = await categoriesWithImage.__anext__()
+            except StopAsyncIteration:
+                exhausted = True
+                return
+            pending.append((category, asyncio.create_task(_discoverForCategory(category, commons, depictor, wholeCategory))))
+
+    try:
+        status.update(status=f'Searching for files not depicting subjects in categories')
+        await fillQueue()
+        while pending and not ih.interrupted:
+            category, task = pending.popleft()
+            await fillQueue()
+            qId, catName = category
+
+            try:
+                undoneFiles = await task
+            except Exception as e:
+                console.print(f'[red]Failed to fetch files for {catlink(catName)}:[/red] {escape(str(e))}')
+                logToFile(logFile, 'ERROR', f'Failed to fetch files for {catlink(catName, False)}: {str(e)}')
+                continue
+
+            if not undoneFiles:
+                console.print(f'No files to process in {catlink(catName)}.')
+                logToFile(logFile, 'WARN', f'No files to process in {catlink(catName, False)}.')
+                continue
+
+            await _markFiles(category, undoneFiles, depictor, status, console, ih, logFile, dryRun)
+            status.update(status=f'Searching for files not depicting subjects in categories')
+    finally:
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+
+
+async def _discoverForCategory(category: CategoryDescriptor, commons: CommonsAPI, depictor: Depictor, wholeCategory: bool = False) -> FileCollection:
+    qId, catName = category
+    files = await commons.getFilesNotDepictingSubject(catName, qId, wholeCategory)
+    return await depictor.getUndoneFiles(files)
+
+
+async def _markFiles(
+        category: CategoryDescriptor,
+        undoneFiles: FileCollection,
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        dryRun: bool
+    ):
+    qId, catName = category
+
+    fileNames = { file.mId: file.title for file in undoneFiles }
+    processed, failed = 0, 0
+
+    def onResult(mId: str, error: Optional[Exception]):
+        nonlocal processed, failed
+        processed += 1
+        fileName = fileNames[mId]
+        status.update(status=f'Processing {catlink(catName)} ({processed}/{len(undoneFiles)}): {pagelink(fileName)} ({mId})')
+        if error is not None:
+            failed += 1
+            console.print(f'[red]Failed to mark {pagelink(fileName)} ({mId}) as not depicting {qId}:[/red] {escape(str(error))}')
+            logToFile(logFile, 'ERROR', f'Failed to mark {pagelink(fileName, False)} ({mId}) as not depicting {qId}: {str(error)}')
+
+    if dryRun:
+        for mId in interruptible(undoneFiles.mIds, ih):
+            onResult(mId, None)
+    else:
+        async for mId, error in depictor.markFilesAsNotDepictingSubject(undoneFiles.mIds, category, lambda: ih.interrupted):
+            onResult(mId, error)
+
+    # They won't be equal only if we interrupted the loop early
+    if processed < len(undoneFiles):
+        console.print(f'[yellow]Interrupted processing {catlink(catName)} after {processed}/{len(undoneFiles)} files.')
+        logToFile(logFile, 'WARN', f'Interrupted processing {catlink(catName, False)} after {processed}/{len(undoneFiles)} files.')
+        return
+    if failed:
+        # The category is left undone, so that the failed files are tried again in the next run
+        console.print(f'[yellow]Not marking {catlink(catName)} as done, as {failed}/{len(undoneFiles)} files failed.')
+        logToFile(logFile, 'WARN', f'Not marking {catlink(catName, False)} as done, as {failed}/{len(undoneFiles)} files failed.')
+        return
+
+    status.update(status=f'Marking category {catlink(catName)} as done')
+    try:
+        if not dryRun:
+            await depictor.markCategoryAsDone(qId)
+        logToFile(logFile, 'INFO', f'Successfully processed category {catlink(catName, False)} ({qId}) with {len(undoneFiles)} files.')
+    except Exception as e:
+        console.print(f'[red]Failed to mark category {catlink(catName)} as done:[/red] {escape(str(e))}')
+        logToFile(logFile, 'ERROR', f'Failed to mark category {catlink(catName, False)} as done: {str(e)}')
+    console.print(f'Processed {catlink(catName)} with {len(undoneFiles)} files.')
@@ -1,5 +1,10 @@
 # Reexport the classes for easier import
-from ._commons import CommonsAPI
+from ._commons import CommonsAPI, MAX_SEARCH_RESULTS, SEARCH_PAGE_SIZE
 from ._depictor import Depictor
+from ._done_store import DoneStore
+from ._metrics import Metrics
 from ._petscan import PetScan
+from ._rate_limiter import DEPICTOR_WRITES, RateLimiter, SharedRateLimiter
+from ._response_cache import ResponseCache
+from ._session import RateLimitedSession, RedirectingAdapter
 from ._wikidata import WikidataAPI
@@ -1,39 +1,232 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from requests import Session
-from typing import Iterator
-from ..data import FileDescriptor
+from typing import Iterable, Iterator, Optional
+from ..data import CategoryDescriptor, FileCollection
+
+
+SEARCH_PAGE_SIZE = 500
+# CirrusSearch refuses to return results past this offset
+MAX_SEARCH_RESULTS = 10000
 
 
 class CommonsAPI:
     
-    def __init__(self, session: Session = Session()):
-        self.httpSession = session
+    def __init__(self, session: Optional[Session] = None):
+        self.httpSession = session if session is not None else Session()
+
+
+    def getFilesNotDepictingSubject(
+            self,
+            categoryName: str,
+            qId: str,
+            wholeCategory: bool = False,
+            prefetchPages: int = 2,
+            newerThan: Optional[int] = None
+        ) -> FileCollection:
+        '''
+        Searches the category for bitmaps without a P180 statement of the given item.
 
+        Normally, only the first page of results is returned. Depictor seems to ignore
+        the possibility of continuation, so it relies on the user coming back and running
+        the search again in modified circumstances (e.g. with more P180 set).
 
-    def getFilesNotDepictingSubject(self, categoryName: str, qId: str, wholeCategory: bool = False) -> Iterator[FileDescriptor]:
+        With `wholeCategory`, all pages are listed. As the total number of hits is known
+        from the first page, up to `prefetchPages` following pages are fetched concurrently.
+        CirrusSearch doesn't return results past the 10000th, so the listing of larger
+        categories stops there.
+
+        With `newerThan`, only files with a greater page ID (i.e. created later) are listed.
+        Results are then sorted from the newest, and pages are fetched until an older file
+        is found, so that the cost depends on the number of new files only.
+        '''
         requestParams = {
             'action': 'query',
             'list': 'search',
-            'srlimit': 500,
+            'srlimit': SEARCH_PAGE_SIZE,
             'srnamespace': 6,  # Namespace for files
             'srsearch': f'-haswbstatement:P180={qId} incategory:"{categoryName}" filetype:bitmap',
             'format': 'json',
             'formatversion': 2,
         }
+        if newerThan is not None:
+            requestParams['srsort'] = 'create_timestamp_desc'
 
-        while True:
+        files = FileCollection()
+        response = self._search(requestParams, 0)
+        if not _addSearchResults(files, response, newerThan):
+            return files
+        if not (wholeCategory or newerThan is not None) or 'continue' not in response:
+            return files
+
+        totalHits = response.get('query', {}).get('searchinfo', {}).get('totalhits', MAX_SEARCH_RESULTS)
+        offsets = iter(range(SEARCH_PAGE_SIZE, min(totalHits, MAX_SEARCH_RESULTS), SEARCH_PAGE_SIZE))
+        executor = ThreadPoolExecutor(max_workers=max(prefetchPages, 1), thread_name_prefix='search')
+        pending: deque[Future] = deque()
+
+        def fillQueue():
+            while len(pending) < max(prefetchPages, 1):
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+                pending.append(executor.submit(self._search, requestParams, offset))
+
+        try:
+            fillQueue()
+            while pending:
+                response = pending.popleft().result()
+                fillQueue()
+                if not _addSearchResults(files, response, newerThan):
+                    break
+                # The category may have shrunk since the first page
+                if 'continue' not in response:
+                    break
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return files
+
+
+    def countFilesNotDepictingSubject(self, categoryName: str, qId: str) -> int:
+        '''Returns the number of files getFilesNotDepictingSubject would find in the whole category, without listing them.'''
+        requestParams = {
+            'action': 'query',
+            'list': 'search',
+            'srlimit': 1,
+            'srnamespace': 6,  # Namespace for files
+            'srsearch': f'-haswbstatement:P180={qId} incategory:"{categoryName}" filetype:bitmap',
+            'srinfo': 'totalhits',
+            'srprop': '',
+            'format': 'json',
+            'formatversion': 2,
+        }
+        response = self._search(requestParams, 0)
+        return response.get('query', {}).get('searchinfo', {}).get('totalhits', 0)
+
+
+    def _search(self, requestParams: dict, offset: int) -> dict:
+        rawResponse = self.httpSession.get(
+            'https://commons.wikimedia.org/w/api.php',
+            params={ **requestParams, 'sroffset': offset } if offset else requestParams,
+            timeout=60,
+        )
+        try:
+            response = rawResponse.json()
+        except Exception as e:
+            raise Exception(
+                'Wikimedia Commons API responded with invalid JSON (response code: ' +
+                str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
+            ) from e
+
+        if 'error' in response:
+            raise Exception(f'Wikimedia Commons API returned an error: {response["error"]}')
+        return response
+
+
+    def getCategoryStates(self, categoryNames: Iterable[str], batchSize: int = 50) -> dict[str, tuple[str, int]]:
+        '''
+        Gets the state of many categories at once, with prop=info|categoryinfo: when their
+        pages were last touched (which happens also when files are added or removed)
+        and how many files they contain.
+
+        :param categoryNames: The categories, without namespace.
+        :param batchSize: How many titles to send in a single request (API limit is 50).
+        :return: A dictionary from the category names, as given, to (touched, number of files).
+            Categories that don't exist are missing.
+        '''
+        names = list(dict.fromkeys(categoryNames))
+        states = {}
+        for i in range(0, len(names), batchSize):
+            batch = names[i:i + batchSize]
+            # The API returns titles with spaces, while PetScan gives them with underscores
+            byTitle = { 'Category:' + name.replace('_', ' '): name for name in batch }
+            requestParams = {
+                'action': 'query',
+                'prop': 'info|categoryinfo',
+                'titles': '|'.join(byTitle),
+                'format': 'json',
+                'formatversion': 2,
+            }
             rawResponse = self.httpSession.get(
                 'https://commons.wikimedia.org/w/api.php',
                 params=requestParams,
                 timeout=60,
             )
-            if rawResponse.status_code == 429:
-                # Too many requests - wait and try again
-                delay = int(rawResponse.headers.get('Retry-After', '5'))
-                print(f'Wikimedia Commons API rate limit exceeded. Retrying after {delay} seconds...')
-                import time
-                time.sleep(delay)
-                continue
+            try:
+                response = rawResponse.json()
+            except Exception as e:
+                raise Exception(
+                    'Wikimedia Commons API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
+                ) from e
+
+            if 'error' in response:
+                raise Exception(f'Wikimedia Commons API returned an error: {response["error"]}')
+
+            query = response.get('query', {})
+            # Titles which the API normalized are returned under their normalized form
+            for normalized in query.get('normalized', []):
+                if normalized.get('from') in byTitle:
+                    byTitle[normalized['to']] = byTitle[normalized['from']]
+            for page in query.get('pages', []):
+                name = byTitle.get(page.get('title', ''))
+                if name is None or page.get('missing') or 'touched' not in page:
+                    continue
+                states[name] = (page['touched'], page.get('categoryinfo', {}).get('files', 0))
+        return states
+
+
+    def iterSubcategoryTree(self, categoryName: str, depth: int = 1, maxWorkers: int = 8) -> Iterator[CategoryDescriptor]:
+        '''
+        Walks the category tree breadth-first, as an alternative to PetScan.getSubcategories.
+        Categories of each level are expanded concurrently and subcategories having
+        a Wikidata item are yielded as soon as they are found. Each category is
+        visited only once, so cycles in the tree are harmless.
+
+        :param categoryName: The root category, without namespace.
+        :param depth: The depth of the tree; 0 means only direct subcategories of the root.
+        :param maxWorkers: How many categories can be expanded at the same time.
+        '''
+        rootTitle = categoryName.replace('_', ' ')
+        visited = { rootTitle }
+        frontier = [rootTitle]
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            for level in range(depth + 1):
+                nextFrontier = []
+                for subcategories in executor.map(self._getSubcategoriesWithItems, frontier):
+                    for title, qId in subcategories:
+                        if title in visited:
+                            continue
+                        visited.add(title)
+                        nextFrontier.append(title)
+                        if qId is not None:
+                            # PetScan returns titles with underscores, so follow it
+                            yield CategoryDescriptor(qId, title.replace(' ', '_'))
+                frontier = nextFrontier
+                if not frontier:
+                    break
+
+
+    def _getSubcategoriesWithItems(self, categoryTitle: str) -> list[tuple[str, str | None]]:
+        '''Returns titles (without namespace) of direct subcategories, with their Wikidata items, if any.'''
+        requestParams = {
+            'action': 'query',
+            'generator': 'categorymembers',
+            'gcmtitle': 'Category:' + categoryTitle,
+            'gcmtype': 'subcat',
+            'gcmlimit': 'max',
+            'prop': 'pageprops',
+            'ppprop': 'wikibase_item',
+            'format': 'json',
+            'formatversion': 2,
+        }
 
+        subcategories = {}
+        while True:
+            rawResponse = self.httpSession.get(
+                'https://commons.wikimedia.org/w/api.php',
+                params=requestParams,
+                timeout=60,
+            )
             try:
                 response = rawResponse.json()
             except Exception as e:
@@ -42,21 +235,43 @@ class CommonsAPI:
                     str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
                 ) from e
 
-            searchResults = response.get('query', {}).get('search', [])
-            for result in searchResults:
-                if 'pageid' not in result:
+            if 'error' in response:
+                raise Exception(f'Wikimedia Commons API returned an error: {response["error"]}')
+
+            for page in response.get('query', {}).get('pages', []):
+                title = page.get('title', '')
+                if not title.startswith('Category:'):
                     continue
-                pageId = result['pageid']
-                yield FileDescriptor(f'M{pageId}', result.get('title', ''))
-            
+                title = title[len('Category:'):]
+                qId = page.get('pageprops', {}).get('wikibase_item')
+                # With continuation, pageprops of a page may come in a later response
+                if qId is not None or title not in subcategories:
+                    subcategories[title] = qId
+
             if 'continue' not in response:
                 break
+            requestParams.update(response['continue'])
 
-            requestParams['sroffset'] = response['continue'].get('sroffset', 0)
+        return list(subcategories.items())
 
-            # Normally, we should continue listing files until we reach the limit.
-            # However, Depictor seems to ignore the possibility of continuation,
-            # so it relies on the user coming back and running the search again
-            # in modified circumstances (e.g. with more P180 set).
-            if not wholeCategory:
-                break
+
+def parseSearchResults(response: dict) -> FileCollection:
+    files = FileCollection()
+    for result in response.get('query', {}).get('search', []):
+        if 'pageid' not in result:
+            continue
+        files.add(result['pageid'], result.get('title', ''))
+    return files
+
+
+def _addSearchResults(files: FileCollection, response: dict, newerThan: Optional[int]) -> bool:
+    '''Adds a page of search results to the files, and returns False if there are no newer files to look for.'''
+    page = parseSearchResults(response)
+    if newerThan is not None:
+        # Results are sorted from the newest, so the rest of them is older
+        older = next((i for i, pageId in enumerate(page.pageIds) if pageId <= newerThan), None)
+        if older is not None:
+            files.extend(page[:older])
+            return False
+    files.extend(page)
+    return True
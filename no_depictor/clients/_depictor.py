@@ -1,37 +1,48 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from requests import Session
-from ..data import CategoryDescriptor, FileDescriptor
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+from ..data import CategoryDescriptor, FileCollection
+from ._done_store import DoneStore
+import sqlite3
 import urllib.parse
 
 
 class Depictor:
 
-    def __init__(self, userName: str, phpSessionId: str, session: Session = Session()):
+    def __init__(
+            self,
+            userName: str,
+            phpSessionId: str,
+            session: Optional[Session] = None,
+            doneStore: Optional[DoneStore] = None,
+            chunkSize: int = 500,
+            maxWorkers: int = 4,
+            maxAttempts: int = 3,
+            maxWritesInFlight: int = 4
+        ):
         self.userName = userName
         self.phpSessionId = phpSessionId
-        self.httpSession = session
+        self.httpSession = session if session is not None else Session()
+        self.doneStore = doneStore
+        # Lookups of many IDs are split into chunks of that size, sent concurrently
+        self.chunkSize = chunkSize
+        self.maxWorkers = maxWorkers
+        self.maxAttempts = maxAttempts
+        # Files are marked concurrently, while the session keeps the rate of requests
+        self.maxWritesInFlight = maxWritesInFlight
 
 
     def getUndoneCategories(self, categories: list[CategoryDescriptor]) -> list[CategoryDescriptor]:
-        requestParams = {
-            'action': 'items-done',
-            'qids': [cat.qId for cat in categories],
-        }
+        if self.doneStore is not None:
+            knownDone = self.doneStore.getDoneItems(cat.qId for cat in categories)
+            categories = [cat for cat in categories if cat.qId not in knownDone]
+            if not categories:
+                return []
 
-        response = self.httpSession.post(
-            'https://hay.toolforge.org/depictor/api/index.php',
-            json=requestParams,
-            cookies={
-                'PHPSESSID': self.phpSessionId,
-            },
-            timeout=60,
-        )
-        try:
-            doneDictionary = response.json()
-        except Exception as e:
-            raise Exception(
-                'Depictor API responded with invalid JSON (response code: ' +
-                str(response.status_code) + '). Beginning of the response: ' + response.text[:200]
-            ) from e
+        doneDictionary = self._postChunked('items-done', 'qids', [cat.qId for cat in categories])
+
+        self._rememberDoneItems(cat.qId for cat in categories if doneDictionary.get(cat.qId, False))
 
         return [
             cat for cat in categories
@@ -39,32 +50,19 @@ class Depictor:
         ]
 
 
-    def getUndoneFiles(self, files: list[FileDescriptor]) -> list[FileDescriptor]:
-        requestParams = {
-            'action': 'files-exists',
-            'mids': [ file.mId for file in files ],
-        }
+    def getUndoneFiles(self, files: FileCollection) -> FileCollection:
+        if self.doneStore is not None:
+            files = files.without(self.doneStore.getDoneFiles(files.mIds))
+            if not files:
+                return FileCollection()
 
-        response = self.httpSession.post(
-            'https://hay.toolforge.org/depictor/api/index.php',
-            json=requestParams,
-            cookies={
-                'PHPSESSID': self.phpSessionId,
-            },
-            timeout=60,
-        )
-        try:
-            doneMids = response.json()
-        except Exception as e:
-            raise Exception(
-                'Depictor API responded with invalid JSON (response code: ' +
-                str(response.status_code) + '). Beginning of the response: ' + response.text[:200]
-            ) from e
+        mIds = files.mIds
+        doneMids = self._postChunked('files-exists', 'mids', mIds)
+        done = { mId for mId in mIds if doneMids.get(mId, False) }
 
-        return [
-            file for file in files
-            if not doneMids.get(file.mId, False)
-        ]
+        self._rememberDoneFiles(done)
+
+        return files.without(done)
 
 
     def markFileAsNotDepictingSubject(self, mId: str, category: CategoryDescriptor) -> None:
@@ -101,6 +99,62 @@ class Depictor:
             raise Exception(
                 f'Failed to mark file {mId} as not depicting {category.qId} in category {category.title}: {rawResponse.text}'
             )
+        self._rememberDoneFiles([mId])
+
+
+    def markFilesAsNotDepictingSubject(
+            self,
+            mIds: Sequence[str],
+            category: CategoryDescriptor,
+            isInterrupted: Callable[[], bool] = lambda: False
+        ) -> Iterator[tuple[str, Optional[Exception]]]:
+        '''
+        Marks the files, keeping up to `maxWritesInFlight` requests in flight, and yields
+        (MID, None) for every file confirmed, in order. Files that failed are checked in
+        Depictor, as the request may have been applied anyway, and the others are sent
+        again, up to `maxAttempts` times in total. At the end, (MID, error) is yielded
+        for every file that still failed. After an interrupt, no new requests are sent,
+        but those in flight are waited for.
+        '''
+        pending = list(mIds)
+        errors: dict[str, Exception] = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.maxWritesInFlight)) as executor:
+            for attempt in range(self.maxAttempts):
+                if attempt > 0:
+                    try:
+                        doneMids = self._postChunked('files-exists', 'mids', pending)
+                    except Exception:
+                        break
+                    confirmed = [mId for mId in pending if doneMids.get(mId, False)]
+                    self._rememberDoneFiles(confirmed)
+                    yield from ((mId, None) for mId in confirmed)
+                    pending = [mId for mId in pending if not doneMids.get(mId, False)]
+
+                failed = []
+                inFlight: deque[tuple[str, Future]] = deque()
+                mIdIterator = iter(pending)
+                while True:
+                    while len(inFlight) < self.maxWritesInFlight and not isInterrupted():
+                        mId = next(mIdIterator, None)
+                        if mId is None:
+                            break
+                        inFlight.append((mId, executor.submit(self.markFileAsNotDepictingSubject, mId, category)))
+                    if not inFlight:
+                        break
+                    mId, future = inFlight.popleft()
+                    try:
+                        future.result()
+                        yield mId, None
+                    except Exception as e:
+                        failed.append(mId)
+                        errors[mId] = e
+
+                pending = failed
+                if not pending or isInterrupted():
+                    break
+
+        for mId in pending:
+            yield mId, errors[mId]
 
 
     def markCategoryAsDone(self, qId: str) -> None:
@@ -131,3 +185,74 @@ class Depictor:
             raise Exception(
                 f'Failed to mark category of {qId} as done: {rawResponse.text}'
             )
+        self._rememberDoneItems([qId])
+
+
+    def _rememberDoneItems(self, qIds: Iterable[str]):
+        if self.doneStore is not None:
+            ignoringStoreErrors(self.doneStore.addDoneItems, qIds)
+
+
+    def _rememberDoneFiles(self, mIds: Iterable[str]):
+        if self.doneStore is not None:
+            ignoringStoreErrors(self.doneStore.addDoneFiles, mIds)
+
+
+    def _postChunked(self, action: str, idsKey: str, ids: list[str]) -> dict:
+        '''
+        Sends a lookup of many IDs in chunks, concurrently, and merges the results.
+        Chunks that failed are retried, up to `maxAttempts` times in total.
+        '''
+        chunks = [ids[i:i + self.chunkSize] for i in range(0, len(ids), self.chunkSize)]
+        result = {}
+        for _ in range(self.maxAttempts):
+            if not chunks:
+                break
+
+            failedChunks = []
+            with ThreadPoolExecutor(max_workers=min(self.maxWorkers, len(chunks))) as executor:
+                futures = [
+                    (chunk, executor.submit(self._post, { 'action': action, idsKey: chunk }))
+                    for chunk in chunks
+                ]
+                for chunk, future in futures:
+                    try:
+                        result.update(future.result())
+                    except Exception as e:
+                        failedChunks.append(chunk)
+                        lastError = e
+            chunks = failedChunks
+
+        if chunks:
+            raise lastError
+        return result
+
+
+    def _post(self, requestParams: dict) -> dict:
+        response = self.httpSession.post(
+            'https://hay.toolforge.org/depictor/api/index.php',
+            json=requestParams,
+            cookies={
+                'PHPSESSID': self.phpSessionId,
+            },
+            timeout=60,
+        )
+        try:
+            return response.json()
+        except Exception as e:
+            raise Exception(
+                'Depictor API responded with invalid JSON (response code: ' +
+                str(response.status_code) + '). Beginning of the response: ' + response.text[:200]
+            ) from e
+
+
+def ignoringStoreErrors(add: Callable[[Iterable[str]], None], ids: Iterable[str]):
+    '''
+    Records what Depictor reported as done in the local mirror. The mirror only saves
+    lookups, so failing to update it (e.g. when another shard keeps the database locked
+    for too long) must not turn a decision Depictor already accepted into an error.
+    '''
+    try:
+        add(ids)
+    except sqlite3.Error:
+        pass
@@ -0,0 +1,136 @@
+from threading import Lock
+from typing import Iterable, Optional
+from ._sqlite import connect, retryOnLock
+import time
+
+
+class DoneStore:
+    '''
+    A local SQLite mirror of what is known to be done in Depictor:
+    items (categories) marked as done and files with any decision.
+    Depictor never forgets these, so the entries don't expire.
+
+    It also keeps high-water marks of categories: the page ID of the newest file
+    seen in the category, so that later runs can look only at newer files, and
+    the state of categories on Commons when they were last processed, so that
+    later runs can skip those that haven't changed.
+
+    Shard processes share the database, so every operation waits for the locks
+    of the others and is retried if it still finds the database locked.
+    '''
+
+    # SQLite limits the number of parameters in a single statement
+    _CHUNK_SIZE = 500
+
+    def __init__(self, path: str):
+        self._lock = Lock()
+        self._connection = connect(path)
+        self._createTables()
+
+
+    @retryOnLock
+    def _createTables(self):
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS done_items (qid TEXT PRIMARY KEY, done_at REAL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS done_files (mid TEXT PRIMARY KEY, done_at REAL)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS category_marks (category TEXT PRIMARY KEY, page_id INTEGER, updated_at REAL)')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS category_states (category TEXT PRIMARY KEY, touched TEXT, files INTEGER, whole_category INTEGER, updated_at REAL)'
+            )
+
+
+    def getDoneItems(self, qIds: Iterable[str]) -> set[str]:
+        return self._select('done_items', 'qid', list(qIds))
+
+
+    def getDoneFiles(self, mIds: Iterable[str]) -> set[str]:
+        return self._select('done_files', 'mid', list(mIds))
+
+
+    def addDoneItems(self, qIds: Iterable[str]):
+        self._insert('done_items', 'qid', list(qIds))
+
+
+    def addDoneFiles(self, mIds: Iterable[str]):
+        self._insert('done_files', 'mid', list(mIds))
+
+
+    @retryOnLock
+    def getHighWaterMark(self, categoryName: str) -> Optional[int]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT page_id FROM category_marks WHERE category = ?', (categoryName,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+
+    @retryOnLock
+    def setHighWaterMark(self, categoryName: str, pageId: int):
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT INTO category_marks (category, page_id, updated_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (category) DO UPDATE SET page_id = MAX(page_id, excluded.page_id), updated_at = excluded.updated_at',
+                (categoryName, pageId, time.time()),
+            )
+
+
+    def getCategoryStates(self, categoryNames: Iterable[str]) -> dict[str, tuple[str, int, bool]]:
+        '''Returns (touched, number of files, whether the whole category was searched) recorded for the categories.'''
+        return self._selectCategoryStates(list(categoryNames))
+
+
+    @retryOnLock
+    def _selectCategoryStates(self, names: list[str]) -> dict[str, tuple[str, int, bool]]:
+        states = {}
+        with self._lock:
+            for i in range(0, len(names), self._CHUNK_SIZE):
+                chunk = names[i:i + self._CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f'SELECT category, touched, files, whole_category FROM category_states WHERE category IN ({placeholders})',
+                    chunk,
+                )
+                states.update((category, (touched, files, bool(whole))) for category, touched, files, whole in rows)
+        return states
+
+
+    @retryOnLock
+    def setCategoryState(self, categoryName: str, touched: str, files: int, wholeCategory: bool):
+        '''Records the state of a category on Commons at the time it was processed without anything left to do.'''
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO category_states (category, touched, files, whole_category, updated_at) VALUES (?, ?, ?, ?, ?)',
+                (categoryName, touched, files, int(wholeCategory), time.time()),
+            )
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+    @retryOnLock
+    def _select(self, table: str, column: str, ids: list[str]) -> set[str]:
+        found = set()
+        with self._lock:
+            for i in range(0, len(ids), self._CHUNK_SIZE):
+                chunk = ids[i:i + self._CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self._connection.execute(
+                    f'SELECT {column} FROM {table} WHERE {column} IN ({placeholders})',
+                    chunk,
+                )
+                found.update(row[0] for row in rows)
+        return found
+
+
+    @retryOnLock
+    def _insert(self, table: str, column: str, ids: list[str]):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f'INSERT OR IGNORE INTO {table} ({column}, done_at) VALUES (?, ?)',
+                ((id, now) for id in ids),
+            )
@@ -0,0 +1,165 @@
+from json import JSONDecodeError, JSONDecoder
+from json.decoder import scanstring
+from typing import Any, Generator, Iterable, Iterator, Optional
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+# Asked for by the parser when it needs the next chunk of the document
+_NEED_MORE = object()
+
+
+def iterJsonArrayItems(chunks: Iterable[str], path: tuple) -> Iterator[Any]:
+    '''
+    Incrementally parses a JSON document and yields items of the array found at
+    the given path, without keeping the whole document in memory. Everything
+    outside of that array is skipped. Chunks after the end of the array are not read.
+
+    :param chunks: The document, in pieces of any size.
+    :param path: Keys and indices leading to the array, e.g. ('*', 0, 'a', '*').
+    :return: An iterator of decoded array items.
+    :raises JsonStreamError: If the document turns out not to be a JSON object or array.
+    '''
+    parser = JsonArrayParser(path)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.finished:
+            return
+    yield from parser.close()
+
+
+class JsonArrayParser:
+    '''
+    The push-based form of iterJsonArrayItems, for chunks arriving asynchronously.
+    Every chunk is passed to `feed`, which returns the array items completed by it,
+    and `close` is called at the end of the document.
+    '''
+
+    def __init__(self, path: tuple):
+        self.finished = False
+        self._parser = _parseArrayItems(path)
+        # Runs up to the first request for a chunk
+        next(self._parser)
+
+
+    def feed(self, chunk: str) -> list[Any]:
+        return self._send(chunk)
+
+
+    def close(self) -> list[Any]:
+        return self._send(None)
+
+
+    def _send(self, chunk: Optional[str]) -> list[Any]:
+        items = []
+        if self.finished:
+            return items
+        try:
+            value = self._parser.send(chunk)
+            while value is not _NEED_MORE:
+                items.append(value)
+                value = next(self._parser)
+        except StopIteration:
+            self.finished = True
+        return items
+
+
+def _parseArrayItems(path: tuple) -> Generator[Any, Optional[str], None]:
+    '''Yields the array items, and _NEED_MORE whenever it needs a chunk, which is sent back (None at the end).'''
+    decoder = JSONDecoder()
+    buffer = ''
+    pos = 0
+    ended = False
+
+    def readMore() -> Generator[Any, Optional[str], bool]:
+        nonlocal buffer, pos, ended
+        while not ended:
+            chunk = yield _NEED_MORE
+            if chunk is None:
+                ended = True
+            elif chunk:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                return True
+        return False
+
+    # Each entry is [container type, current key or index, whether a key is expected next]
+    stack: list[list] = []
+
+    while True:
+        if pos >= len(buffer) and not (yield from readMore()):
+            return
+
+        char = buffer[pos]
+        if char.isspace():
+            pos += 1
+            continue
+
+        if not stack and char not in '{[':
+            raise JsonStreamError('Not a JSON object or array. Beginning of the document: ' + buffer[pos:pos + 200])
+
+        if char == '"':
+            try:
+                value, end = scanstring(buffer, pos + 1)
+            except JSONDecodeError:
+                if not (yield from readMore()):
+                    raise
+                continue
+            top = stack[-1]
+            if top[0] == '{' and top[2]:
+                top[1] = value
+                top[2] = False
+            pos = end
+
+        elif char == '{':
+            stack.append(['{', None, True])
+            pos += 1
+
+        elif char == '[':
+            pos += 1
+            if tuple(entry[1] for entry in stack) != path:
+                stack.append(['[', 0, False])
+                continue
+
+            # Found the array, yield its items one by one
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ','):
+                    pos += 1
+                if pos >= len(buffer):
+                    if not (yield from readMore()):
+                        raise JsonStreamError('Unexpected end of the document inside an array.')
+                    continue
+                if buffer[pos] == ']':
+                    return
+
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except JSONDecodeError:
+                    if not (yield from readMore()):
+                        raise
+                    continue
+                # A number could continue in the next chunk
+                if end >= len(buffer) and not isinstance(item, (dict, list, str)) and (yield from readMore()):
+                    continue
+                pos = end
+                yield item
+
+        elif char == ',':
+            top = stack[-1]
+            if top[0] == '[':
+                top[1] += 1
+            else:
+                top[2] = True
+            pos += 1
+
+        elif char in '}]':
+            stack.pop()
+            pos += 1
+            if not stack:
+                return
+
+        else:
+            # ':' and scalar values outside of the array
+            pos += 1
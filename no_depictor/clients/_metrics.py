@@ -0,0 +1,214 @@
+from threading import Event, Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+import json
+import math
+import time
+
+
+# Upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+class EndpointMetrics:
+
+    def __init__(self):
+        self.requests = 0
+        self.cached = 0
+        self.errors = 0
+        self.rateLimited = 0 # Responses with HTTP 429
+        self.retries = 0
+        self.latencySum = 0.0
+        self.latencyBuckets = [0] * len(LATENCY_BUCKETS)
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+
+    def toDict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'cached': self.cached,
+            'errors': self.errors,
+            'rate_limited': self.rateLimited,
+            'retries': self.retries,
+            'latency_sum_sec': self.latencySum,
+            'latency_buckets': {
+                str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.latencyBuckets)
+            },
+            'bytes_sent': self.bytesSent,
+            'bytes_received': self.bytesReceived,
+        }
+
+
+class Metrics:
+    '''
+    Collects per-endpoint statistics of HTTP requests: counts, latency histograms,
+    bytes transferred, 429 responses and retries, as well as time spent waiting for
+    the rate limiter and reuse of connections to each host. Optionally, the statistics are periodically written to a file
+    in the Prometheus text format or as JSON, by a background thread, so that writing the file neither slows down
+    nor fails the requests.
+    '''
+
+    def __init__(self, exportPath: Optional[str] = None, exportFormat: str = 'prometheus', exportInterval: float = 30):
+        self.exportPath = exportPath
+        self.exportFormat = exportFormat
+        self.exportInterval = exportInterval
+
+        self._lock = Lock()
+        self._startTime = time.time()
+        self._stopExporting = Event()
+        self._endpoints: dict[str, EndpointMetrics] = {}
+        self._rateLimitSleep: dict[str, float] = {}
+        self._connections: dict[str, tuple[int, int]] = {}
+        if exportPath:
+            Thread(target=self._exportPeriodically, name='metrics-export', daemon=True).start()
+
+
+    def recordRequest(self, endpoint: str, statusCode: Optional[int], latency: float, bytesSent: int, bytesReceived: int):
+        '''Records a completed request. `statusCode` is None if the request failed without a response.'''
+        with self._lock:
+            metrics = self._getEndpoint(endpoint)
+            metrics.requests += 1
+            metrics.latencySum += latency
+            metrics.bytesSent += bytesSent
+            metrics.bytesReceived += bytesReceived
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    metrics.latencyBuckets[i] += 1
+                    break
+            if statusCode is None or statusCode >= 500:
+                metrics.errors += 1
+            elif statusCode == 429:
+                metrics.rateLimited += 1
+
+
+    def recordCached(self, endpoint: str):
+        with self._lock:
+            self._getEndpoint(endpoint).cached += 1
+
+
+    def recordRetry(self, endpoint: str):
+        with self._lock:
+            self._getEndpoint(endpoint).retries += 1
+
+
+    def recordRateLimitSleep(self, host: str, seconds: float):
+        with self._lock:
+            self._rateLimitSleep[host] = self._rateLimitSleep.get(host, 0.0) + seconds
+
+
+    def recordConnections(self, host: str, opened: int, requests: int):
+        '''Records how many connections to the host have been opened so far, and how many requests were sent over them.'''
+        with self._lock:
+            self._connections[host] = (opened, requests)
+
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'started_at': self._startTime,
+                'elapsed_sec': time.time() - self._startTime,
+                'endpoints': { name: metrics.toDict() for name, metrics in sorted(self._endpoints.items()) },
+                'rate_limit_sleep_sec': dict(sorted(self._rateLimitSleep.items())),
+                'connections': {
+                    host: { 'opened': opened, 'requests': requests }
+                    for host, (opened, requests) in sorted(self._connections.items())
+                },
+            }
+
+
+    def export(self):
+        '''Writes the current statistics to the export file, if any.'''
+        if not self.exportPath:
+            return
+
+        snapshot = self.snapshot()
+        if self.exportFormat == 'json':
+            content = json.dumps(snapshot, indent=4)
+        else:
+            content = toPrometheus(snapshot)
+
+        with open(self.exportPath, 'w', encoding='utf-8') as file:
+            file.write(content)
+
+
+    def close(self):
+        '''Stops the periodic export; the final one is left to the caller.'''
+        self._stopExporting.set()
+
+
+    def _exportPeriodically(self):
+        while not self._stopExporting.wait(self.exportInterval):
+            try:
+                self.export()
+            except OSError:
+                # Tried again at the next interval, and the final export reports the error
+                pass
+
+
+    def _getEndpoint(self, endpoint: str) -> EndpointMetrics:
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = EndpointMetrics()
+        return metrics
+
+
+def endpointName(url: str, jsonBody: Optional[dict] = None) -> str:
+    '''
+    Names the endpoint of a request, e.g. `commons.wikimedia.org:search`
+    or `hay.toolforge.org:add-file`, based on the host and the action.
+    '''
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    action = (jsonBody or {}).get('action') or query.get('list') or query.get('generator') or query.get('action')
+    if not action and parts.path.rstrip('/').endswith('sparql'):
+        action = 'sparql'
+    return f'{parts.hostname}:{action}' if action else str(parts.hostname)
+
+
+def toPrometheus(snapshot: dict) -> str:
+    lines = []
+
+    def metric(name: str, type: str, help: str, samples: list[tuple[dict, float]]):
+        lines.append(f'# HELP no_depictor_{name} {help}')
+        lines.append(f'# TYPE no_depictor_{name} {type}')
+        for labels, value in samples:
+            labelText = ','.join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f'no_depictor_{name}{{{labelText}}} {value}')
+
+    endpoints = snapshot['endpoints']
+    for name, key, help in (
+        ('requests_total', 'requests', 'Requests sent over the network.'),
+        ('cached_responses_total', 'cached', 'Requests served from the local cache.'),
+        ('errors_total', 'errors', 'Requests failed with a connection error or HTTP 5xx.'),
+        ('rate_limited_total', 'rate_limited', 'Responses with HTTP 429.'),
+        ('retries_total', 'retries', 'Requests repeated after HTTP 429 or a transient failure.'),
+        ('sent_bytes_total', 'bytes_sent', 'Bytes of request bodies sent.'),
+        ('received_bytes_total', 'bytes_received', 'Bytes of response bodies received.'),
+    ):
+        metric(name, 'counter', help, [({ 'endpoint': endpoint }, values[key]) for endpoint, values in endpoints.items()])
+
+    lines.append('# HELP no_depictor_request_duration_seconds Latency of requests.')
+    lines.append('# TYPE no_depictor_request_duration_seconds histogram')
+    for endpoint, values in endpoints.items():
+        cumulative = 0
+        for bound, count in values['latency_buckets'].items():
+            cumulative += count
+            le = '+Inf' if bound == 'inf' else bound
+            lines.append(f'no_depictor_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {cumulative}')
+        lines.append(f'no_depictor_request_duration_seconds_sum{{endpoint="{endpoint}"}} {values["latency_sum_sec"]}')
+        lines.append(f'no_depictor_request_duration_seconds_count{{endpoint="{endpoint}"}} {values["requests"]}')
+
+    metric(
+        'rate_limit_sleep_seconds_total', 'counter', 'Time spent waiting for the rate limiter.',
+        [({ 'host': host }, seconds) for host, seconds in snapshot['rate_limit_sleep_sec'].items()]
+    )
+    metric(
+        'connections_opened_total', 'counter', 'Connections opened to the host.',
+        [({ 'host': host }, values['opened']) for host, values in snapshot['connections'].items()]
+    )
+    metric(
+        'connection_requests_total', 'counter', 'Requests sent over the connections to the host.',
+        [({ 'host': host }, values['requests']) for host, values in snapshot['connections'].items()]
+    )
+    return '\n'.join(lines) + '\n'
@@ -1,19 +1,105 @@
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
+from typing import Iterator, Optional
 from ..data import CategoryDescriptor
+from ._json_stream import iterJsonArrayItems
+from ._response_cache import cacheParsedResponse
 
 
 class PetScan:
 
-    def __init__(self, session: Session = Session()):
-        self.httpSession = session
+    def __init__(self, session: Optional[Session] = None, maxWorkers: int = 4):
+        self.httpSession = session if session is not None else Session()
+        # Split queries are sent concurrently, while the session keeps the rate of requests
+        self.maxWorkers = maxWorkers
 
 
     def getSubcategories(self, categoryName: str, depth: int = 1) -> list[CategoryDescriptor]:
+        return list(self.iterSubcategories(categoryName, depth))
+
+
+    def iterSubcategories(self, categoryName: str, depth: int = 1) -> Iterator[CategoryDescriptor]:
+        '''
+        Streams subcategories of the category, parsing the response incrementally,
+        so that the first ones can be processed before the whole response is downloaded.
+
+        Queries of large trees may time out or be cut short. Then the query is split:
+        the direct subcategories are fetched, and each of them is queried one level
+        less deep, concurrently, splitting further where needed. Categories found
+        by several queries are yielded only once.
+        '''
         categoryName = categoryName.replace('_', ' ')
+        seen: set[str] = set()
+        try:
+            for category in self._query(categoryName, depth):
+                seen.add(category.title)
+                yield category
+            return
+        except Exception:
+            if depth == 0:
+                raise
+        yield from self._iterSplitQuery(categoryName, depth, seen)
+
+
+    def _iterSplitQuery(self, categoryName: str, depth: int, seen: set[str]) -> Iterator[CategoryDescriptor]:
+        # Categories whose query failed at the current depth; the tree is split level by level
+        failed = [categoryName]
+        queried = { categoryName }
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            while failed:
+                subcategoryNames = []
+                for subcategories in executor.map(self._getDirectSubcategories, failed):
+                    for title, qId in subcategories:
+                        if qId and title not in seen:
+                            seen.add(title)
+                            yield CategoryDescriptor(qId, title)
+                        name = title.replace('_', ' ')
+                        # Breadth-first, a category is first reached with the most levels left below it
+                        if name not in queried:
+                            queried.add(name)
+                            subcategoryNames.append(name)
+
+                depth -= 1
+                failed = []
+                for name, categories in zip(subcategoryNames, executor.map(self._tryQuery, subcategoryNames, [depth] * len(subcategoryNames))):
+                    if categories is None:
+                        failed.append(name)
+                        continue
+                    for category in categories:
+                        if category.title not in seen:
+                            seen.add(category.title)
+                            yield category
+
+
+    def _tryQuery(self, categoryName: str, depth: int) -> Optional[list[CategoryDescriptor]]:
+        '''Returns the subcategories, or None if the query failed and can be split further.'''
+        try:
+            return list(self._query(categoryName, depth))
+        except Exception:
+            if depth == 0:
+                raise
+            return None
+
+
+    def _getDirectSubcategories(self, categoryName: str) -> list[tuple[str, Optional[str]]]:
+        '''Returns titles of direct subcategories, with their Wikidata items, if any.'''
+        return [
+            (item['title'], item.get('q') or None)
+            for item in self._iterItems(categoryName, 0, 'any')
+        ]
+
+
+    def _query(self, categoryName: str, depth: int) -> Iterator[CategoryDescriptor]:
+        for item in self._iterItems(categoryName, depth, 'with'):
+            if 'q' in item:
+                yield CategoryDescriptor(item['q'], item['title'])
+
+
+    def _iterItems(self, categoryName: str, depth: int, wikidataItem: str) -> Iterator[dict]:
         requestParams = {
             'categories': categoryName,
             'depth': depth,
-            'wikidata_item': 'with',
+            'wikidata_item': wikidataItem,
             'project': 'wikimedia',
             'language': 'commons',
             'format': 'json',
@@ -21,29 +107,30 @@ class PetScan:
             'search_max_results': 500, # Seems to be ignored by PetScan...
             'doit': 1
         }
-        
+
         rawResponse = self.httpSession.get(
             'https://petscan.wmcloud.org/',
             params=requestParams,
             timeout=60,
+            stream=True,
         )
-        try:
-            response = rawResponse.json()
-        except Exception as e:
-            raise Exception(
-                'PetScan API responded with invalid JSON (response code: ' +
-                str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
-            ) from e
-
-        # PetScan JSON response is far from self-explanatory,
-        # property path: response['*'][0]['a']['*']
-        items = response \
-            .get('*', [{}])[0] \
-            .get('a', {}) \
-            .get('*', [])
-        
-        return [
-            CategoryDescriptor(item['q'], item['title'])
-            for item in items
-            if 'q' in item and 'title' in item
-        ]
+        with rawResponse:
+            rawResponse.encoding = rawResponse.encoding or 'utf-8'
+
+            # PetScan JSON response is far from self-explanatory,
+            # property path: response['*'][0]['a']['*']
+            chunks = rawResponse.iter_content(chunk_size=64 * 1024, decode_unicode=True)
+            items = iterJsonArrayItems(chunks, ('*', 0, 'a', '*'))
+            try:
+                for item in items:
+                    if isinstance(item, dict) and 'title' in item:
+                        yield item
+            except ValueError as e: # Includes JSONDecodeError and JsonStreamError
+                raise Exception(
+                    'PetScan API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status_code) + '). ' + str(e)
+                ) from e
+            # The parser stops after the array, but only a response read to its end can be cached
+            for _ in chunks:
+                pass
+            cacheParsedResponse(rawResponse)
@@ -0,0 +1,224 @@
+from email.utils import parsedate_to_datetime
+from threading import Lock
+from typing import Callable, Optional, TypeVar
+import sqlite3
+import time
+
+
+T = TypeVar('T')
+
+
+# Endpoints writing to Depictor, which share their own bucket, see bucketName
+DEPICTOR_WRITE_ENDPOINTS = ('hay.toolforge.org:add-file', 'hay.toolforge.org:item-done')
+DEPICTOR_WRITES = 'hay.toolforge.org:write'
+
+# Initial rate (requests per second), burst size and bounds of adaptation for each host.
+# Depictor is run by a volunteer, so writes never go faster than the old fixed pace
+# of 2 per second, unless the limits are raised in the configuration.
+DEFAULT_HOST_LIMITS = {
+    DEPICTOR_WRITES: { 'rate': 2, 'burst': 1, 'min_rate': 0.5, 'max_rate': 2 },
+    'hay.toolforge.org': { 'rate': 2, 'burst': 2, 'min_rate': 0.5, 'max_rate': 5 },
+    'commons.wikimedia.org': { 'rate': 5, 'burst': 5, 'min_rate': 0.5, 'max_rate': 20 },
+    'www.wikidata.org': { 'rate': 5, 'burst': 5, 'min_rate': 0.5, 'max_rate': 20 },
+    'query.wikidata.org': { 'rate': 2, 'burst': 2, 'min_rate': 0.2, 'max_rate': 5 },
+    'petscan.wmcloud.org': { 'rate': 1, 'burst': 1, 'min_rate': 0.1, 'max_rate': 2 },
+}
+
+
+class _TokenBucket:
+
+    def __init__(
+            self,
+            rate: float,
+            burst: float = 1,
+            min_rate: Optional[float] = None,
+            max_rate: Optional[float] = None,
+            slow_latency: float = 2.0,
+            increase: float = 0.05
+        ):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        # Raising only the initial rate raises the bounds with it
+        self.minRate = min(float(min_rate if min_rate is not None else rate), self.rate)
+        self.maxRate = max(float(max_rate if max_rate is not None else rate), self.rate)
+        self.slowLatency = slow_latency
+        self.increase = increase
+
+        self.tokens = self.burst
+        self.lastRefill = time.monotonic()
+
+
+    def reserve(self) -> float:
+        '''Takes a token and returns how long to wait before using it.'''
+        now = time.monotonic()
+        if now > self.lastRefill:
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate)
+            self.lastRefill = now
+
+        self.tokens -= 1
+        delay = self.lastRefill - now # Positive only if the host asked us to back off
+        if self.tokens < 0:
+            delay += -self.tokens / self.rate
+        return delay
+
+
+    def backOff(self, delay: float):
+        now = time.monotonic()
+        self.tokens = min(self.tokens, 0)
+        self.lastRefill = max(self.lastRefill, now + delay)
+        self.rate = max(self.minRate, self.rate / 2)
+
+
+    def adapt(self, latency: float, failed: bool):
+        if failed or latency > self.slowLatency:
+            self.rate = max(self.minRate, self.rate * 0.9)
+        else:
+            self.rate = min(self.maxRate, self.rate + self.increase)
+
+
+class RateLimiter:
+    '''
+    Keeps a token bucket for each host, shared by all the clients (and threads)
+    sending requests to that host. The rate of each bucket adapts to responses:
+    it grows slowly while the server responds quickly, drops on slow responses
+    and server errors, and is halved on HTTP 429. Retry-After holds back all
+    requests to the host, not only the one that received it.
+
+    Hosts without configured limits are not rate-limited. Writes to Depictor
+    are limited separately from reads, see bucketName.
+    '''
+
+    def __init__(self, hostLimits: Optional[dict[str, dict]] = None):
+        '''
+        :param hostLimits: Overrides of DEFAULT_HOST_LIMITS, keyed by host name. Each value
+            may contain `rate`, `burst`, `min_rate`, `max_rate`, `slow_latency` and `increase`.
+        '''
+        limits = { host: dict(limit) for host, limit in DEFAULT_HOST_LIMITS.items() }
+        for host, limit in (hostLimits or {}).items():
+            limits.setdefault(host, {}).update(limit)
+
+        self._lock = Lock()
+        self._buckets = {
+            host: _TokenBucket(**limit)
+            for host, limit in limits.items()
+            if 'rate' in limit
+        }
+
+
+    def reserve(self, host: str) -> float:
+        '''
+        Reserves a request to the host.
+
+        :return: Number of seconds the caller must wait before sending the request.
+        '''
+        return self._update(host, lambda bucket: max(bucket.reserve(), 0), 0)
+
+
+    def acquire(self, host: str):
+        '''Blocks until a request to the host can be sent.'''
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def report(self, host: str, statusCode: int, latency: float, retryAfter: Optional[str] = None):
+        '''Updates the rate for the host based on the response.'''
+        def update(bucket: _TokenBucket):
+            if statusCode == 429:
+                bucket.backOff(parseRetryAfter(retryAfter))
+            else:
+                bucket.adapt(latency, statusCode >= 500)
+
+        self._update(host, update, None)
+
+
+    def getRate(self, host: str) -> Optional[float]:
+        with self._lock:
+            bucket = self._buckets.get(host)
+            return bucket.rate if bucket is not None else None
+
+
+    def _update(self, host: str, operation: Callable[[_TokenBucket], T], default: T) -> T:
+        '''Applies the operation to the bucket of the host, or returns the default if the host is not rate-limited.'''
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                return default
+            return operation(bucket)
+
+
+class SharedRateLimiter(RateLimiter):
+    '''
+    A RateLimiter whose buckets are shared by several processes through an SQLite
+    database, so that together they don't exceed the limits of each host. The state
+    of a bucket is loaded and stored in the same transaction as every update.
+    '''
+
+    def __init__(self, path: str, hostLimits: Optional[dict[str, dict]] = None):
+        super().__init__(hostLimits)
+        # Transactions are started explicitly, to lock the database for the whole update
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=OFF')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_buckets (host TEXT PRIMARY KEY, tokens REAL, last_refill REAL, rate REAL)'
+            )
+
+
+    def reset(self):
+        '''Forgets the state left by previous runs.'''
+        with self._lock:
+            self._connection.execute('DELETE FROM rate_buckets')
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+    def _update(self, host: str, operation: Callable[[_TokenBucket], T], default: T) -> T:
+        with self._lock:
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                return default
+
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._connection.execute(
+                    'SELECT tokens, last_refill, rate FROM rate_buckets WHERE host = ?', (host,)
+                ).fetchone()
+                if row is not None:
+                    # time.monotonic() is system-wide, so it can be compared across processes
+                    bucket.tokens, bucket.lastRefill, bucket.rate = row
+                result = operation(bucket)
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO rate_buckets (host, tokens, last_refill, rate) VALUES (?, ?, ?, ?)',
+                    (host, bucket.tokens, bucket.lastRefill, bucket.rate),
+                )
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            return result
+
+
+def bucketName(host: str, endpoint: str) -> str:
+    '''Returns the name of the bucket limiting the request: the host, or DEPICTOR_WRITES for writes to Depictor.'''
+    if endpoint in DEPICTOR_WRITE_ENDPOINTS:
+        return DEPICTOR_WRITES
+    return host
+
+
+def parseRetryAfter(value: Optional[str], default: float = 5) -> float:
+    '''Parses the Retry-After header, which is either a number of seconds or an HTTP date.'''
+    if not value:
+        return default
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return default
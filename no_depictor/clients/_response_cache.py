@@ -0,0 +1,184 @@
+from requests import PreparedRequest, Response
+from requests.structures import CaseInsensitiveDict
+from threading import Lock
+from typing import Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from ._sqlite import connect, retryOnLock
+import json
+import time
+
+
+# Time to live (in seconds) of cached responses; requests not listed here are never cached.
+# Depictor is deliberately absent, as its state changes with every decision we make.
+DEFAULT_TTLS = {
+    'petscan.wmcloud.org': 24 * 3600,
+    'query.wikidata.org/sparql': 24 * 3600,
+    'www.wikidata.org/w/api.php?action=wbgetentities': 6 * 3600,
+}
+
+
+class ResponseCache:
+    '''
+    An on-disk cache of responses to read-only GET requests, stored in SQLite.
+    Entries expire after a per-endpoint TTL and the least recently used ones
+    are evicted when the cache grows over its size limit. A response is stored
+    only once the client parsed it successfully, see cacheParsedResponse.
+
+    Shard processes share the database, so the total size is always read from
+    it, and operations that find the database locked are retried.
+    '''
+
+    def __init__(self, path: str, maxBytes: int = 200 * 1024 * 1024, ttls: Optional[dict[str, float]] = None, refresh: bool = False):
+        '''
+        :param path: Path to the SQLite database.
+        :param maxBytes: Maximum total size of cached response bodies.
+        :param ttls: Overrides of DEFAULT_TTLS, keyed by endpoint.
+        :param refresh: If True, cached responses are not used, but fresh ones are still stored.
+        '''
+        self.maxBytes = maxBytes
+        self.ttls = { **DEFAULT_TTLS, **(ttls or {}) }
+        self.refresh = refresh
+
+        self._lock = Lock()
+        self._connection = connect(path)
+        self._createTables()
+
+
+    @retryOnLock
+    def _createTables(self):
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, status INTEGER, headers TEXT, body BLOB, '
+                'expires_at REAL, accessed_at REAL, size INTEGER)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+
+
+    def getTtl(self, request: PreparedRequest) -> Optional[float]:
+        '''Returns the TTL for the request, or None if it must not be cached.'''
+        if request.method != 'GET':
+            return None
+
+        url = urlsplit(request.url)
+        query = dict(parse_qsl(url.query))
+        for endpoint, ttl in self.ttls.items():
+            endpointUrl = urlsplit('//' + endpoint)
+            if url.hostname != endpointUrl.hostname:
+                continue
+            if endpointUrl.path and url.path != endpointUrl.path:
+                continue
+            if any(query.get(key) != value for key, value in parse_qsl(endpointUrl.query)):
+                continue
+            return ttl
+        return None
+
+
+    def get(self, request: PreparedRequest) -> Optional[Response]:
+        if self.refresh:
+            return None
+
+        row = self._select(self._key(request))
+        if row is None:
+            return None
+
+        status, headers, body = row
+        response = Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+
+    def put(self, request: PreparedRequest, response: Response, ttl: float, body: Optional[bytes] = None):
+        '''
+        :param body: The body of a streamed response, which can't be read from it again.
+        '''
+        if response.status_code != 200:
+            return
+
+        body = body if body is not None else response.content
+        # Only the headers that matter for decoding are kept
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() in ('content-type',)
+        }
+        self._insert(self._key(request), response.status_code, json.dumps(headers), body, ttl)
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+    @retryOnLock
+    def _select(self, key: str) -> Optional[tuple[int, str, bytes]]:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT status, headers, body FROM responses WHERE key = ? AND expires_at > ?',
+                (key, now),
+            ).fetchone()
+            if row is not None:
+                self._connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (now, key))
+        return row
+
+
+    @retryOnLock
+    def _insert(self, key: str, status: int, headers: str, body: bytes, ttl: float):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO responses (key, status, headers, body, expires_at, accessed_at, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, status, headers, body, now + ttl, now, len(body)),
+            )
+            self._evict()
+
+
+    def _evict(self):
+        # Other processes may have added entries too, so the total is taken from the database
+        totalBytes = self._totalBytes()
+        if totalBytes <= self.maxBytes:
+            return
+
+        # Drop expired entries first, then the least recently used ones
+        self._connection.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+        totalBytes = self._totalBytes()
+        rows = self._connection.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall()
+        toDelete = []
+        for key, size in rows:
+            if totalBytes <= self.maxBytes * 0.9:
+                break
+            toDelete.append((key,))
+            totalBytes -= size
+        self._connection.executemany('DELETE FROM responses WHERE key = ?', toDelete)
+
+
+    def _totalBytes(self) -> int:
+        return self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+
+    @staticmethod
+    def _key(request: PreparedRequest) -> str:
+        url = urlsplit(request.url)
+        query = urlencode(sorted(parse_qsl(url.query, keep_blank_values=True)))
+        normalizedUrl = urlunsplit((url.scheme, url.netloc.lower(), url.path, query, ''))
+        return f'{request.method} {normalizedUrl}'
+
+
+def cacheParsedResponse(response: Response):
+    '''
+    Stores a response in the cache of the session that sent it, once the client parsed
+    it successfully, so that a truncated or invalid body isn't served for the whole TTL.
+    Does nothing for responses that aren't cached or that came from the cache.
+    '''
+    store = getattr(response, 'storeInCache', None)
+    if store is not None:
+        response.storeInCache = None
+        store()
@@ -0,0 +1,234 @@
+from requests import ConnectionError, PreparedRequest, Response, Session, Timeout
+from requests.adapters import BaseAdapter, DEFAULT_POOLSIZE, HTTPAdapter
+from typing import Optional
+from urllib.parse import urlparse
+from urllib3.util import Retry
+import json
+import random
+import time
+
+from ._metrics import endpointName, Metrics
+from ._rate_limiter import bucketName, DEPICTOR_WRITE_ENDPOINTS, RateLimiter
+from ._response_cache import ResponseCache
+
+
+# Requests to these endpoints change the state of Depictor, so they are never repeated
+# after a transient failure, as they might have reached the server. Everything else is a read.
+NON_IDEMPOTENT_ENDPOINTS = DEPICTOR_WRITE_ENDPOINTS
+TRANSIENT_STATUS_CODES = (500, 502, 503, 504)
+
+
+class RateLimitedSession(Session):
+    '''
+    A requests session that sends every request through a RateLimiter
+    and repeats requests rejected with HTTP 429. Reads failed with a connection
+    error or HTTP 5xx are repeated after a jittered exponential backoff.
+    Optionally, responses to read-only requests are served from a ResponseCache
+    (and stored in it when the client calls cacheParsedResponse), and statistics of all requests are collected in Metrics.
+    '''
+
+    def __init__(
+            self,
+            rateLimiter: RateLimiter,
+            maxRetries: int = 5,
+            responseCache: Optional[ResponseCache] = None,
+            metrics: Optional[Metrics] = None,
+            maxTransientRetries: int = 3,
+            backoffBase: float = 1.0
+        ):
+        super().__init__()
+        self.rateLimiter = rateLimiter
+        self.maxRetries = maxRetries
+        self.responseCache = responseCache
+        self.metrics = metrics
+        self.maxTransientRetries = maxTransientRetries
+        self.backoffBase = backoffBase
+
+
+    def mountPools(self, poolSizes: dict[str, int], baseUrls: Optional[dict[str, str]] = None):
+        '''
+        Gives each host its own connection pool, large enough to keep a connection
+        for every request that can be in flight to the host, so that they are reused
+        instead of being opened (with a TLS handshake) and discarded.
+
+        :param poolSizes: The number of connections kept for each host.
+        :param baseUrls: Hosts whose requests are sent to another base URL, see RedirectingAdapter.
+        '''
+        baseUrls = baseUrls or {}
+        for host in { *poolSizes, *baseUrls }:
+            poolSize = max(poolSizes.get(host, DEFAULT_POOLSIZE), 1)
+            # Connecting is always safe to repeat, as nothing has been sent yet
+            retries = Retry(total=None, connect=2, read=0, status=0, other=0, redirect=5, backoff_factor=0.2, backoff_jitter=0.2)
+            if host in baseUrls:
+                adapter = RedirectingAdapter(baseUrls[host], pool_connections=1, pool_maxsize=poolSize, max_retries=retries)
+            else:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=poolSize, max_retries=retries)
+            self.mount(f'https://{host}/', adapter)
+
+
+    def getConnectionStats(self) -> dict[str, tuple[int, int]]:
+        '''Returns the number of connections opened and requests sent over them, for each mounted host.'''
+        stats = {}
+        for prefix, adapter in self.adapters.items():
+            host = urlparse(prefix).hostname
+            if host is not None:
+                stats[host] = _countConnections(adapter)
+        return stats
+
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        endpoint = _endpointOf(request)
+        ttl = self.responseCache.getTtl(request) if self.responseCache is not None else None
+        if ttl is not None:
+            cachedResponse = self.responseCache.get(request)
+            if cachedResponse is not None:
+                if self.metrics is not None:
+                    self.metrics.recordCached(endpoint)
+                return cachedResponse
+
+        host = urlparse(request.url).hostname or ''
+        bucket = bucketName(host, endpoint)
+        idempotent = endpoint not in NON_IDEMPOTENT_ENDPOINTS
+        attempt = 0
+        transientAttempt = 0
+        while True:
+            delay = self.rateLimiter.reserve(bucket)
+            if delay > 0:
+                time.sleep(delay)
+                if self.metrics is not None:
+                    self.metrics.recordRateLimitSleep(bucket, delay)
+
+            start = time.monotonic()
+            try:
+                response = super().send(request, **kwargs)
+            except (ConnectionError, Timeout):
+                if self.metrics is not None:
+                    self.metrics.recordRequest(endpoint, None, time.monotonic() - start, _bodySize(request), 0)
+                if not idempotent or transientAttempt >= self.maxTransientRetries:
+                    raise
+                self._backOff(endpoint, transientAttempt)
+                transientAttempt += 1
+                continue
+            except Exception:
+                if self.metrics is not None:
+                    self.metrics.recordRequest(endpoint, None, time.monotonic() - start, _bodySize(request), 0)
+                raise
+            latency = time.monotonic() - start
+            self.rateLimiter.report(bucket, response.status_code, latency, response.headers.get('Retry-After'))
+            if self.metrics is not None:
+                # Reading the body of a streamed response here would defeat streaming
+                received = int(response.headers.get('Content-Length', 0)) if kwargs.get('stream') else len(response.content)
+                self.metrics.recordRequest(endpoint, response.status_code, latency, _bodySize(request), received)
+                self.metrics.recordConnections(host, *_countConnections(self.get_adapter(request.url)))
+
+            if response.status_code == 429 and attempt < self.maxRetries:
+                response.close()
+                attempt += 1
+                if self.metrics is not None:
+                    self.metrics.recordRetry(endpoint)
+                continue
+            if response.status_code in TRANSIENT_STATUS_CODES and idempotent and transientAttempt < self.maxTransientRetries:
+                response.close()
+                self._backOff(endpoint, transientAttempt)
+                transientAttempt += 1
+                continue
+            break
+
+        if ttl is not None and response.status_code == 200:
+            # Stored only after the client parsed the body, see cacheParsedResponse
+            if kwargs.get('stream'):
+                # Reading the body here would defeat streaming, so a copy is kept while the client reads it
+                recorder = _RecordingStream(response.raw, self.responseCache.maxBytes)
+                response.raw = recorder
+                response.storeInCache = lambda: recorder.complete and self.responseCache.put(request, response, ttl, recorder.body())
+            else:
+                response.storeInCache = lambda: self.responseCache.put(request, response, ttl)
+        return response
+
+
+    def _backOff(self, endpoint: str, attempt: int):
+        # Full jitter keeps concurrent workers from retrying in lockstep
+        time.sleep(random.uniform(0, min(self.backoffBase * 2 ** attempt, 30)))
+        if self.metrics is not None:
+            self.metrics.recordRetry(endpoint)
+
+
+def _endpointOf(request: PreparedRequest) -> str:
+    jsonBody = None
+    if request.body and 'json' in request.headers.get('Content-Type', ''):
+        try:
+            jsonBody = json.loads(request.body)
+        except ValueError:
+            pass
+    return endpointName(request.url, jsonBody if isinstance(jsonBody, dict) else None)
+
+
+def _bodySize(request: PreparedRequest) -> int:
+    return len(request.body) if request.body else 0
+
+
+def _countConnections(adapter: BaseAdapter) -> tuple[int, int]:
+    if not isinstance(adapter, HTTPAdapter):
+        return (0, 0)
+    pools = adapter.poolmanager.pools
+    opened, requests = 0, 0
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is not None:
+            opened += pool.num_connections
+            requests += pool.num_requests
+    return (opened, requests)
+
+
+class _RecordingStream:
+    '''
+    Wraps the raw stream of a response and keeps a copy of the decoded chunks
+    read through it, so that a streamed response can be cached after it was read.
+    Bodies larger than `maxBytes` can't be cached anyway, so they are not kept.
+    '''
+
+    def __init__(self, raw, maxBytes: int):
+        self._raw = raw
+        self.maxBytes = maxBytes
+        self.complete = False
+        self._chunks: Optional[list[bytes]] = []
+        self._size = 0
+
+
+    def stream(self, amt: Optional[int] = None, decode_content: Optional[bool] = None):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            if self._chunks is not None:
+                self._size += len(chunk)
+                if self._size > self.maxBytes:
+                    self._chunks = None
+                else:
+                    self._chunks.append(chunk)
+            yield chunk
+        self.complete = self._chunks is not None
+
+
+    def body(self) -> bytes:
+        return b''.join(self._chunks or ())
+
+
+    def __getattr__(self, name: str):
+        return getattr(self._raw, name)
+
+
+class RedirectingAdapter(HTTPAdapter):
+    '''
+    A transport adapter sending requests to another base URL, e.g. a local mock
+    of the API. It works below the session, so rate limiting and caching still
+    see the original host.
+    '''
+
+    def __init__(self, baseUrl: str, **kwargs):
+        super().__init__(**kwargs)
+        self.baseUrl = baseUrl.rstrip('/')
+
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        url = urlparse(request.url)
+        request = request.copy()
+        request.url = self.baseUrl + url.path + ('?' + url.query if url.query else '')
+        return super().send(request, **kwargs)
@@ -0,0 +1,41 @@
+from functools import wraps
+from typing import Callable, TypeVar
+import random
+import sqlite3
+import time
+
+
+T = TypeVar('T')
+
+# How long a statement waits for a lock held by another connection, e.g. of another shard process
+BUSY_TIMEOUT_SECONDS = 30
+
+
+def connect(path: str) -> sqlite3.Connection:
+    '''Opens a database that other processes may be using at the same time.'''
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_SECONDS, check_same_thread=False)
+    connection.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_SECONDS * 1000}')
+    return connection
+
+
+def isLockError(error: sqlite3.OperationalError) -> bool:
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def retryOnLock(method: Callable[..., T], maxAttempts: int = 5) -> Callable[..., T]:
+    '''
+    Retries the decorated method when the database is locked. The busy timeout doesn't
+    cover every case: a transaction that read before it writes fails right away if
+    another connection wrote in the meantime, and then it has to be started again.
+    '''
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        for attempt in range(maxAttempts):
+            try:
+                return method(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not isLockError(e) or attempt == maxAttempts - 1:
+                    raise
+            time.sleep(random.uniform(0.05, 0.1) * 2 ** attempt)
+    return wrapper
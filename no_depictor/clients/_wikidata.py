@@ -1,16 +1,60 @@
 from ..data import CategoryDescriptor
+from ._response_cache import cacheParsedResponse
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
+from typing import Callable, Iterable, Optional
 
 class WikidataAPI:
 
-    def __init__(self, session: Session = Session()):
-        self.httpSession = session
+    def __init__(self, session: Optional[Session] = None):
+        self.httpSession = session if session is not None else Session()
 
-    
-    def hasImageClaim(self, qId: str, repeatable=True) -> bool:
+
+    def getItemsWithImageClaim(
+            self,
+            qIds: Iterable[str],
+            batchSize: int = 50,
+            maxWorkers: int = 4,
+            onError: Optional[Callable[[list[str], Exception], None]] = None
+        ) -> set[str]:
+        '''
+        Checks many items for P18 at once, using multi-ID wbgetentities requests.
+        Batches are sent concurrently.
+
+        :param qIds: The QIDs to check.
+        :param batchSize: How many IDs to send in a single request (API limit is 50).
+        :param maxWorkers: How many requests can be in flight at the same time.
+        :param onError: Called with the QIDs of a batch that couldn't be checked and the error,
+            while the other batches are still checked. Without it, the first error is raised.
+        :return: A set of those QIDs that have an image claim.
+        '''
+        uniqueIds = list(dict.fromkeys(qIds))
+        batches = [uniqueIds[i:i + batchSize] for i in range(0, len(uniqueIds), batchSize)]
+        if not batches:
+            return set()
+
+        def getBatch(batch: list[str]) -> set[str]:
+            try:
+                return self._getItemsWithImageClaimBatch(batch)
+            except Exception as e:
+                if onError is None:
+                    raise
+                onError(batch, e)
+                return set()
+
+        withImage = set()
+        with ThreadPoolExecutor(max_workers=min(maxWorkers, len(batches))) as executor:
+            for batchResult in executor.map(getBatch, batches):
+                withImage.update(batchResult)
+        return withImage
+
+
+    def _getItemsWithImageClaimBatch(self, qIds: list[str]) -> set[str]:
+        # wbgetentities cannot filter claims by property, so at least
+        # skip labels, descriptions and sitelinks to keep responses small
         requestParams = {
             'action': 'wbgetentities',
-            'ids': qId,
+            'ids': '|'.join(qIds),
             'props': 'claims',
             'format': 'json',
         }
@@ -20,14 +64,6 @@ class WikidataAPI:
             params=requestParams,
             timeout=60,
         )
-        if rawResponse.status_code == 429 and repeatable:
-            # Too many requests - wait and try again
-            delay = int(rawResponse.headers.get('Retry-After', '5'))
-            print(f'Wikidata API rate limit exceeded. Retrying after {delay} seconds...')
-            import time
-            time.sleep(delay)
-            return self.hasImageClaim(qId, repeatable=False)
-
         try:
             response = rawResponse.json()
         except Exception as e:
@@ -36,13 +72,18 @@ class WikidataAPI:
                 str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
             ) from e
 
-        itemData = response.get('entities', {}).get(qId, {})
-        claims = itemData.get('claims', {})
+        if 'error' in response:
+            raise Exception(f'Wikidata API returned an error: {response["error"]}')
+        cacheParsedResponse(rawResponse)
 
-        return 'P18' in claims
+        entities = response.get('entities', {})
+        return {
+            qId for qId in qIds
+            if 'P18' in entities.get(qId, {}).get('claims', {})
+        }
     
 
-    def getItemForCommonsCategory(self, categoryName: str, repeatable=True) -> CategoryDescriptor:
+    def getItemForCommonsCategory(self, categoryName: str) -> CategoryDescriptor:
         sparql = f'''
             select ?item ?image ?cat where {{
               ?item wdt:P18 ?image;
@@ -61,14 +102,6 @@ class WikidataAPI:
             params=requestParams,
             timeout=60,
         )
-        if rawResponse.status_code == 429 and repeatable:
-            # Too many requests - wait and try again
-            delay = int(rawResponse.headers.get('Retry-After', '5'))
-            print(f'Wikidata API rate limit exceeded. Retrying after {delay} seconds...')
-            import time
-            time.sleep(delay)
-            return self.getItemForCommonsCategory(categoryName, repeatable=False)
-        
         try:
             response = rawResponse.json()
         except Exception as e:
@@ -79,6 +112,7 @@ class WikidataAPI:
 
         if 'results' not in response or 'bindings' not in response['results']:
             raise Exception(f'Invalid response from Wikidata SPARQL: {response}')
+        cacheParsedResponse(rawResponse)
         
         bindings = response['results']['bindings']
         if not bindings:
@@ -94,3 +128,87 @@ class WikidataAPI:
             raise Exception(f'Invalid QID "{qId}" extracted from item URI "{itemUri}".')
 
         return CategoryDescriptor(qId, categoryName)
+
+
+    def getItemsForCommonsCategories(
+            self,
+            categoryNames: Iterable[str],
+            batchSize: int = 50,
+            maxWorkers: int = 2
+        ) -> tuple[dict[str, CategoryDescriptor], list[str]]:
+        '''
+        Resolves many Commons categories to Wikidata items (having an image) at once,
+        using SPARQL queries with a VALUES clause.
+
+        :param categoryNames: Names of the categories, without namespace.
+        :param batchSize: How many categories to resolve in a single query.
+        :param maxWorkers: How many queries can be in flight at the same time.
+        :return: A mapping of category names to descriptors and a list of names that couldn't be resolved.
+        '''
+        uniqueNames = list(dict.fromkeys(categoryNames))
+        batches = [uniqueNames[i:i + batchSize] for i in range(0, len(uniqueNames), batchSize)]
+
+        resolved = {}
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(maxWorkers, len(batches))) as executor:
+                for batchResult in executor.map(self._getItemsForCommonsCategoriesBatch, batches):
+                    resolved.update(batchResult)
+
+        unresolved = [name for name in uniqueNames if name not in resolved]
+        return resolved, unresolved
+
+
+    def _getItemsForCommonsCategoriesBatch(self, categoryNames: list[str]) -> dict[str, CategoryDescriptor]:
+        values = ' '.join(sparqlString(name) for name in categoryNames)
+        sparql = f'''
+            select ?item ?cat where {{
+              values ?cat {{ {values} }}
+              ?item wdt:P18 ?image;
+                    wdt:P373 ?cat.
+            }}
+        '''
+
+        requestParams = {
+            'format': 'json',
+            'query': sparql,
+        }
+
+        rawResponse = self.httpSession.get(
+            'https://query.wikidata.org/sparql',
+            params=requestParams,
+            timeout=60,
+        )
+        try:
+            response = rawResponse.json()
+        except Exception as e:
+            raise Exception(
+                'Wikidata Query API responded with invalid JSON (response code: ' +
+                str(rawResponse.status_code) + '). Beginning of the response: ' + rawResponse.text[:200]
+            ) from e
+
+        if 'results' not in response or 'bindings' not in response['results']:
+            raise Exception(f'Invalid response from Wikidata SPARQL: {response}')
+        cacheParsedResponse(rawResponse)
+
+        return parseCategoryBindings(response['results']['bindings'])
+
+
+def sparqlString(value: str) -> str:
+    '''Formats a string as a SPARQL literal.'''
+    escaped = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r')
+    return f'"{escaped}"'
+
+
+def parseCategoryBindings(bindings: list[dict]) -> dict[str, CategoryDescriptor]:
+    '''Maps category names to descriptors, based on ?item and ?cat bindings. The first item for a category wins.'''
+    resolved = {}
+    for binding in bindings:
+        categoryName = binding.get('cat', {}).get('value')
+        itemUri = binding.get('item', {}).get('value')
+        if not categoryName or not itemUri or categoryName in resolved:
+            continue
+
+        qId = itemUri.split('/')[-1]  # Extract the QID from the URI
+        if qId.startswith('Q'):
+            resolved[categoryName] = CategoryDescriptor(qId, categoryName)
+    return resolved
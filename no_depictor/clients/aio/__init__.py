@@ -0,0 +1,7 @@
+# Asyncio counterparts of the clients, built on aiohttp.
+# They expose the same methods as the blocking clients, but as coroutines.
+from ._commons import CommonsAPI
+from ._depictor import Depictor
+from ._petscan import PetScan
+from ._rate_limiting import rateLimitingMiddleware
+from ._wikidata import WikidataAPI
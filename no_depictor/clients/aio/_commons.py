@@ -0,0 +1,156 @@
+from aiohttp import ClientSession, ClientTimeout
+from collections import deque
+from typing import AsyncIterator
+from ...data import CategoryDescriptor, FileCollection
+from .._commons import MAX_SEARCH_RESULTS, parseSearchResults, SEARCH_PAGE_SIZE
+import asyncio
+import json
+
+
+class CommonsAPI:
+
+    def __init__(self, session: ClientSession):
+        self.httpSession = session
+
+
+    async def getFilesNotDepictingSubject(
+            self,
+            categoryName: str,
+            qId: str,
+            wholeCategory: bool = False,
+            prefetchPages: int = 2
+        ) -> FileCollection:
+        requestParams = {
+            'action': 'query',
+            'list': 'search',
+            'srlimit': SEARCH_PAGE_SIZE,
+            'srnamespace': 6,  # Namespace for files
+            'srsearch': f'-haswbstatement:P180={qId} incategory:"{categoryName}" filetype:bitmap',
+            'format': 'json',
+            'formatversion': 2,
+        }
+
+        response = await self._search(requestParams, 0)
+        files = parseSearchResults(response)
+        # See the blocking client for why we normally stop after the first page
+        if not wholeCategory or 'continue' not in response:
+            return files
+
+        totalHits = response.get('query', {}).get('searchinfo', {}).get('totalhits', MAX_SEARCH_RESULTS)
+        offsets = iter(range(SEARCH_PAGE_SIZE, min(totalHits, MAX_SEARCH_RESULTS), SEARCH_PAGE_SIZE))
+        pending: deque[asyncio.Task] = deque()
+
+        def fillQueue():
+            while len(pending) < max(prefetchPages, 1):
+                offset = next(offsets, None)
+                if offset is None:
+                    return
+                pending.append(asyncio.create_task(self._search(requestParams, offset)))
+
+        try:
+            fillQueue()
+            while pending:
+                response = await pending.popleft()
+                fillQueue()
+                files.extend(parseSearchResults(response))
+                if 'continue' not in response:
+                    break
+        finally:
+            for task in pending:
+                task.cancel()
+        return files
+
+
+    async def _search(self, requestParams: dict, offset: int) -> dict:
+        async with self.httpSession.get(
+            'https://commons.wikimedia.org/w/api.php',
+            params={ **requestParams, 'sroffset': offset } if offset else requestParams,
+            timeout=ClientTimeout(total=60),
+        ) as rawResponse:
+            responseText = await rawResponse.text()
+            try:
+                response = json.loads(responseText)
+            except Exception as e:
+                raise Exception(
+                    'Wikimedia Commons API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                ) from e
+
+        if 'error' in response:
+            raise Exception(f'Wikimedia Commons API returned an error: {response["error"]}')
+        return response
+
+
+    async def iterSubcategoryTree(self, categoryName: str, depth: int = 1, maxWorkers: int = 8) -> AsyncIterator[CategoryDescriptor]:
+        rootTitle = categoryName.replace('_', ' ')
+        visited = { rootTitle }
+        frontier = [rootTitle]
+        semaphore = asyncio.Semaphore(maxWorkers)
+
+        async def expand(title: str) -> list[tuple[str, str | None]]:
+            async with semaphore:
+                return await self._getSubcategoriesWithItems(title)
+
+        for level in range(depth + 1):
+            nextFrontier = []
+            for subcategories in await asyncio.gather(*(expand(title) for title in frontier)):
+                for title, qId in subcategories:
+                    if title in visited:
+                        continue
+                    visited.add(title)
+                    nextFrontier.append(title)
+                    if qId is not None:
+                        # PetScan returns titles with underscores, so follow it
+                        yield CategoryDescriptor(qId, title.replace(' ', '_'))
+            frontier = nextFrontier
+            if not frontier:
+                break
+
+
+    async def _getSubcategoriesWithItems(self, categoryTitle: str) -> list[tuple[str, str | None]]:
+        requestParams = {
+            'action': 'query',
+            'generator': 'categorymembers',
+            'gcmtitle': 'Category:' + categoryTitle,
+            'gcmtype': 'subcat',
+            'gcmlimit': 'max',
+            'prop': 'pageprops',
+            'ppprop': 'wikibase_item',
+            'format': 'json',
+            'formatversion': 2,
+        }
+
+        subcategories = {}
+        while True:
+            async with self.httpSession.get(
+                'https://commons.wikimedia.org/w/api.php',
+                params=requestParams,
+                timeout=ClientTimeout(total=60),
+            ) as rawResponse:
+                responseText = await rawResponse.text()
+                try:
+                    response = json.loads(responseText)
+                except Exception as e:
+                    raise Exception(
+                        'Wikimedia Commons API responded with invalid JSON (response code: ' +
+                        str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                    ) from e
+
+            if 'error' in response:
+                raise Exception(f'Wikimedia Commons API returned an error: {response["error"]}')
+
+            for page in response.get('query', {}).get('pages', []):
+                title = page.get('title', '')
+                if not title.startswith('Category:'):
+                    continue
+                title = title[len('Category:'):]
+                qId = page.get('pageprops', {}).get('wikibase_item')
+                # With continuation, pageprops of a page may come in a later response
+                if qId is not None or title not in subcategories:
+                    subcategories[title] = qId
+
+            if 'continue' not in response:
+                break
+            requestParams.update(response['continue'])
+
+        return list(subcategories.items())
@@ -0,0 +1,259 @@
+from aiohttp import ClientSession, ClientTimeout
+from collections import deque
+import asyncio
+from typing import AsyncIterator, Callable, Iterable, Optional, Sequence
+from yarl import URL
+from ...data import CategoryDescriptor, FileCollection
+from .._depictor import ignoringStoreErrors
+from .._done_store import DoneStore
+import json
+import urllib.parse
+
+
+class Depictor:
+    '''
+    The asyncio counterpart of clients.Depictor. The DoneStore is SQLite, which
+    blocks, so it is used on a worker thread to keep the event loop running.
+    '''
+
+    def __init__(
+            self,
+            userName: str,
+            phpSessionId: str,
+            session: ClientSession,
+            doneStore: Optional[DoneStore] = None,
+            chunkSize: int = 500,
+            maxWorkers: int = 4,
+            maxAttempts: int = 3,
+            maxWritesInFlight: int = 4
+        ):
+        self.userName = userName
+        self.phpSessionId = phpSessionId
+        self.httpSession = session
+        self.doneStore = doneStore
+        # Lookups of many IDs are split into chunks of that size, sent concurrently
+        self.chunkSize = chunkSize
+        self.maxWorkers = maxWorkers
+        self.maxAttempts = maxAttempts
+        # Files are marked concurrently, while the session keeps the rate of requests
+        self.maxWritesInFlight = maxWritesInFlight
+
+
+    async def getUndoneCategories(self, categories: list[CategoryDescriptor]) -> list[CategoryDescriptor]:
+        if self.doneStore is not None:
+            knownDone = await asyncio.to_thread(self.doneStore.getDoneItems, [cat.qId for cat in categories])
+            categories = [cat for cat in categories if cat.qId not in knownDone]
+            if not categories:
+                return []
+
+        doneDictionary = await self._postChunked('items-done', 'qids', [cat.qId for cat in categories])
+        await self._rememberDoneItems([cat.qId for cat in categories if doneDictionary.get(cat.qId, False)])
+
+        return [
+            cat for cat in categories
+            if not doneDictionary.get(cat.qId, False)
+        ]
+
+
+    async def getUndoneFiles(self, files: FileCollection) -> FileCollection:
+        if self.doneStore is not None:
+            files = files.without(await asyncio.to_thread(self.doneStore.getDoneFiles, files.mIds))
+            if not files:
+                return FileCollection()
+
+        mIds = files.mIds
+        doneMids = await self._postChunked('files-exists', 'mids', mIds)
+        done = { mId for mId in mIds if doneMids.get(mId, False) }
+        await self._rememberDoneFiles(done)
+
+        return files.without(done)
+
+
+    async def markFileAsNotDepictingSubject(self, mId: str, category: CategoryDescriptor) -> None:
+        requestParams = {
+            'mid': mId,
+            'qid': category.qId,
+            'user': self.userName,
+            'status': 'not-depicted',
+            'action': 'add-file',
+        }
+        # Depictor client uses %20 for spaces, so the whole query is encoded manually
+        # and aiohttp is told not to re-encode the URL.
+        query = urllib.parse.urlencode(
+            { 'category': category.title, **requestParams },
+            quote_via=urllib.parse.quote,
+        )
+
+        async with self.httpSession.get(
+            URL('https://hay.toolforge.org/depictor/api/index.php?' + query, encoded=True),
+            headers=self._cookieHeaders(),
+            timeout=ClientTimeout(total=60),
+        ) as rawResponse:
+            responseText = await rawResponse.text()
+            try:
+                response = json.loads(responseText)
+            except Exception as e:
+                raise Exception(
+                    'Depictor API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                ) from e
+
+            success = rawResponse.status == 200 and response.get('ok') == 'Added'
+            if not success:
+                raise Exception(
+                    f'Failed to mark file {mId} as not depicting {category.qId} in category {category.title}: {responseText}'
+                )
+        await self._rememberDoneFiles([mId])
+
+
+    async def markFilesAsNotDepictingSubject(
+            self,
+            mIds: Sequence[str],
+            category: CategoryDescriptor,
+            isInterrupted: Callable[[], bool] = lambda: False
+        ) -> AsyncIterator[tuple[str, Optional[Exception]]]:
+        '''
+        Marks the files, keeping up to `maxWritesInFlight` requests in flight, and yields
+        (MID, None) for every file confirmed, in order. Files that failed are checked in
+        Depictor, as the request may have been applied anyway, and the others are sent
+        again, up to `maxAttempts` times in total. At the end, (MID, error) is yielded
+        for every file that still failed. After an interrupt, no new requests are sent,
+        but those in flight are waited for.
+        '''
+        pending = list(mIds)
+        errors: dict[str, Exception] = {}
+        for attempt in range(self.maxAttempts):
+            if attempt > 0:
+                try:
+                    doneMids = await self._postChunked('files-exists', 'mids', pending)
+                except Exception:
+                    break
+                confirmed = [mId for mId in pending if doneMids.get(mId, False)]
+                await self._rememberDoneFiles(confirmed)
+                for mId in confirmed:
+                    yield mId, None
+                pending = [mId for mId in pending if not doneMids.get(mId, False)]
+
+            failed = []
+            inFlight: deque[tuple[str, asyncio.Task]] = deque()
+            mIdIterator = iter(pending)
+            try:
+                while True:
+                    while len(inFlight) < self.maxWritesInFlight and not isInterrupted():
+                        mId = next(mIdIterator, None)
+                        if mId is None:
+                            break
+                        inFlight.append((mId, asyncio.create_task(self.markFileAsNotDepictingSubject(mId, category))))
+                    if not inFlight:
+                        break
+                    mId, task = inFlight.popleft()
+                    try:
+                        await task
+                        yield mId, None
+                    except Exception as e:
+                        failed.append(mId)
+                        errors[mId] = e
+            finally:
+                # Writes already sent are let finish, even if the caller stops early
+                await asyncio.gather(*(task for _, task in inFlight), return_exceptions=True)
+
+            pending = failed
+            if not pending or isInterrupted():
+                break
+
+        for mId in pending:
+            yield mId, errors[mId]
+
+
+    async def markCategoryAsDone(self, qId: str) -> None:
+        requestParams = {
+            'action': 'item-done',
+            'qid': qId,
+            'user': self.userName,
+        }
+
+        async with self.httpSession.post(
+            'https://hay.toolforge.org/depictor/api/index.php',
+            json=requestParams,
+            headers=self._cookieHeaders(),
+            timeout=ClientTimeout(total=60),
+        ) as rawResponse:
+            responseText = await rawResponse.text()
+            try:
+                response = json.loads(responseText)
+            except Exception as e:
+                raise Exception(
+                    'Depictor API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                ) from e
+
+            success = rawResponse.status == 200 and response.get('ok') == 'Added'
+            if not success:
+                raise Exception(
+                    f'Failed to mark category of {qId} as done: {responseText}'
+                )
+        await self._rememberDoneItems([qId])
+
+
+    async def _rememberDoneItems(self, qIds: list[str]):
+        if self.doneStore is not None:
+            await asyncio.to_thread(ignoringStoreErrors, self.doneStore.addDoneItems, qIds)
+
+
+    async def _rememberDoneFiles(self, mIds: Iterable[str]):
+        if self.doneStore is not None:
+            await asyncio.to_thread(ignoringStoreErrors, self.doneStore.addDoneFiles, list(mIds))
+
+
+    async def _postChunked(self, action: str, idsKey: str, ids: list[str]) -> dict:
+        '''
+        Sends a lookup of many IDs in chunks, concurrently, and merges the results.
+        Chunks that failed are retried, up to `maxAttempts` times in total.
+        '''
+        chunks = [ids[i:i + self.chunkSize] for i in range(0, len(ids), self.chunkSize)]
+        semaphore = asyncio.Semaphore(self.maxWorkers)
+
+        async def postChunk(chunk: list[str]) -> dict:
+            async with semaphore:
+                return await self._post({ 'action': action, idsKey: chunk })
+
+        result = {}
+        for _ in range(self.maxAttempts):
+            if not chunks:
+                break
+
+            failedChunks = []
+            responses = await asyncio.gather(*(postChunk(chunk) for chunk in chunks), return_exceptions=True)
+            for chunk, response in zip(chunks, responses):
+                if isinstance(response, Exception):
+                    failedChunks.append(chunk)
+                    lastError = response
+                else:
+                    result.update(response)
+            chunks = failedChunks
+
+        if chunks:
+            raise lastError
+        return result
+
+
+    async def _post(self, requestParams: dict) -> dict:
+        async with self.httpSession.post(
+            'https://hay.toolforge.org/depictor/api/index.php',
+            json=requestParams,
+            headers=self._cookieHeaders(),
+            timeout=ClientTimeout(total=60),
+        ) as rawResponse:
+            responseText = await rawResponse.text()
+            try:
+                return json.loads(responseText)
+            except Exception as e:
+                raise Exception(
+                    'Depictor API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                ) from e
+
+
+    def _cookieHeaders(self) -> dict:
+        # Cookies are sent as a header, so they don't leak into the shared session's cookie jar
+        return { 'Cookie': f'PHPSESSID={self.phpSessionId}' }
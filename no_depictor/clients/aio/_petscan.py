@@ -0,0 +1,143 @@
+from aiohttp import ClientSession, ClientTimeout
+from typing import AsyncIterator, Optional
+from ...data import CategoryDescriptor
+from .._json_stream import JsonArrayParser
+import asyncio
+import codecs
+
+
+class PetScan:
+
+    def __init__(self, session: ClientSession, maxWorkers: int = 4):
+        self.httpSession = session
+        # Split queries are sent concurrently, while the middleware keeps the rate of requests
+        self.maxWorkers = maxWorkers
+
+
+    async def getSubcategories(self, categoryName: str, depth: int = 1) -> list[CategoryDescriptor]:
+        return [category async for category in self.iterSubcategories(categoryName, depth)]
+
+
+    async def iterSubcategories(self, categoryName: str, depth: int = 1) -> AsyncIterator[CategoryDescriptor]:
+        '''
+        Streams subcategories of the category, parsing the response incrementally,
+        so that the first ones can be processed before the whole response is downloaded.
+
+        Queries of large trees may time out or be cut short. Then the query is split:
+        the direct subcategories are fetched, and each of them is queried one level
+        less deep, concurrently, splitting further where needed. Categories found
+        by several queries are yielded only once.
+        '''
+        categoryName = categoryName.replace('_', ' ')
+        seen: set[str] = set()
+        try:
+            async for item in self._iterItems(categoryName, depth, 'with'):
+                if 'q' in item:
+                    seen.add(item['title'])
+                    yield CategoryDescriptor(item['q'], item['title'])
+            return
+        except Exception:
+            if depth == 0:
+                raise
+        async for category in self._iterSplitQuery(categoryName, depth, seen):
+            yield category
+
+
+    async def _iterSplitQuery(self, categoryName: str, depth: int, seen: set[str]) -> AsyncIterator[CategoryDescriptor]:
+        semaphore = asyncio.Semaphore(self.maxWorkers)
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        # Categories whose query failed at the current depth; the tree is split level by level
+        failed = [categoryName]
+        queried = { categoryName }
+        while failed:
+            subcategoryNames = []
+            for subcategories in await asyncio.gather(*(limited(self._getDirectSubcategories(name)) for name in failed)):
+                for title, qId in subcategories:
+                    if qId and title not in seen:
+                        seen.add(title)
+                        yield CategoryDescriptor(qId, title)
+                    name = title.replace('_', ' ')
+                    # Breadth-first, a category is first reached with the most levels left below it
+                    if name not in queried:
+                        queried.add(name)
+                        subcategoryNames.append(name)
+
+            depth -= 1
+            failed = []
+            for name, categories in zip(subcategoryNames, await asyncio.gather(*(limited(self._tryQuery(name, depth)) for name in subcategoryNames))):
+                if categories is None:
+                    failed.append(name)
+                    continue
+                for category in categories:
+                    if category.title not in seen:
+                        seen.add(category.title)
+                        yield category
+
+
+    async def _tryQuery(self, categoryName: str, depth: int) -> Optional[list[CategoryDescriptor]]:
+        '''Returns the subcategories, or None if the query failed and can be split further.'''
+        try:
+            return await self._query(categoryName, depth)
+        except Exception:
+            if depth == 0:
+                raise
+            return None
+
+
+    async def _getDirectSubcategories(self, categoryName: str) -> list[tuple[str, Optional[str]]]:
+        '''Returns titles of direct subcategories, with their Wikidata items, if any.'''
+        return [
+            (item['title'], item.get('q') or None)
+            async for item in self._iterItems(categoryName, 0, 'any')
+        ]
+
+
+    async def _query(self, categoryName: str, depth: int) -> list[CategoryDescriptor]:
+        return [
+            CategoryDescriptor(item['q'], item['title'])
+            async for item in self._iterItems(categoryName, depth, 'with')
+            if 'q' in item
+        ]
+
+
+    async def _iterItems(self, categoryName: str, depth: int, wikidataItem: str) -> AsyncIterator[dict]:
+        requestParams = {
+            'categories': categoryName,
+            'depth': depth,
+            'wikidata_item': wikidataItem,
+            'project': 'wikimedia',
+            'language': 'commons',
+            'format': 'json',
+            'ns[14]': 1,  # Namespace for categories
+            'search_max_results': 500, # Seems to be ignored by PetScan...
+            'doit': 1
+        }
+
+        async with self.httpSession.get(
+            'https://petscan.wmcloud.org/',
+            params=requestParams,
+            timeout=ClientTimeout(total=60),
+        ) as rawResponse:
+            # PetScan JSON response is far from self-explanatory,
+            # property path: response['*'][0]['a']['*']
+            parser = JsonArrayParser(('*', 0, 'a', '*'))
+            decoder = codecs.getincrementaldecoder(rawResponse.charset or 'utf-8')(errors='replace')
+            try:
+                async for chunk in rawResponse.content.iter_chunked(64 * 1024):
+                    for item in parser.feed(decoder.decode(chunk)):
+                        if isinstance(item, dict) and 'title' in item:
+                            yield item
+                    if parser.finished:
+                        return
+                for item in parser.close():
+                    if isinstance(item, dict) and 'title' in item:
+                        yield item
+            except ValueError as e: # Includes JSONDecodeError and JsonStreamError
+                raise Exception(
+                    'PetScan API responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). ' + str(e)
+                ) from e
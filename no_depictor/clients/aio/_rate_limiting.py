@@ -0,0 +1,98 @@
+from aiohttp import ClientConnectionError, ClientHandlerType, ClientRequest, ClientResponse
+from typing import Optional
+import asyncio
+import json
+import random
+import time
+
+from .._metrics import endpointName, Metrics
+from .._rate_limiter import bucketName, RateLimiter
+from .._session import NON_IDEMPOTENT_ENDPOINTS, TRANSIENT_STATUS_CODES
+
+
+def rateLimitingMiddleware(
+        rateLimiter: RateLimiter,
+        maxRetries: int = 5,
+        metrics: Optional[Metrics] = None,
+        maxTransientRetries: int = 3,
+        backoffBase: float = 1.0
+    ):
+    '''
+    Creates an aiohttp client middleware that sends every request through the RateLimiter
+    and repeats requests rejected with HTTP 429. Reads failed with a connection error
+    or HTTP 5xx are repeated after a jittered exponential backoff, like in RateLimitedSession.
+    Statistics of requests are collected in Metrics.
+    '''
+    async def backOff(endpoint: str, attempt: int):
+        await asyncio.sleep(random.uniform(0, min(backoffBase * 2 ** attempt, 30)))
+        if metrics is not None:
+            metrics.recordRetry(endpoint)
+
+    async def middleware(request: ClientRequest, handler: ClientHandlerType) -> ClientResponse:
+        endpoint = _endpointOf(request)
+        bucket = bucketName(request.url.host or '', endpoint)
+        idempotent = endpoint not in NON_IDEMPOTENT_ENDPOINTS
+        bodySize = _bodySize(request)
+        attempt = 0
+        transientAttempt = 0
+        while True:
+            delay = rateLimiter.reserve(bucket)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                if metrics is not None:
+                    metrics.recordRateLimitSleep(bucket, delay)
+
+            start = time.monotonic()
+            try:
+                response = await handler(request)
+            except (ClientConnectionError, asyncio.TimeoutError):
+                if metrics is not None:
+                    metrics.recordRequest(endpoint, None, time.monotonic() - start, bodySize, 0)
+                if not idempotent or transientAttempt >= maxTransientRetries:
+                    raise
+                await backOff(endpoint, transientAttempt)
+                transientAttempt += 1
+                continue
+            except Exception:
+                if metrics is not None:
+                    metrics.recordRequest(endpoint, None, time.monotonic() - start, bodySize, 0)
+                raise
+            latency = time.monotonic() - start
+            rateLimiter.report(bucket, response.status, latency, response.headers.get('Retry-After'))
+            if metrics is not None:
+                metrics.recordRequest(endpoint, response.status, latency, bodySize, response.content_length or 0)
+
+            if response.status == 429 and attempt < maxRetries:
+                response.release()
+                attempt += 1
+                if metrics is not None:
+                    metrics.recordRetry(endpoint)
+                continue
+            if response.status in TRANSIENT_STATUS_CODES and idempotent and transientAttempt < maxTransientRetries:
+                response.release()
+                await backOff(endpoint, transientAttempt)
+                transientAttempt += 1
+                continue
+            return response
+
+    return middleware
+
+
+def _bodySize(request: ClientRequest) -> int:
+    # Depending on the version of aiohttp, the body is a payload or plain bytes
+    body = request.body
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return body.size or 0
+
+
+def _endpointOf(request: ClientRequest) -> str:
+    jsonBody = None
+    if request.body is not None and 'json' in request.headers.get('Content-Type', ''):
+        try:
+            jsonBody = json.loads(request.body.decode())
+        except (ValueError, TypeError, AttributeError):
+            pass
+    return endpointName(str(request.url), jsonBody if isinstance(jsonBody, dict) else None)
@@ -0,0 +1,147 @@
+from aiohttp import ClientSession, ClientTimeout
+from typing import Callable, Iterable, Optional
+from ...data import CategoryDescriptor
+from .._wikidata import parseCategoryBindings, sparqlString
+import asyncio
+import json
+
+
+class WikidataAPI:
+
+    def __init__(self, session: ClientSession):
+        self.httpSession = session
+
+
+    async def getItemsWithImageClaim(
+            self,
+            qIds: Iterable[str],
+            batchSize: int = 50,
+            maxWorkers: int = 4,
+            onError: Optional[Callable[[list[str], Exception], None]] = None
+        ) -> set[str]:
+        uniqueIds = list(dict.fromkeys(qIds))
+        batches = [uniqueIds[i:i + batchSize] for i in range(0, len(uniqueIds), batchSize)]
+        semaphore = asyncio.Semaphore(maxWorkers)
+
+        async def getBatch(batch: list[str]) -> set[str]:
+            async with semaphore:
+                try:
+                    return await self._getItemsWithImageClaimBatch(batch)
+                except Exception as e:
+                    if onError is None:
+                        raise
+                    onError(batch, e)
+                    return set()
+
+        withImage = set()
+        for batchResult in await asyncio.gather(*(getBatch(batch) for batch in batches)):
+            withImage.update(batchResult)
+        return withImage
+
+
+    async def _getItemsWithImageClaimBatch(self, qIds: list[str]) -> set[str]:
+        requestParams = {
+            'action': 'wbgetentities',
+            'ids': '|'.join(qIds),
+            'props': 'claims',
+            'format': 'json',
+        }
+
+        response = await self._getJson('https://www.wikidata.org/w/api.php', requestParams, 'Wikidata API')
+
+        entities = response.get('entities', {})
+        return {
+            qId for qId in qIds
+            if 'P18' in entities.get(qId, {}).get('claims', {})
+        }
+
+
+    async def getItemForCommonsCategory(self, categoryName: str) -> CategoryDescriptor:
+        sparql = f'''
+            select ?item ?image ?cat where {{
+              ?item wdt:P18 ?image;
+                    wdt:P373 "{categoryName}";
+                    wdt:P373 ?cat.
+            }}
+        '''
+
+        requestParams = {
+            'format': 'json',
+            'query': sparql,
+        }
+
+        response = await self._getJson('https://query.wikidata.org/sparql', requestParams, 'Wikidata Query API')
+
+        if 'results' not in response or 'bindings' not in response['results']:
+            raise Exception(f'Invalid response from Wikidata SPARQL: {response}')
+
+        bindings = response['results']['bindings']
+        if not bindings:
+            raise Exception(f'No results found for category "{categoryName}" in Wikidata SPARQL query.')
+
+        binding = bindings[0]
+        itemUri = binding.get('item', {}).get('value')
+        if not itemUri:
+            raise Exception(f'No item found for category "{categoryName}" in Wikidata SPARQL query.')
+
+        qId = itemUri.split('/')[-1]  # Extract the QID from the URI
+        if not qId.startswith('Q'):
+            raise Exception(f'Invalid QID "{qId}" extracted from item URI "{itemUri}".')
+
+        return CategoryDescriptor(qId, categoryName)
+
+
+    async def getItemsForCommonsCategories(
+            self,
+            categoryNames: Iterable[str],
+            batchSize: int = 50,
+            maxWorkers: int = 2
+        ) -> tuple[dict[str, CategoryDescriptor], list[str]]:
+        uniqueNames = list(dict.fromkeys(categoryNames))
+        batches = [uniqueNames[i:i + batchSize] for i in range(0, len(uniqueNames), batchSize)]
+        semaphore = asyncio.Semaphore(maxWorkers)
+
+        async def getBatch(batch: list[str]) -> dict[str, CategoryDescriptor]:
+            async with semaphore:
+                return await self._getItemsForCommonsCategoriesBatch(batch)
+
+        resolved = {}
+        for batchResult in await asyncio.gather(*(getBatch(batch) for batch in batches)):
+            resolved.update(batchResult)
+
+        unresolved = [name for name in uniqueNames if name not in resolved]
+        return resolved, unresolved
+
+
+    async def _getItemsForCommonsCategoriesBatch(self, categoryNames: list[str]) -> dict[str, CategoryDescriptor]:
+        values = ' '.join(sparqlString(name) for name in categoryNames)
+        sparql = f'''
+            select ?item ?cat where {{
+              values ?cat {{ {values} }}
+              ?item wdt:P18 ?image;
+                    wdt:P373 ?cat.
+            }}
+        '''
+
+        requestParams = {
+            'format': 'json',
+            'query': sparql,
+        }
+
+        response = await self._getJson('https://query.wikidata.org/sparql', requestParams, 'Wikidata Query API')
+        if 'results' not in response or 'bindings' not in response['results']:
+            raise Exception(f'Invalid response from Wikidata SPARQL: {response}')
+
+        return parseCategoryBindings(response['results']['bindings'])
+
+
+    async def _getJson(self, url: str, requestParams: dict, apiName: str) -> dict:
+        async with self.httpSession.get(url, params=requestParams, timeout=ClientTimeout(total=60)) as rawResponse:
+            responseText = await rawResponse.text()
+            try:
+                return json.loads(responseText)
+            except Exception as e:
+                raise Exception(
+                    f'{apiName} responded with invalid JSON (response code: ' +
+                    str(rawResponse.status) + '). Beginning of the response: ' + responseText[:200]
+                ) from e
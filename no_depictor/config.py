@@ -9,18 +9,48 @@ def getConfig(console: Console):
     DEFAULT_CONFIG_FILE = 'config.json'
 
     parser = ArgumentParser(description='A tool for mass-marking Wikimedia Commons images as not-depiciting a given subject.')
+    parser.add_argument('command', nargs='?', choices=('plan', 'execute'), help='Only find the work and write it to the work file (plan), or only do the work from the work file (execute)')
     parser.add_argument('--category', type=str, help='Category name whose subcategories to process')
     parser.add_argument('--categoryfile', type=str, help='File containing category names whose subcategories to process')
+    parser.add_argument('--tree-source', type=str, choices=('petscan', 'commons'), help='Service used to fetch category trees, unless set for a category with "Name|depth|source" (default: petscan)')
     parser.add_argument('--logfile', type=str, help='Path to the log file (default: no_depictor.log)')
+    parser.add_argument('--log-format', type=str, choices=('wikitext', 'jsonl'), help='Format of the log file (default: wikitext)')
+    parser.add_argument('--log-max-mb', type=float, help='Size in MB after which the log file is rotated, 0 to disable (default: 100)')
     parser.add_argument('--user', type=str, help='Username for Depictor API')
     parser.add_argument('--sessid', type=str, help='PHP session ID for Depictor API')
     parser.add_argument('--config', type=str, help='Path to the configuration file, set to "-" to disable')
+    parser.add_argument('--chunk-size', type=int, help='Number of IDs checked in Depictor in a single request (default: 500)')
+    parser.add_argument('--chunk-workers', type=int, help='Number of concurrent requests checking IDs in Depictor (default: 4)')
+    parser.add_argument('--state-db', type=str, help='Path to the local database of items and files done in Depictor (default: no_depictor.sqlite3), set to "-" to disable')
+    parser.add_argument('--cache', action='store_true', help='Cache responses of PetScan and Wikidata on disk between runs')
+    parser.add_argument('--no-cache', action='store_true', help='Do not use the cache in this run, even if it is enabled in the configuration file')
+    parser.add_argument('--refresh', action='store_true', help='Ignore cached responses of PetScan and Wikidata, but cache the fresh ones')
     parser.add_argument('--dry-run', action='store_true', help='Perform a dry run without making any changes')
+    parser.add_argument('--check-unchanged', action='store_true', help='Search categories for files even if they have not changed on Commons since they were last processed, and record their current states')
+    parser.add_argument('--resume', action='store_true', help='First finish the categories left unfinished by an interrupted run, as recorded in the journal')
+    parser.add_argument('--estimate', action='store_true', help='Only estimate how many categories and files would be processed, and how long it would take')
+    parser.add_argument('--whole-category', action='store_true', help='Process all files of a category (up to 10000), not only the first 500 search results')
+    parser.add_argument('--no-whole-category', action='store_true', help='Process only the first 500 search results in this run, even if --whole-category is set in the configuration file')
+    parser.add_argument('--write-workers', type=int, help='Number of files marked in Depictor concurrently, within its rate limit (default: 4)')
+    parser.add_argument('--workers', type=int, help='Number of categories searched for files concurrently (default: 1, or 16 with --asyncio)')
+    parser.add_argument('--asyncio', action='store_true', help='Use the asyncio-based driver in this run, which keeps many read requests in flight on a single thread')
+    parser.add_argument('--watch', type=float, help='Keep running and process files uploaded since the previous cycle every WATCH minutes')
+    parser.add_argument('--shards', type=int, help='Number of worker processes the lines of the category file are distributed to (default: 1)')
+    parser.add_argument('--work-file', type=str, help='Work file written by the plan command and read by the execute command (default: no_depictor_work.jsonl.gz)')
+    parser.add_argument('--write-rate', type=float, help='Writes to Depictor per second in the execute command (default: the rate limit of Depictor)')
+    parser.add_argument('--metrics-file', type=str, help='File to which request metrics are periodically written')
+    parser.add_argument('--metrics-format', type=str, choices=('prometheus', 'json'), help='Format of the metrics file (default: json for *.json files, prometheus otherwise)')
 
     args = parser.parse_args()
     combinedArgs = { key: getattr(args, key, None) for key in vars(args) }
     if combinedArgs.get('dry_run') == False:
         combinedArgs['dry_run'] = None  # False is the default, for not set
+    if combinedArgs.get('asyncio') == False:
+        combinedArgs['asyncio'] = None
+    if combinedArgs.get('cache') == False:
+        combinedArgs['cache'] = None
+    if combinedArgs.get('whole_category') == False:
+        combinedArgs['whole_category'] = None
 
     if args.config != '-':
         try:
@@ -44,28 +74,38 @@ def getConfig(console: Console):
 
     if args.config != '-':
         # Save the configuration back to the file
+        # Skipping or refreshing the cache, refreshing the category states, watching, the asyncio driver and commands are meant for a single run only
+        savedArgs = {
+            key: value for key, value in combinedArgs.items()
+            if key not in ('command', 'no_cache', 'no_whole_category', 'refresh', 'check_unchanged', 'watch', 'estimate', 'resume', 'asyncio')
+        }
         try:
             with open(args.config or DEFAULT_CONFIG_FILE, 'w') as configFile:
-                json.dump(combinedArgs, configFile, indent=4)
+                json.dump(savedArgs, configFile, indent=4)
         except IOError as e:
             console.print(f'[bold red]Error writing to configuration file `{args.config}`: {e}')
             sys.exit(1)
 
+    # Only for this run, the saved setting stays
+    if combinedArgs.get('no_whole_category'):
+        combinedArgs['whole_category'] = False
     return combinedArgs
 
 
 def _askUserForMissingArgs(allArgs: dict, cliArgs: Namespace, console: Console) -> dict:
-    if _absent('category', cliArgs) and _absent('categoryfile', cliArgs):
-        _askForCategory(allArgs, console)
-    elif not _absent('category', cliArgs) and not _absent('categoryfile', cliArgs):
-        console.print(f'[bold red]You cannot specify both --category and --categoryfile at the same time.')
-        sys.exit(1)
-    else:
-        # Ensure that CLI value takes precedence and that we have only one of these two
-        if _absent('category', cliArgs):
-            allArgs['category'] = None
+    # The execute command takes the categories from the work file
+    if cliArgs.command != 'execute':
+        if _absent('category', cliArgs) and _absent('categoryfile', cliArgs):
+            _askForCategory(allArgs, console)
+        elif not _absent('category', cliArgs) and not _absent('categoryfile', cliArgs):
+            console.print(f'[bold red]You cannot specify both --category and --categoryfile at the same time.')
+            sys.exit(1)
         else:
-            allArgs['categoryfile'] = None
+            # Ensure that CLI value takes precedence and that we have only one of these two
+            if _absent('category', cliArgs):
+                allArgs['category'] = None
+            else:
+                allArgs['categoryfile'] = None
 
     if _absent('user', cliArgs):
         allArgs['user'] = (Prompt.ask(
@@ -95,6 +135,15 @@ def _askUserForMissingArgs(allArgs: dict, cliArgs: Namespace, console: Console)
     if not allArgs.get('dry_run', False):
         allArgs['dry_run'] = False
 
+    if not allArgs.get('asyncio', False):
+        allArgs['asyncio'] = False
+
+    if not allArgs.get('cache', False):
+        allArgs['cache'] = False
+
+    if not allArgs.get('whole_category', False):
+        allArgs['whole_category'] = False
+
     return allArgs
 
 
@@ -1,2 +1,3 @@
 from ._category_descriptor import CategoryDescriptor
+from ._file_collection import FileCollection
 from ._file_descriptor import FileDescriptor
@@ -1,9 +1,33 @@
 class CategoryDescriptor:
 
+    __slots__ = ('qId', 'title')
+
     def __init__(self, qId: str, title: str):
-        self.qId = qId
-        self.title = title # Without namespace
+        object.__setattr__(self, 'qId', qId)
+        object.__setattr__(self, 'title', title) # Without namespace
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
 
 
     def __iter__(self):
         return iter((self.qId, self.title))
+
+
+    def __eq__(self, other):
+        if not isinstance(other, CategoryDescriptor):
+            return NotImplemented
+        return self.qId == other.qId and self.title == other.title
+
+
+    def __hash__(self):
+        return hash((self.qId, self.title))
+
+
+    def __repr__(self):
+        return f'CategoryDescriptor({self.qId!r}, {self.title!r})'
+
+
+    def __reduce__(self):
+        return (CategoryDescriptor, (self.qId, self.title))
@@ -0,0 +1,82 @@
+from array import array
+from typing import Collection, Iterable, Iterator, Sequence, overload
+
+from ._file_descriptor import FileDescriptor
+
+
+class FileCollection(Sequence[FileDescriptor]):
+    '''
+    A compact list of files, keeping page IDs in an array and titles in a list,
+    instead of a descriptor object per file. Descriptors are created on access,
+    so the clients fill and filter collections in bulk, without creating them.
+    '''
+
+    __slots__ = ('_pageIds', '_titles')
+
+    def __init__(self, files: Iterable[FileDescriptor] = ()):
+        self._pageIds = array('q')
+        self._titles: list[str] = []
+        for file in files:
+            self.append(file)
+
+
+    def append(self, file: FileDescriptor):
+        self._pageIds.append(file.pageId)
+        self._titles.append(file.title)
+
+
+    def add(self, pageId: int, title: str):
+        '''Appends a file without creating its descriptor.'''
+        self._pageIds.append(pageId)
+        self._titles.append(title)
+
+
+    def extend(self, files: 'FileCollection'):
+        self._pageIds.extend(files._pageIds)
+        self._titles.extend(files._titles)
+
+
+    def without(self, mIds: Collection[str]) -> 'FileCollection':
+        '''Returns a new collection without the files with the given MIDs.'''
+        result = FileCollection()
+        for pageId, title in zip(self._pageIds, self._titles):
+            if f'M{pageId}' not in mIds:
+                result.add(pageId, title)
+        return result
+
+
+    @property
+    def pageIds(self) -> array:
+        '''The page IDs of the files, in order. The array must not be modified.'''
+        return self._pageIds
+
+
+    @property
+    def mIds(self) -> list[str]:
+        return [f'M{pageId}' for pageId in self._pageIds]
+
+
+    def __len__(self) -> int:
+        return len(self._pageIds)
+
+
+    @overload
+    def __getitem__(self, index: int) -> FileDescriptor: ...
+    @overload
+    def __getitem__(self, index: slice) -> 'FileCollection': ...
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            result = FileCollection()
+            result._pageIds = self._pageIds[index]
+            result._titles = self._titles[index]
+            return result
+        return FileDescriptor(self._pageIds[index], self._titles[index])
+
+
+    def __iter__(self) -> Iterator[FileDescriptor]:
+        for pageId, title in zip(self._pageIds, self._titles):
+            yield FileDescriptor(pageId, title)
+
+
+    def __repr__(self):
+        return f'FileCollection({len(self)} files)'
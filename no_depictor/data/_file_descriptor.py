@@ -1,9 +1,44 @@
 class FileDescriptor:
 
-    def __init__(self, mId: str, title: str):
-        self.mId = mId
-        self.title = title # With namespace
+    __slots__ = ('pageId', 'title')
+
+    def __init__(self, mId: str | int, title: str):
+        '''
+        :param mId: The media ID, either as 'M123' or as the page ID alone.
+        :param title: The title of the file page, with namespace.
+        '''
+        if isinstance(mId, str):
+            mId = int(mId[1:] if mId.startswith('M') else mId)
+        object.__setattr__(self, 'pageId', mId)
+        object.__setattr__(self, 'title', title) # With namespace
+
+
+    @property
+    def mId(self) -> str:
+        return f'M{self.pageId}'
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
 
 
     def __iter__(self):
         return iter((self.mId, self.title))
+
+
+    def __eq__(self, other):
+        if not isinstance(other, FileDescriptor):
+            return NotImplemented
+        return self.pageId == other.pageId and self.title == other.title
+
+
+    def __hash__(self):
+        return hash((self.pageId, self.title))
+
+
+    def __repr__(self):
+        return f'FileDescriptor({self.mId!r}, {self.title!r})'
+
+
+    def __reduce__(self):
+        return (FileDescriptor, (self.pageId, self.title))
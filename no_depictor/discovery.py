@@ -0,0 +1,93 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from .clients import CommonsAPI, Depictor, DoneStore
+from .data import CategoryDescriptor, FileCollection
+from .interrupt_handler import InterruptHandler
+
+
+DiscoveryResult = tuple[CategoryDescriptor, FileCollection, Optional[int], Optional[Exception]]
+
+
+def discoverUndoneFiles(
+        categories: Iterable[CategoryDescriptor],
+        commons: CommonsAPI,
+        depictor: Depictor,
+        ih: InterruptHandler,
+        workers: int = 1,
+        queueSize: Optional[int] = None,
+        wholeCategory: bool = False,
+        markStore: Optional[DoneStore] = None
+    ) -> Iterator[DiscoveryResult]:
+    '''
+    Finds files to be marked for each of the categories. Results are yielded
+    in the same order as the categories were given.
+
+    With more than one worker, discovery for upcoming categories runs on a thread
+    pool while the caller processes the current one. At most `queueSize` categories
+    are discovered ahead of the caller (by default twice the number of workers).
+
+    :param categories: The categories to search in.
+    :param commons: Commons API client.
+    :param depictor: Depictor API client.
+    :param ih: An instance of InterruptHandler; no new work is scheduled after interruption.
+    :param workers: The number of threads to use for discovery.
+    :param queueSize: The maximum number of categories discovered ahead.
+    :param wholeCategory: Whether to list all files of the categories, not only the first page of search results.
+    :param markStore: If set, only files newer than the high-water marks of the categories are listed,
+        and all files of categories without a mark.
+    :return: An iterator of (category, undone files, newest page ID, error) tuples. The newest page ID
+        is the new high-water mark of the category, or None if no files were found. If the discovery
+        failed, the list of files is empty and the error is set.
+    '''
+    if workers <= 1:
+        for category in categories:
+            if ih.interrupted:
+                break
+            yield _discoverForCategory(category, commons, depictor, wholeCategory, markStore)
+        return
+
+    queueSize = max(queueSize or 2 * workers, 1)
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='discovery')
+    pending: deque[tuple[CategoryDescriptor, Future]] = deque()
+    categoryIterator = iter(categories)
+
+    def fillQueue():
+        while len(pending) < queueSize and not ih.interrupted:
+            category = next(categoryIterator, None)
+            if category is None:
+                return
+            pending.append((category, executor.submit(_discoverForCategory, category, commons, depictor, wholeCategory, markStore)))
+
+    try:
+        fillQueue()
+        while pending and not ih.interrupted:
+            _, future = pending.popleft()
+            fillQueue()
+            yield future.result()
+    finally:
+        # Categories that haven't been started yet are not needed anymore
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _discoverForCategory(
+        category: CategoryDescriptor,
+        commons: CommonsAPI,
+        depictor: Depictor,
+        wholeCategory: bool = False,
+        markStore: Optional[DoneStore] = None
+    ) -> DiscoveryResult:
+    qId, catName = category
+    try:
+        newerThan = None
+        if markStore is not None:
+            # Without a mark yet, all files are listed, newest first (as newer than page 0), because the newest
+            # file found becomes the mark, and older files missed by a partial listing would never be found
+            mark = markStore.getHighWaterMark(catName)
+            newerThan = mark if mark is not None else 0
+        files = commons.getFilesNotDepictingSubject(catName, qId, wholeCategory, newerThan=newerThan)
+        undoneFiles = depictor.getUndoneFiles(files)
+    except Exception as e:
+        return (category, FileCollection(), None, e)
+    return (category, undoneFiles, max(files.pageIds, default=None), None)
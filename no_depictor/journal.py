@@ -0,0 +1,179 @@
+from threading import Lock
+from typing import Optional
+import atexit
+import json
+import os
+import time
+
+from .data import CategoryDescriptor, FileCollection
+
+
+class PendingCategory:
+    '''A category whose files were planned to be marked, but which wasn't marked as done.'''
+
+    __slots__ = ('category', 'files', 'newestPageId')
+
+    def __init__(self, category: CategoryDescriptor, files: FileCollection, newestPageId: Optional[int]):
+        self.category = category
+        self.files = files # Only the files not confirmed yet
+        self.newestPageId = newestPageId
+
+
+class Journal:
+    '''
+    An append-only journal of writes to Depictor, so that a run which was interrupted
+    or killed can continue at the exact file, without discovering the categories again.
+
+    Before the files of a category are marked, the list of them is recorded (`plan`).
+    Every confirmed `add-file` and `item-done` is recorded after Depictor accepted it.
+    The plans are synced to disk right away, and the confirmations in batches, so a crash
+    loses at most the last batch of confirmations; their files are checked in Depictor again
+    when resuming. When the journal is opened, it is read and rewritten with only the
+    categories still pending.
+    '''
+
+    def __init__(self, path: str, syncEvery: int = 100, syncInterval: float = 1.0):
+        self.path = path
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+
+        self._lock = Lock()
+        self._pending = self._replay()
+        self._compact()
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._unsynced = 0
+        self._lastSync = time.monotonic()
+        self._closed = False
+        # Confirmations written since the last sync shouldn't be lost on an unexpected exit
+        atexit.register(self.close)
+
+
+    def getPending(self) -> list[PendingCategory]:
+        '''Returns the categories with unfinished work, in the order they were started.'''
+        with self._lock:
+            return [
+                PendingCategory(category, FileCollection(file for file in files if file.mId not in doneMids), newestPageId)
+                for category, files, newestPageId, doneMids in self._pending.values()
+            ]
+
+
+    def planCategory(self, category: CategoryDescriptor, files: FileCollection, newestPageId: Optional[int]):
+        '''Records the files that are about to be marked in the category.'''
+        with self._lock:
+            self._pending[(category.qId, category.title)] = (category, files, newestPageId, set())
+            self._write(_planRecord(category, files, newestPageId))
+            self._sync()
+
+
+    def fileDone(self, category: CategoryDescriptor, mId: str):
+        with self._lock:
+            entry = self._pending.get((category.qId, category.title))
+            if entry is not None:
+                entry[3].add(mId)
+            self._write({ 'op': 'add-file', 'qid': category.qId, 'category': category.title, 'mid': mId })
+            self._syncIfDue()
+
+
+    def categoryDone(self, category: CategoryDescriptor):
+        with self._lock:
+            self._pending.pop((category.qId, category.title), None)
+            self._write({ 'op': 'item-done', 'qid': category.qId, 'category': category.title })
+            self._syncIfDue()
+
+
+    @property
+    def pendingCount(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+
+    def checkpoint(self):
+        '''Writes everything recorded so far to disk.'''
+        with self._lock:
+            if not self._closed:
+                self._sync()
+
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._sync()
+            self._file.close()
+            self._closed = True
+        atexit.unregister(self.close)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+    def _replay(self) -> dict[tuple[str, str], tuple[CategoryDescriptor, FileCollection, Optional[int], set[str]]]:
+        pending = {}
+        try:
+            file = open(self.path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            return pending
+
+        with file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line may be cut short if the process was killed while writing it
+                    continue
+                key = (record['qid'], record['category'])
+                if record['op'] == 'plan':
+                    files = FileCollection()
+                    for pageId, title in record['files']:
+                        files.add(pageId, title)
+                    # A newer plan for the same category replaces the older one
+                    pending.pop(key, None)
+                    pending[key] = (CategoryDescriptor(*key), files, record.get('newest'), set())
+                elif record['op'] == 'add-file' and key in pending:
+                    pending[key][3].add(record['mid'])
+                elif record['op'] == 'item-done':
+                    pending.pop(key, None)
+        return pending
+
+
+    def _compact(self):
+        '''Rewrites the journal with only the pending categories, replacing the file atomically.'''
+        temporaryPath = self.path + '.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as output:
+            for key, (category, files, newestPageId, doneMids) in list(self._pending.items()):
+                files = FileCollection(file for file in files if file.mId not in doneMids)
+                self._pending[key] = (category, files, newestPageId, set())
+                output.write(json.dumps(_planRecord(category, files, newestPageId), ensure_ascii=False) + '\n')
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temporaryPath, self.path)
+
+
+    def _write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._unsynced += 1
+
+
+    def _syncIfDue(self):
+        if self._unsynced >= self.syncEvery or time.monotonic() - self._lastSync >= self.syncInterval:
+            self._sync()
+
+
+    def _sync(self):
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._lastSync = time.monotonic()
+
+
+def _planRecord(category: CategoryDescriptor, files: FileCollection, newestPageId: Optional[int]) -> dict:
+    return {
+        'op': 'plan', 'qid': category.qId, 'category': category.title,
+        'files': [[file.pageId, file.title] for file in files], 'newest': newestPageId,
+    }
@@ -0,0 +1,209 @@
+from datetime import datetime
+from queue import Empty, Queue
+from rich.console import Console
+from rich.table import Table
+from threading import Thread
+from typing import Optional
+from urllib.parse import quote
+import atexit
+import json
+import os
+import time
+
+from .clients import Metrics
+from .pipeline import Deduplicator
+
+
+def catlink(categoryName: str, consoleFormat = True) -> str:
+    return pagelink('Category:' + categoryName, consoleFormat)
+
+
+def pagelink(pageName: str, consoleFormat = True) -> str:
+    urlencoded = quote(pageName.replace(' ', '_'), safe=':/')
+    displayName = pageName.replace('_', ' ')
+    if displayName.startswith('Category:') or displayName.startswith('File:'):
+        displayName = ':' + displayName
+    
+    if not consoleFormat:
+        return f'[[{displayName}]]'
+    return f'[[[link=https://commons.wikimedia.org/wiki/{urlencoded}]{displayName}[/link]]]'
+
+
+class LogWriter:
+    '''
+    Writes log messages to a file on a background thread, so that slow disks
+    don't hold up the work. Messages wait in a bounded queue (logging blocks only
+    when it is full) and are written and flushed in batches. Everything logged
+    is written before the program exits, even after an interrupt.
+
+    Messages are formatted as a wikitext list, which can be pasted on a wiki page,
+    or as JSON lines. The file is rotated when it grows over `maxBytes`.
+    '''
+
+    def __init__(
+            self,
+            path: str,
+            format: str = 'wikitext',
+            maxBytes: int = 0,
+            backupCount: int = 5,
+            queueSize: int = 10000,
+            flushInterval: float = 1.0
+        ):
+        '''
+        :param path: Path to the log file, which is appended to.
+        :param format: `wikitext` or `jsonl`.
+        :param maxBytes: Size after which the file is renamed to `path.1` (and so on) and a new one is started; 0 disables rotation.
+        :param backupCount: How many rotated files are kept.
+        :param queueSize: How many messages can wait to be written.
+        :param flushInterval: How often the file is flushed, in seconds.
+        '''
+        self.path = path
+        self.format = format
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.flushInterval = flushInterval
+
+        self._file = open(path, 'a', encoding='utf-8')
+        self._queue: Queue[Optional[tuple[datetime, str, str]]] = Queue(maxsize=queueSize)
+        self._closed = False
+        self._thread = Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+        # Daemon threads are killed at exit, so flush the queue before that happens
+        atexit.register(self.close)
+
+
+    def log(self, type: str, message: str):
+        if self._closed:
+            return
+        self._queue.put((datetime.now(), type, message))
+
+
+    def close(self):
+        '''Writes all the queued messages and closes the file.'''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        atexit.unregister(self.close)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+    def _run(self):
+        while True:
+            entries = [self._queue.get()]
+            # Take everything that arrived in the meantime, to write it at once
+            deadline = time.monotonic() + self.flushInterval
+            while entries[-1] is not None:
+                try:
+                    entries.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except Empty:
+                    break
+
+            finished = entries[-1] is None
+            self._file.write(''.join(self._format(*entry) for entry in entries if entry is not None))
+            self._file.flush()
+            if self.maxBytes and self._file.tell() >= self.maxBytes:
+                self._rotate()
+            if finished:
+                return
+
+
+    def _format(self, timestamp: datetime, type: str, message: str) -> str:
+        if self.format == 'jsonl':
+            return json.dumps({ 'time': timestamp.isoformat(timespec='milliseconds'), 'type': type, 'message': message }, ensure_ascii=False) + '\n'
+
+        now = timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3] # Trim microseconds to milliseconds
+        prefix = f'* <!-- {now} | {type} --> '
+
+        lines = message.splitlines() or ['']
+        formattedMessage = prefix + lines[0].rstrip()
+        for line in lines[1:]:
+            formattedMessage += '\n*:' + ' ' * (len(prefix) - 2) + line.rstrip()
+        return formattedMessage + '\n'
+
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backupCount > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+
+def formatDuration(seconds: float) -> str:
+    '''Formats a duration for humans, e.g. `2 h 5 min` or `40 s`.'''
+    seconds = round(seconds)
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f'{days} d {hours} h'
+    if hours:
+        return f'{hours} h {minutes} min'
+    if minutes:
+        return f'{minutes} min {seconds} s'
+    return f'{seconds} s'
+
+
+def logToFile(logFile: LogWriter, type: str, message: str):
+    logFile.log(type, message)
+
+
+def printMetricsSummary(console: Console, metrics: Metrics):
+    snapshot = metrics.snapshot()
+    if not snapshot['endpoints']:
+        return
+
+    table = Table(title=f'Requests in {snapshot["elapsed_sec"]:.0f} s')
+    for column in ('Endpoint', 'Requests', 'Cached', 'Errors', '429', 'Retries', 'Avg latency', 'Received'):
+        table.add_column(column, justify='left' if column == 'Endpoint' else 'right')
+    for endpoint, values in snapshot['endpoints'].items():
+        requests = values['requests']
+        table.add_row(
+            endpoint,
+            str(requests),
+            str(values['cached']),
+            str(values['errors']),
+            str(values['rate_limited']),
+            str(values['retries']),
+            f'{values["latency_sum_sec"] / requests * 1000:.0f} ms' if requests else '-',
+            f'{values["bytes_received"] / 1024:.0f} KiB',
+        )
+    console.print(table)
+
+    connections = ', '.join(
+        f'{host} {values["requests"]} over {values["opened"]}'
+        for host, values in snapshot['connections'].items() if values['opened']
+    )
+    if connections:
+        console.print(f'Requests per connections opened: {connections}')
+
+    sleeps = ', '.join(f'{host} {seconds:.1f} s' for host, seconds in snapshot['rate_limit_sleep_sec'].items() if seconds >= 0.05)
+    if sleeps:
+        console.print(f'Waited for the rate limiter: {sleeps}')
+
+
+def printDeduplicationSummary(deduplicator: Deduplicator, console: Console, logFile: LogWriter):
+    if deduplicator.duplicates == 0:
+        return
+    # Duplicates are dropped before the filters, so some of them wouldn't have been searched anyway
+    # (done in Depictor or without an image); besides the searches, each saves a part of batched lookups
+    message = (
+        f'{deduplicator.duplicates} categories were shared by several roots and processed only once, '
+        f'saving up to {deduplicator.duplicates} searches on Commons and {deduplicator.duplicates} lookups of files in Depictor.'
+    )
+    console.print(message)
+    logToFile(logFile, 'INFO', message)
@@ -0,0 +1,220 @@
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Callable, Iterable, Iterator, TypeVar
+from urllib.parse import unquote
+
+from .clients import CommonsAPI, Depictor, DoneStore, WikidataAPI
+from .data import CategoryDescriptor
+
+# Lazy stages of the processing pipeline. Each stage pulls from the previous one
+# only as much as it needs, so memory use doesn't depend on the size of the tree.
+
+TREE_SOURCES = ('petscan', 'commons')
+
+def splitRootCategory(line: str, defaultTreeSource: str = 'petscan') -> tuple[str, int, str]:
+    '''
+    Splits a line of the category file in the `Name|depth` or `Name|depth|source` format,
+    where source is the service used to fetch the category tree (see TREE_SOURCES).
+    Raises ValueError if the line is malformed.
+    '''
+    parts = line.split('|')
+    categoryName = unquote(parts[0].strip())
+    try:
+        depth = int(parts[1].strip())
+    except ValueError:
+        raise ValueError(f'Invalid depth "{parts[1].strip()}", expected a whole number.') from None
+    treeSource = (parts[2].strip().lower() if len(parts) > 2 else '') or defaultTreeSource
+    if treeSource not in TREE_SOURCES:
+        raise ValueError(f'Unknown category tree source "{treeSource}", expected one of: {", ".join(TREE_SOURCES)}.')
+    return categoryName, depth, treeSource
+
+
+T = TypeVar('T')
+def batched(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    '''Groups items of the iterable into lists of at most `size` items.'''
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def buffered(iterable: Iterable[T], maxSize: int) -> Iterator[T]:
+    '''
+    Consumes the iterable on a background thread, keeping at most `maxSize`
+    items ready for the caller. Exceptions are re-raised in the caller's thread.
+    '''
+    queue: Queue = Queue(maxsize=maxSize)
+    stopped = Event()
+    END = object()
+
+    def put(entry) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put(entry, timeout=0.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((END, e))
+            return
+        put((END, None))
+
+    Thread(target=produce, daemon=True, name='buffered').start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is END:
+                return
+            yield item
+    finally:
+        stopped.set()
+        # Unblock the producer, if it's waiting for space in the queue
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+
+
+class StageCounter:
+    '''Counts items passing through a stage.'''
+
+    def __init__(self):
+        self.count = 0
+
+
+    def __call__(self, iterable: Iterable[T]) -> Iterator[T]:
+        for item in iterable:
+            self.count += 1
+            yield item
+
+
+class Deduplicator:
+    '''
+    Drops categories that already passed through it, so that a category shared
+    by the trees of several roots is processed once per run. The same instance
+    is used for all the roots.
+    '''
+
+    def __init__(self):
+        self.duplicates = 0
+        self._seen: set[tuple[str, str]] = set()
+        self._skipped: set[tuple[str, str]] = set()
+
+
+    def skip(self, categories: Iterable[CategoryDescriptor]):
+        '''Drops the categories without counting them as duplicates, e.g. because they were already resumed.'''
+        self._skipped.update(self._key(category) for category in categories)
+
+
+    def __call__(self, categories: Iterable[CategoryDescriptor]) -> Iterator[CategoryDescriptor]:
+        for category in categories:
+            key = self._key(category)
+            if key in self._skipped:
+                continue
+            if key in self._seen:
+                self.duplicates += 1
+                continue
+            self._seen.add(key)
+            yield category
+
+
+    @staticmethod
+    def _key(category: CategoryDescriptor) -> tuple[str, str]:
+        # PetScan gives titles with underscores, while roots from the file may have spaces
+        return (category.qId, category.title.replace(' ', '_'))
+
+
+class UnchangedCategoryFilter:
+    '''
+    Drops categories that haven't changed on Commons (neither their page was touched,
+    e.g. by adding or removing files, nor the number of files changed) since they were
+    last processed with nothing left to do, as searching them would find nothing again.
+    The states of the categories let through are kept until they are processed, see `record`.
+    With `skipUnchanged` off, no category is dropped, but the states are still recorded.
+    '''
+
+    def __init__(self, commons: CommonsAPI, doneStore: DoneStore, wholeCategory: bool = False, skipUnchanged: bool = True, batchSize: int = 50):
+        self.commons = commons
+        self.doneStore = doneStore
+        self.wholeCategory = wholeCategory
+        self.skipUnchanged = skipUnchanged
+        self.batchSize = batchSize
+        self.unchanged = 0
+        self._states: dict[str, tuple[str, int]] = {}
+
+
+    def __call__(self, categories: Iterable[CategoryDescriptor]) -> Iterator[CategoryDescriptor]:
+        for batch in batched(categories, self.batchSize):
+            titles = [category.title for category in batch]
+            try:
+                states = self.commons.getCategoryStates(titles)
+            except Exception:
+                # Without the states, the categories are just searched as usual
+                yield from batch
+                continue
+
+            recorded = self.doneStore.getCategoryStates(titles)
+            for category in batch:
+                state = states.get(category.title)
+                previous = recorded.get(category.title)
+                # A search of the first page says nothing about the rest of the category
+                if self.skipUnchanged and state is not None and previous is not None and previous[:2] == state and (previous[2] or not self.wholeCategory):
+                    self.unchanged += 1
+                    continue
+                if state is not None:
+                    self._states[category.title] = state
+                yield category
+
+
+    def record(self, category: CategoryDescriptor):
+        '''Records the state of the category as it was before it was processed, once there is nothing left to do in it.'''
+        state = self._states.pop(category.title, None)
+        if state is not None:
+            self.doneStore.setCategoryState(category.title, *state, self.wholeCategory)
+
+
+def filterUndoneCategories(categories: Iterable[CategoryDescriptor], depictor: Depictor) -> Iterator[CategoryDescriptor]:
+    '''Yields categories not done in Depictor, checking as many at once as the client sends concurrently.'''
+    for batch in batched(categories, depictor.chunkSize * depictor.maxWorkers):
+        yield from depictor.getUndoneCategories(batch)
+
+
+def filterCategoriesWithImage(
+        categories: Iterable[CategoryDescriptor],
+        wikidata: WikidataAPI,
+        onSkipped: Callable[[CategoryDescriptor], None],
+        onFailed: Callable[[CategoryDescriptor, Exception], None],
+        batchSize: int = 200
+    ) -> Iterator[CategoryDescriptor]:
+    '''
+    Yields categories whose items have an image (P18) and calls `onSkipped` for the others.
+    Categories whose items couldn't be checked are passed to `onFailed` and dropped,
+    while the rest of the batch goes on.
+    '''
+    for batch in batched(categories, batchSize):
+        errors: dict[str, Exception] = {}
+        def onError(qIds: list[str], error: Exception):
+            errors.update((qId, error) for qId in qIds)
+
+        itemsWithImage = wikidata.getItemsWithImageClaim((cat.qId for cat in batch), onError=onError)
+        for category in batch:
+            if category.qId in itemsWithImage:
+                yield category
+            elif category.qId in errors:
+                onFailed(category, errors[category.qId])
+            else:
+                onSkipped(category)
@@ -0,0 +1,155 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from rich.console import Console
+from rich.markup import escape
+from rich.status import Status
+from rich.table import Table
+from typing import Iterable, Optional
+
+from .clients import CommonsAPI, DEPICTOR_WRITES, Depictor, MAX_SEARCH_RESULTS, PetScan, RateLimiter, SEARCH_PAGE_SIZE, WikidataAPI
+from .data import CategoryDescriptor
+from .interrupt_handler import interruptible, InterruptHandler
+from .output import catlink, formatDuration, logToFile, LogWriter
+from .pipeline import Deduplicator, filterCategoriesWithImage, filterUndoneCategories, StageCounter
+from .runner import getCategoriesForRoot
+
+
+class RootPlan:
+    '''Counts of the work to be done for a single line of the category file.'''
+
+    def __init__(self, rootCategory: str):
+        self.rootCategory = rootCategory
+        self.categories = 0
+        self.undoneCategories = 0
+        self.categoriesWithImage = 0
+        self.files = 0
+        self.failedCategories = 0
+
+
+def planRootCategories(
+        rootCategories: list[str],
+        resolvedRoots: Optional[dict[str, CategoryDescriptor]],
+        args: dict,
+        commons: CommonsAPI,
+        petscan: PetScan,
+        wikidata: WikidataAPI,
+        depictor: Depictor,
+        rateLimiter: RateLimiter,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter
+    ):
+    '''
+    Estimates the work for the category file without making any changes: how many
+    categories are not done in Depictor and how many files would be marked in them.
+    Files are counted with the total number of search hits instead of being listed,
+    so the counts are upper bounds; files already decided in Depictor are included.
+    All the searches of a root run concurrently, only limited by the rate limiter.
+    '''
+    filesPerCategory = MAX_SEARCH_RESULTS if args.get('whole_category') else SEARCH_PAGE_SIZE
+    deduplicator = Deduplicator()
+    plans = []
+    for rootCategory in interruptible(rootCategories, ih):
+        rootCategory, categories = getCategoriesForRoot(rootCategory, resolvedRoots, args, commons, petscan, wikidata, status, console, logFile)
+        if categories is None:
+            continue
+
+        plan = RootPlan(rootCategory)
+        plans.append(plan)
+        totalCounter, undoneCounter, withImageCounter = StageCounter(), StageCounter(), StageCounter()
+
+        def onFailed(category: CategoryDescriptor, error: Exception):
+            plan.failedCategories += 1
+
+        categoriesWithImage = withImageCounter(filterCategoriesWithImage(
+            undoneCounter(filterUndoneCategories(totalCounter(deduplicator(categories)), depictor)),
+            wikidata,
+            lambda category: None,
+            onFailed,
+        ))
+        status.update(status=f'Counting files in categories of {catlink(rootCategory)}')
+        try:
+            for category, count in _countFiles(categoriesWithImage, commons, ih, args.get('workers') or 16):
+                if count is None:
+                    plan.failedCategories += 1
+                else:
+                    plan.files += min(count, filesPerCategory)
+        except Exception as e:
+            console.print(f'[red]Failed to fetch categories of {catlink(rootCategory)}:[/red] {escape(str(e))}')
+            logToFile(logFile, 'ERROR', f'Failed to fetch categories of {catlink(rootCategory, False)}: {str(e)}')
+
+        plan.categories = totalCounter.count
+        plan.undoneCategories = undoneCounter.count
+        plan.categoriesWithImage = withImageCounter.count
+        console.print(
+            f'{plan.categories} categories, {plan.undoneCategories} not done in Depictor, '
+            f'{plan.categoriesWithImage} with an image, up to {plan.files} files to mark.'
+        )
+        logToFile(
+            logFile, 'INFO',
+            f'Estimate for {catlink(rootCategory, False)}: {plan.categories} categories, {plan.undoneCategories} not done in Depictor, '
+            f'{plan.categoriesWithImage} with an image, up to {plan.files} files to mark.'
+        )
+
+    _printPlan(plans, rateLimiter.getRate(DEPICTOR_WRITES), console, logFile)
+
+
+def _countFiles(
+        categories: Iterable[CategoryDescriptor],
+        commons: CommonsAPI,
+        ih: InterruptHandler,
+        workers: int
+    ) -> Iterable[tuple[CategoryDescriptor, Optional[int]]]:
+    '''Counts files in the categories concurrently, keeping at most twice the number of workers in flight.'''
+    def count(category: CategoryDescriptor) -> Optional[int]:
+        try:
+            return commons.countFilesNotDepictingSubject(category.title, category.qId)
+        except Exception:
+            return None
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='planning')
+    pending: deque[tuple[CategoryDescriptor, Future]] = deque()
+    categoryIterator = iter(categories)
+    try:
+        while not ih.interrupted:
+            while len(pending) < 2 * workers:
+                category = next(categoryIterator, None)
+                if category is None:
+                    break
+                pending.append((category, executor.submit(count, category)))
+            if not pending:
+                return
+            category, future = pending.popleft()
+            yield category, future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _printPlan(plans: list[RootPlan], writeRate: Optional[float], console: Console, logFile: LogWriter):
+    table = Table(title='Estimate')
+    for column in ('Root category', 'Categories', 'Not done', 'With image', 'Files (up to)', 'Failed'):
+        table.add_column(column, justify='left' if column == 'Root category' else 'right')
+    for plan in plans:
+        table.add_row(
+            escape(plan.rootCategory), str(plan.categories), str(plan.undoneCategories),
+            str(plan.categoriesWithImage), str(plan.files), str(plan.failedCategories),
+        )
+
+    totalCategories = sum(plan.categoriesWithImage for plan in plans)
+    totalFiles = sum(plan.files for plan in plans)
+    table.add_section()
+    table.add_row(
+        'Total', str(sum(plan.categories for plan in plans)), str(sum(plan.undoneCategories for plan in plans)),
+        str(totalCategories), str(totalFiles), str(sum(plan.failedCategories for plan in plans)),
+    )
+    console.print(table)
+
+    # Every file and every category takes a write request to Depictor
+    writes = totalFiles + totalCategories
+    if writeRate:
+        eta = f'about {formatDuration(writes / writeRate)} at {writeRate:g} writes per second'
+    else:
+        eta = 'unknown, as writes to Depictor are not rate-limited'
+    console.print(f'Up to {writes} writes to Depictor, which would take {eta}.')
+    logToFile(logFile, 'INFO', f'Estimate: up to {totalFiles} files to mark in {totalCategories} categories, which would take {eta}.')
@@ -0,0 +1,435 @@
+from rich.console import Console
+from rich.markup import escape
+from rich.status import Status
+from typing import Iterable, Optional
+from urllib.parse import unquote
+
+from .clients import CommonsAPI, Depictor, DoneStore, Metrics, PetScan, RateLimitedSession, RateLimiter, ResponseCache, WikidataAPI
+from .data import CategoryDescriptor, FileCollection
+from .discovery import discoverUndoneFiles
+from .interrupt_handler import interruptible, InterruptHandler
+from .journal import Journal
+from .output import catlink, logToFile, LogWriter, pagelink
+from .pipeline import buffered, Deduplicator, filterCategoriesWithImage, filterUndoneCategories, splitRootCategory, StageCounter, UnchangedCategoryFilter
+from .work_file import WorkFileWriter
+
+
+def createResponseCache(args: dict) -> Optional[ResponseCache]:
+    # The cache is opt-in, --no-cache turns it off for a single run
+    if not args.get('cache') or args.get('no_cache'):
+        return None
+    return ResponseCache(
+        args.get('cache_file') or 'no_depictor_cache.sqlite3',
+        maxBytes=int((args.get('cache_max_mb') or 200) * 1024 * 1024),
+        ttls=args.get('cache_ttls'),
+        refresh=bool(args.get('refresh')),
+    )
+
+
+def createMetrics(metricsPath: Optional[str], args: dict) -> Metrics:
+    return Metrics(
+        metricsPath,
+        exportFormat=args.get('metrics_format') or ('json' if metricsPath and metricsPath.endswith('.json') else 'prometheus'),
+    )
+
+
+def createLogWriter(logPath: str, args: dict) -> LogWriter:
+    return LogWriter(
+        logPath,
+        format=args.get('log_format') or 'wikitext',
+        maxBytes=int((args.get('log_max_mb') if args.get('log_max_mb') is not None else 100) * 1024 * 1024),
+    )
+
+
+def createSession(
+        args: dict,
+        rateLimiter: RateLimiter,
+        responseCache: Optional[ResponseCache] = None,
+        metrics: Optional[Metrics] = None
+    ) -> RateLimitedSession:
+    session = RateLimitedSession(rateLimiter, responseCache=responseCache, metrics=metrics)
+    session.headers.update({
+        'User-Agent': 'NoDepictor/1.0 (User:Msz2001)'
+    })
+    # API overrides are used by benchmarks to send requests to a local mock of the APIs, instead of the real hosts
+    session.mountPools({ **getPoolSizes(args), **(args.get('pool_sizes') or {}) }, args.get('api_overrides'))
+    return session
+
+
+def createClients(
+        args: dict,
+        session: RateLimitedSession,
+        doneStore: Optional[DoneStore],
+        userName: str,
+        phpSessionId: str
+    ) -> tuple[CommonsAPI, WikidataAPI, PetScan, Depictor]:
+    depictor = Depictor(
+        userName, phpSessionId, session, doneStore,
+        chunkSize=args.get('chunk_size') or 500,
+        maxWorkers=args.get('chunk_workers') or 4,
+        maxWritesInFlight=args.get('write_workers') or 4,
+    )
+    return CommonsAPI(session), WikidataAPI(session), PetScan(session), depictor
+
+
+def getPoolSizes(args: dict) -> dict[str, int]:
+    '''Returns the number of connections to keep for each host, matching the number of requests that can be in flight.'''
+    workers = args.get('workers') or 1
+    chunkWorkers = args.get('chunk_workers') or 4
+    writeWorkers = args.get('write_workers') or 4
+    return {
+        # Every discovery worker searches with prefetching of 2 pages, while trees are walked by 8 threads
+        'commons.wikimedia.org': 2 * workers + 8,
+        'www.wikidata.org': 4,
+        'query.wikidata.org': 2,
+        # Queries of large trees are split into several, sent concurrently
+        'petscan.wmcloud.org': 4,
+        # Every discovery worker checks files in concurrent chunks, while files are marked concurrently too
+        'hay.toolforge.org': workers * chunkWorkers + writeWorkers,
+    }
+
+
+def processRootCategory(
+        rootCategory: str,
+        resolvedRoots: Optional[dict[str, CategoryDescriptor]],
+        args: dict,
+        commons: CommonsAPI,
+        petscan: PetScan,
+        wikidata: WikidataAPI,
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        deduplicator: Optional[Deduplicator] = None,
+        journal: Optional[Journal] = None,
+        workFile: Optional[WorkFileWriter] = None
+    ):
+    '''
+    Processes a single line of the category file: a category with its subcategories
+    down to the given depth, or just the category itself.
+
+    :param resolvedRoots: Items of categories without depth, resolved by resolveRootCategories,
+        or None if they should be resolved one by one.
+    :param deduplicator: Skips categories already processed under other roots in this run.
+    :param journal: Records the writes, so that the run can be resumed.
+    :param workFile: Receives the files to be marked instead of Depictor, to be executed later.
+    '''
+    rootCategory, categories = getCategoriesForRoot(rootCategory, resolvedRoots, args, commons, petscan, wikidata, status, console, logFile)
+    if categories is None:
+        return
+
+    totalCounter, undoneCounter = StageCounter(), StageCounter()
+    duplicatesBefore = deduplicator.duplicates if deduplicator is not None else 0
+    if deduplicator is not None:
+        categories = deduplicator(categories)
+    if args.get('watch'):
+        # New files may appear in categories done before, so they are checked since their high-water marks
+        undoneCategories = undoneCounter(totalCounter(categories))
+    else:
+        status.update(status=f'Finding categories already done in Depictor')
+        undoneCategories = undoneCounter(filterUndoneCategories(totalCounter(categories), depictor))
+    changeFilter = None
+    if depictor.doneStore is not None:
+        changeFilter = UnchangedCategoryFilter(commons, depictor.doneStore, args.get('whole_category', False), not args.get('check_unchanged'))
+        undoneCategories = changeFilter(undoneCategories)
+    try:
+        doWorkForUndoneCategories(
+            undoneCategories, commons, depictor, wikidata, status, console, ih, logFile,
+            args.get('dry_run', False), args.get('workers') or 1, args.get('whole_category', False),
+            depictor.doneStore if args.get('watch') else None, journal, workFile, changeFilter
+        )
+    except Exception as e:
+        # Only the lazy stages before discovery can raise here
+        console.print(f'[red]Failed to fetch categories of {catlink(rootCategory)}:[/red] {escape(str(e))}')
+        logToFile(logFile, 'ERROR', f'Failed to fetch categories of {catlink(rootCategory, False)}: {str(e)}')
+        return
+
+    duplicates = deduplicator.duplicates - duplicatesBefore if deduplicator is not None else 0
+    if duplicates > 0:
+        console.print(f'Skipped {duplicates} categories of {catlink(rootCategory)} already processed under other roots.')
+        logToFile(logFile, 'INFO', f'Skipped {duplicates} categories already processed under other roots.')
+
+    if changeFilter is not None and changeFilter.unchanged > 0:
+        console.print(f'Skipped {changeFilter.unchanged} categories of {catlink(rootCategory)} unchanged on Commons since they were last processed.')
+        logToFile(logFile, 'INFO', f'Skipped {changeFilter.unchanged} categories unchanged on Commons since they were last processed.')
+
+    if totalCounter.count == 0:
+        if duplicates == 0:
+            console.print(f'No subcategories of {catlink(rootCategory)} found.')
+            logToFile(logFile, 'WARN', 'No categories to process.')
+    elif undoneCounter.count == 0:
+        console.print(f'All categories of {catlink(rootCategory)} have already been done in Depictor.')
+        logToFile(logFile, 'INFO', 'All categories have already been done in Depictor.')
+    else:
+        console.print(f'Found {totalCounter.count} categories in total, {undoneCounter.count} of them not done in Depictor.')
+        logToFile(logFile, 'INFO', f'Found {totalCounter.count} categories in total, {undoneCounter.count} of them not done in Depictor.')
+
+
+def getCategoriesForRoot(
+        rootCategory: str,
+        resolvedRoots: Optional[dict[str, CategoryDescriptor]],
+        args: dict,
+        commons: CommonsAPI,
+        petscan: PetScan,
+        wikidata: WikidataAPI,
+        status: Status,
+        console: Console,
+        logFile: LogWriter
+    ) -> tuple[str, Optional[Iterable[CategoryDescriptor]]]:
+    '''
+    Gets the categories for a line of the category file. Subcategories are streamed.
+
+    :return: The name of the root category and its categories, or None if they couldn't be found.
+    '''
+    if '|' in rootCategory:
+        try:
+            rootCategory, depth, treeSource = splitRootCategory(rootCategory, args.get('tree_source') or 'petscan')
+        except ValueError as e:
+            # A malformed line of the category file mustn't stop the others
+            console.print(f'[red]Skipping line `{escape(rootCategory)}` of the category file:[/red] {escape(str(e))}')
+            logToFile(logFile, 'ERROR', f'Skipping line "{rootCategory}" of the category file: {str(e)}')
+            return rootCategory, None
+        console.rule(catlink(rootCategory))
+        status.update(status=f'Fetching subcategories for {catlink(rootCategory)} with depth {depth} from {treeSource}')
+        logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
+        logToFile(logFile, 'INFO', f'Fetching subcategories for {catlink(rootCategory, False)} with depth {depth} from {treeSource}')
+
+        # Subcategories are streamed, so that the work can start before all of them are known
+        if treeSource == 'commons':
+            subcategories = commons.iterSubcategoryTree(rootCategory, depth)
+        else:
+            subcategories = petscan.iterSubcategories(rootCategory, depth)
+        categories = buffered(subcategories, 10000)
+    else:
+        rootCategory = unquote(rootCategory.strip())
+        console.rule(catlink(rootCategory))
+        status.update(status=f'Getting QID for {catlink(rootCategory)}')
+        logToFile(logFile, 'INFO', f'----------------------------------------------------------------------------')
+        logToFile(logFile, 'INFO', f'Getting QID for {catlink(rootCategory, False)}')
+        if resolvedRoots is not None:
+            if rootCategory not in resolvedRoots:
+                console.print(f'[red]Failed to get QID for {catlink(rootCategory)}:[/red] no item with an image found in Wikidata.')
+                logToFile(logFile, 'ERROR', f'Failed to get QID for {catlink(rootCategory, False)}: no item with an image found in Wikidata.')
+                return rootCategory, None
+            categories = [resolvedRoots[rootCategory]]
+        else:
+            try:
+                categories = [wikidata.getItemForCommonsCategory(rootCategory)]
+            except Exception as e:
+                console.print(f'[red]Failed to get QID for {catlink(rootCategory)}:[/red] {escape(str(e))}')
+                logToFile(logFile, 'ERROR', f'Failed to get QID for {catlink(rootCategory, False)}: {str(e)}')
+                return rootCategory, None
+
+    return rootCategory, categories
+
+
+def resumeFromJournal(
+        journal: Journal,
+        args: dict,
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter
+    ) -> set[CategoryDescriptor]:
+    '''
+    Finishes the categories left pending in the journal by an interrupted run, starting
+    at the first file not confirmed. The files are checked in Depictor first, as the
+    confirmations of the last moments before a crash may be missing from the journal.
+
+    :return: The categories resumed, so that they can be skipped later in the run.
+    '''
+    pending = journal.getPending()
+    if not pending:
+        console.print('Nothing to resume, the journal has no unfinished categories.')
+        return set()
+
+    console.rule('Resuming')
+    console.print(f'Resuming {len(pending)} categories with {sum(len(entry.files) for entry in pending)} files left.')
+    logToFile(logFile, 'INFO', f'Resuming {len(pending)} categories from the journal.')
+    resumed = set()
+    for entry in interruptible(pending, ih):
+        qId, catName = entry.category
+        status.update(status=f'Checking files left in {catlink(catName)}')
+        try:
+            undoneFiles = depictor.getUndoneFiles(entry.files) if entry.files else entry.files
+        except Exception as e:
+            console.print(f'[red]Failed to check files of {catlink(catName)} in Depictor:[/red] {escape(str(e))}')
+            logToFile(logFile, 'ERROR', f'Failed to check files of {catlink(catName, False)} in Depictor: {str(e)}')
+            continue
+
+        markFilesInCategory(
+            entry.category, undoneFiles, entry.newestPageId, depictor, status, console, ih, logFile,
+            args.get('dry_run', False), depictor.doneStore if args.get('watch') else None, journal,
+        )
+        resumed.add(entry.category)
+    return resumed
+
+
+def resolveRootCategories(
+        rootCategories: list[str],
+        wikidata: WikidataAPI,
+        status: Status,
+        console: Console,
+        logFile: LogWriter
+    ) -> Optional[dict[str, CategoryDescriptor]]:
+    '''
+    Resolves all root categories without depth to Wikidata items up front.
+    Returns None if that failed and the categories should be resolved one by one.
+    '''
+    names = [unquote(c.strip()) for c in rootCategories if '|' not in c]
+    if not names:
+        return {}
+
+    status.update(status=f'Getting QIDs for {len(names)} categories')
+    try:
+        resolved, unresolved = wikidata.getItemsForCommonsCategories(names)
+    except Exception as e:
+        console.print(f'[red]Failed to get QIDs for root categories, they will be resolved one by one:[/red] {escape(str(e))}')
+        logToFile(logFile, 'ERROR', f'Failed to get QIDs for root categories, they will be resolved one by one: {str(e)}')
+        return None
+
+    if unresolved:
+        console.print(f'[yellow]No items with an image found for {len(unresolved)} of {len(names)} categories.')
+        logToFile(logFile, 'WARN', f'No items with an image found for {len(unresolved)} of {len(names)} categories:\n' + '\n'.join(catlink(name, False) for name in unresolved))
+    return resolved
+
+
+def doWorkForUndoneCategories(
+        undoneCategories: Iterable[CategoryDescriptor],
+        commons: CommonsAPI,
+        depictor: Depictor,
+        wikidata: WikidataAPI,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        dryRun: bool = False,
+        workers: int = 1,
+        wholeCategory: bool = False,
+        markStore: Optional[DoneStore] = None,
+        journal: Optional[Journal] = None,
+        workFile: Optional[WorkFileWriter] = None,
+        changeFilter: Optional[UnchangedCategoryFilter] = None
+    ):
+    '''
+    Marks files in the categories as not depicting their subjects. With `markStore`,
+    only files uploaded since the high-water marks of the categories are processed,
+    and the marks are moved forward after the categories are done. With `journal`,
+    the writes are recorded, so that an interrupted run can be resumed. With `workFile`,
+    the files are written to it instead of being marked. With `changeFilter`, the states
+    of categories with nothing left to do are recorded, so that they can be skipped later.
+    '''
+    def onSkipped(category: CategoryDescriptor):
+        qId, catName = category
+        console.print(f'[cyan]Skipping ({catlink(catName)}) ({qId}) because it has no image.[/cyan]')
+        logToFile(logFile, 'INFO', f'Skipped {catlink(catName, False)} ({qId}) because it has no image.')
+
+    def onFailed(category: CategoryDescriptor, error: Exception):
+        qId, catName = category
+        console.print(f'[red]Failed to check Wikidata item {qId} ({catlink(catName)}) for P18:[/red] {escape(str(error))}')
+        logToFile(logFile, 'ERROR', f'Failed to check Wikidata item {qId} ({catlink(catName, False)}) for P18: {str(error)}')
+
+    categoriesWithImage = filterCategoriesWithImage(undoneCategories, wikidata, onSkipped, onFailed)
+
+    status.update(status=f'Searching for files not depicting subjects in categories')
+    discoveredCategories = discoverUndoneFiles(categoriesWithImage, commons, depictor, ih, workers, wholeCategory=wholeCategory, markStore=markStore)
+    for category, undoneFiles, newestPageId, error in interruptible(discoveredCategories, ih):
+        qId, catName = category
+
+        if error is not None:
+            console.print(f'[red]Failed to fetch files for {catlink(catName)}:[/red] {escape(str(error))}')
+            logToFile(logFile, 'ERROR', f'Failed to fetch files for {catlink(catName, False)}: {str(error)}')
+            continue
+
+        if not undoneFiles:
+            if changeFilter is not None and not dryRun:
+                changeFilter.record(category)
+            if markStore is not None:
+                # No new uploads is the usual case when watching, not worth a message
+                if newestPageId is not None and not dryRun:
+                    markStore.setHighWaterMark(catName, newestPageId)
+                continue
+            console.print(f'No files to process in {catlink(catName)}.')
+            logToFile(logFile, 'WARN', f'No files to process in {catlink(catName, False)}.')
+            continue
+
+        if workFile is not None:
+            workFile.addCategory(category, undoneFiles)
+            console.print(f'Planned {catlink(catName)} with {len(undoneFiles)} files.')
+            continue
+        done = markFilesInCategory(category, undoneFiles, newestPageId, depictor, status, console, ih, logFile, dryRun, markStore, journal)
+        if done and changeFilter is not None and not dryRun:
+            changeFilter.record(category)
+        status.update(status=f'Searching for files not depicting subjects in categories')
+
+
+def markFilesInCategory(
+        category: CategoryDescriptor,
+        undoneFiles: FileCollection,
+        newestPageId: Optional[int],
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter,
+        dryRun: bool = False,
+        markStore: Optional[DoneStore] = None,
+        journal: Optional[Journal] = None
+    ) -> bool:
+    '''
+    Marks the files as not depicting the subject of the category, and then the category as done.
+    With `journal`, the files are recorded before they are marked, and every confirmed write after it.
+
+    :return: Whether the category was marked as done.
+    '''
+    qId, catName = category
+    if journal is not None and not dryRun:
+        journal.planCategory(category, undoneFiles, newestPageId)
+
+    if dryRun:
+        results = ((mId, None) for mId in interruptible(undoneFiles.mIds, ih))
+    else:
+        results = depictor.markFilesAsNotDepictingSubject(undoneFiles.mIds, category, lambda: ih.interrupted)
+    fileNames = { file.mId: file.title for file in undoneFiles }
+    processed, failed = 0, 0
+    for mId, error in results:
+        processed += 1
+        fileName = fileNames[mId]
+        status.update(status=f'Processing {catlink(catName)} ({processed}/{len(undoneFiles)}): {pagelink(fileName)} ({mId})')
+        if error is not None:
+            failed += 1
+            console.print(f'[red]Failed to mark {pagelink(fileName)} ({mId}) as not depicting {qId}:[/red] {escape(str(error))}')
+            logToFile(logFile, 'ERROR', f'Failed to mark {pagelink(fileName, False)} ({mId}) as not depicting {qId}: {str(error)}')
+        elif journal is not None and not dryRun:
+            journal.fileDone(category, mId)
+
+    # They won't be equal only if we interrupted the loop early
+    if processed < len(undoneFiles):
+        console.print(f'[yellow]Interrupted processing {catlink(catName)} after {processed}/{len(undoneFiles)} files.')
+        logToFile(logFile, 'WARN', f'Interrupted processing {catlink(catName, False)} after {processed}/{len(undoneFiles)} files.')
+        if journal is not None and not dryRun:
+            journal.checkpoint()
+        return False
+    elif failed:
+        # The category is left undone, so that the failed files are tried again in the next run
+        console.print(f'[yellow]Not marking {catlink(catName)} as done, as {failed}/{len(undoneFiles)} files failed.')
+        logToFile(logFile, 'WARN', f'Not marking {catlink(catName, False)} as done, as {failed}/{len(undoneFiles)} files failed.')
+        return False
+    else:
+        status.update(status=f'Marking category {catlink(catName)} as done')
+        try:
+            if not dryRun:
+                depictor.markCategoryAsDone(qId)
+                if journal is not None:
+                    journal.categoryDone(category)
+                if markStore is not None and newestPageId is not None:
+                    markStore.setHighWaterMark(catName, newestPageId)
+            logToFile(logFile, 'INFO', f'Successfully processed category {catlink(catName, False)} ({qId}) with {len(undoneFiles)} files.')
+        except Exception as e:
+            console.print(f'[red]Failed to mark category {catlink(catName)} as done:[/red] {escape(str(e))}')
+            logToFile(logFile, 'ERROR', f'Failed to mark category {catlink(catName, False)} as done: {str(e)}')
+            return False
+        console.print(f'Processed {catlink(catName)} with {len(undoneFiles)} files.')
+        return True
@@ -0,0 +1,150 @@
+from multiprocessing.process import BaseProcess
+from rich.console import Console
+from rich.markup import escape
+from threading import Event, Thread
+import multiprocessing
+import os
+import time
+
+from .clients import DoneStore, SharedRateLimiter
+from .interrupt_handler import InterruptHandler
+from .output import logToFile, printDeduplicationSummary
+from .pipeline import Deduplicator
+from .runner import createClients, createLogWriter, createMetrics, createResponseCache, createSession, processRootCategory, resolveRootCategories
+from .work_queue import WorkQueue
+
+
+# Most lines of the category file leased by a worker at once; roots without depth are resolved in batches of that size
+MAX_LEASE_SIZE = 20
+# How many times a crashed worker is replaced by a new one
+MAX_RESTARTS = 3
+
+
+def runSharded(rootCategories: list[str], args: dict, console: Console):
+    '''
+    Processes the root categories in `args['shards']` worker processes. The lines
+    are distributed through a WorkQueue, and the rate limits are shared by all
+    the workers. Each worker writes its own log file.
+    '''
+    shardCount = args['shards']
+    dbPath = args.get('shard_db') or 'no_depictor_shards.sqlite3'
+    queue = WorkQueue(dbPath)
+    queue.reset(rootCategories)
+    rateLimiter = SharedRateLimiter(dbPath, args.get('rate_limits'))
+    rateLimiter.reset()
+    rateLimiter.close()
+
+    # Small files are split into smaller leases, so that all the workers get some lines
+    leaseSize = max(1, min(MAX_LEASE_SIZE, len(rootCategories) // (4 * shardCount)))
+    # Spawning works the same way on all platforms, and doesn't copy the state of the parent
+    context = multiprocessing.get_context('spawn')
+
+    def start(worker: int) -> BaseProcess:
+        process = context.Process(target=_runWorker, args=(worker, args, dbPath, leaseSize), name=f'shard-{worker}')
+        process.start()
+        return process
+
+    processes = { worker: start(worker) for worker in range(shardCount) }
+    restarts = 0
+    lastSeq = 0
+    with console.status('Starting workers') as status, InterruptHandler() as ih:
+        while processes:
+            time.sleep(1)
+            for seq, line, worker in queue.getCompleted(lastSeq):
+                console.print(f'[dim]\\[shard {worker}][/dim] Finished {escape(line)}')
+                lastSeq = seq
+
+            for worker, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                del processes[worker]
+                if process.exitcode == 0 or ih.interrupted:
+                    continue
+
+                # The lines the worker was processing would otherwise wait until their leases expire
+                queue.release(worker)
+                console.print(f'[red]Shard {worker} exited with code {process.exitcode}.')
+                if restarts < MAX_RESTARTS and queue.getCounts()['pending'] > 0:
+                    restarts += 1
+                    console.print(f'[yellow]Restarting shard {worker}.')
+                    processes[worker] = start(worker)
+
+            counts = queue.getCounts()
+            if ih.interrupted:
+                status.update(status=f'Interrupted, waiting for {len(processes)} shards to finish the current files')
+            else:
+                total = sum(counts.values())
+                status.update(status=f'{counts["done"]}/{total} lines done, {counts["leased"]} in progress on {len(processes)} shards')
+
+    counts = queue.getCounts()
+    console.print(f'Processed {counts["done"]} of {sum(counts.values())} lines of the category file in {shardCount} shards.')
+    queue.close()
+
+
+def shardPath(path: str, worker: int) -> str:
+    '''Makes a separate file name for the worker, e.g. `no_depictor.log` becomes `no_depictor.1.log`.'''
+    root, extension = os.path.splitext(path)
+    return f'{root}.{worker}{extension}'
+
+
+def _runWorker(worker: int, args: dict, dbPath: str, leaseSize: int):
+    # The progress is shown by the parent, and the details are in the log file of the worker
+    console = Console(quiet=True)
+    queue = WorkQueue(dbPath)
+    rateLimiter = SharedRateLimiter(dbPath, args.get('rate_limits'))
+    responseCache = createResponseCache(args)
+    metricsPath = args.get('metrics_file')
+    metrics = createMetrics(shardPath(metricsPath, worker) if metricsPath else None, args)
+    session = createSession(args, rateLimiter, responseCache, metrics)
+    stateDbPath = args.get('state_db') or 'no_depictor.sqlite3'
+    doneStore = DoneStore(stateDbPath) if stateDbPath != '-' else None
+
+    # Workers can use separate Depictor accounts, e.g. to spread the decisions
+    accounts = args.get('shard_accounts') or []
+    account = accounts[worker % len(accounts)] if accounts else {}
+    commons, wikidata, petscan, depictor = createClients(
+        args, session, doneStore, account.get('user') or args['user'], account.get('sessid') or args['sessid']
+    )
+
+    # Leases are renewed in the background, as a single line may take hours to process
+    stopRenewing = Event()
+    def renewLeases():
+        while not stopRenewing.wait(queue.leaseSeconds / 3):
+            queue.renew(worker)
+    Thread(target=renewLeases, name='lease-renewal', daemon=True).start()
+
+    with createLogWriter(shardPath(args.get('logfile') or 'no_depictor.log', worker), args) as logFile, \
+            console.status('Initializing') as status, InterruptHandler() as ih:
+        logToFile(logFile, 'INFO', f'Starting shard {worker}.')
+        # Categories are deduplicated within each worker only
+        deduplicator = Deduplicator()
+        while not ih.interrupted:
+            batch = queue.lease(worker, leaseSize)
+            if not batch:
+                break
+
+            resolvedRoots = resolveRootCategories([line for _, line in batch], wikidata, status, console, logFile)
+            for position, rootCategory in batch:
+                if ih.interrupted:
+                    break
+                processRootCategory(rootCategory, resolvedRoots, args, commons, petscan, wikidata, depictor, status, console, ih, logFile, deduplicator)
+                # An interrupted line has to be processed again
+                if not ih.interrupted:
+                    queue.complete(position, worker)
+            queue.release(worker)
+
+        stopRenewing.set()
+        printDeduplicationSummary(deduplicator, console, logFile)
+        metrics.close()
+        try:
+            metrics.export()
+        except OSError as e:
+            logToFile(logFile, 'ERROR', f'Failed to write metrics to {metrics.exportPath}: {str(e)}')
+        logToFile(logFile, 'INFO', f'Shard {worker} finished.')
+
+    queue.close()
+    rateLimiter.close()
+    if doneStore is not None:
+        doneStore.close()
+    if responseCache is not None:
+        responseCache.close()
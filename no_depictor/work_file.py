@@ -0,0 +1,224 @@
+from rich.console import Console
+from rich.markup import escape
+from rich.status import Status
+from typing import Iterator, Optional, TextIO
+import gzip
+import json
+import os
+import time
+import uuid
+
+from .clients import Depictor
+from .data import CategoryDescriptor, FileCollection
+from .interrupt_handler import InterruptHandler
+from .output import catlink, formatDuration, logToFile, LogWriter
+
+
+class WorkFileWriter:
+    '''
+    Writes the work found by discovery to a gzipped JSON lines file, to be executed later.
+    Every file to be marked is a line `["M123", "Q42", "Category title"]`, and after
+    the files of a category comes its done marker, `["Q42", "Category title"]`.
+
+    The first line, `{"plan": "<id>"}`, identifies the plan, so that the saved offset
+    of an execution of a previous plan written to the same path isn't used for this one.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.planId = uuid.uuid4().hex
+        self.categories = 0
+        self.files = 0
+        # The offset of the previous plan would skip lines of this one
+        _Offset.remove(path)
+        self._file: TextIO = gzip.open(path, 'wt', encoding='utf-8')
+        self._file.write(json.dumps({ 'plan': self.planId }) + '\n')
+
+
+    def addCategory(self, category: CategoryDescriptor, files: FileCollection):
+        for mId in files.mIds:
+            self._file.write(json.dumps([mId, category.qId, category.title], ensure_ascii=False) + '\n')
+        self._file.write(json.dumps([category.qId, category.title], ensure_ascii=False) + '\n')
+        self.categories += 1
+        self.files += len(files)
+
+
+    def close(self):
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, type, value, tb):
+        self.close()
+
+
+def readWorkFile(path: str, offset: int = 0) -> Iterator[tuple[int, CategoryDescriptor, list[tuple[int, str]]]]:
+    '''
+    Reads the work file by categories, skipping the first `offset` lines.
+
+    :return: Tuples of the line number of the done marker, the category and the (line number, MID)
+        of its files. A category whose marker is missing at the end of the file is not returned.
+    '''
+    files: list[tuple[int, str]] = []
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        for lineNumber, line in enumerate(file):
+            if lineNumber < offset:
+                continue
+            record = json.loads(line)
+            if isinstance(record, dict):
+                continue
+            if len(record) == 3:
+                files.append((lineNumber, record[0]))
+            else:
+                yield lineNumber, CategoryDescriptor(*record), files
+                files = []
+
+
+def readPlanId(path: str) -> Optional[str]:
+    '''Returns the ID of the plan in the work file, or None if it was written without one.'''
+    with gzip.open(path, 'rt', encoding='utf-8') as file:
+        line = file.readline()
+    record = json.loads(line) if line else None
+    return record.get('plan') if isinstance(record, dict) else None
+
+
+class _Offset:
+    '''
+    The number of lines of the work file already executed, kept in a file next to it
+    together with the ID of the plan. An offset saved for another plan is ignored.
+    '''
+
+    def __init__(self, workPath: str, planId: Optional[str], saveInterval: float = 1.0):
+        self.path = workPath + '.offset'
+        self.planId = planId
+        self.saveInterval = saveInterval
+        self._lastSave = time.monotonic()
+        self.value = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                parts = file.read().split()
+        except FileNotFoundError:
+            return
+        savedPlanId, value = (parts[0], parts[1]) if len(parts) == 2 else (None, parts[0] if parts else '0')
+        if savedPlanId == planId:
+            self.value = int(value)
+
+
+    @staticmethod
+    def remove(workPath: str):
+        try:
+            os.remove(workPath + '.offset')
+        except FileNotFoundError:
+            pass
+
+
+    def advance(self, value: int):
+        self.value = value
+        if time.monotonic() - self._lastSave >= self.saveInterval:
+            self.save()
+
+
+    def save(self):
+        # The old offset stays valid until the new one is completely written
+        temporaryPath = self.path + '.tmp'
+        with open(temporaryPath, 'w', encoding='utf-8') as file:
+            file.write(f'{self.planId} {self.value}' if self.planId is not None else str(self.value))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporaryPath, self.path)
+        self._lastSave = time.monotonic()
+
+
+def executeWorkFile(
+        path: str,
+        depictor: Depictor,
+        status: Status,
+        console: Console,
+        ih: InterruptHandler,
+        logFile: LogWriter
+    ):
+    '''
+    Marks the files listed in the work file, and the categories as done after their files.
+    The progress is saved in `<path>.offset`, so that the execution can be stopped and
+    continued later. Files decided in Depictor since the work file was written are skipped.
+    '''
+    offset = _Offset(path, readPlanId(path))
+    if offset.value:
+        console.print(f'Continuing `{escape(path)}` from line {offset.value + 1}.')
+        logToFile(logFile, 'INFO', f'Continuing {path} from line {offset.value + 1}.')
+
+    start = time.monotonic()
+    categories, marked, failed = 0, 0, 0
+    stuck = False
+    try:
+        for markerLine, category, files in readWorkFile(path, offset.value):
+            if ih.interrupted:
+                break
+            qId, catName = category
+            status.update(status=f'Checking files of {catlink(catName)} in Depictor')
+            try:
+                fileCollection = FileCollection()
+                for _, mId in files:
+                    fileCollection.add(int(mId[1:]), '')
+                undoneMids = set(depictor.getUndoneFiles(fileCollection).mIds) if files else set()
+            except Exception as e:
+                console.print(f'[red]Failed to check files of {catlink(catName)} in Depictor:[/red] {escape(str(e))}')
+                logToFile(logFile, 'ERROR', f'Failed to check files of {catlink(catName, False)} in Depictor: {str(e)}')
+                stuck = True
+                break
+
+            # The offset moves over files confirmed (or decided before), but not past one that failed
+            confirmed = { mId for _, mId in files if mId not in undoneMids }
+            nextFile = 0
+            categoryFailed = 0
+            mIds = [mId for _, mId in files if mId in undoneMids]
+            for i, (mId, error) in enumerate(depictor.markFilesAsNotDepictingSubject(mIds, category, lambda: ih.interrupted)):
+                elapsed = time.monotonic() - start
+                status.update(status=f'Processing {catlink(catName)} ({i+1}/{len(mIds)}): {mId}, {marked / elapsed if elapsed else 0:.1f} files per second')
+                if error is not None:
+                    categoryFailed += 1
+                    console.print(f'[red]Failed to mark {mId} as not depicting {qId}:[/red] {escape(str(error))}')
+                    logToFile(logFile, 'ERROR', f'Failed to mark {mId} as not depicting {qId} in {catlink(catName, False)}: {str(error)}')
+                    continue
+                marked += 1
+                confirmed.add(mId)
+                while nextFile < len(files) and files[nextFile][1] in confirmed:
+                    nextFile += 1
+                if nextFile:
+                    offset.advance(files[nextFile - 1][0] + 1)
+            if ih.interrupted:
+                break
+            if categoryFailed:
+                # The offset can't move past the failed files, so later categories would be sent again
+                # in the next run; stop here instead, so that they are done only once
+                failed += categoryFailed
+                stuck = True
+                console.print(f'[yellow]Not marking {catlink(catName)} as done, as {categoryFailed}/{len(files)} files failed.')
+                logToFile(logFile, 'WARN', f'Not marking {catlink(catName, False)} as done, as {categoryFailed}/{len(files)} files failed.')
+                break
+
+            status.update(status=f'Marking category {catlink(catName)} as done')
+            try:
+                depictor.markCategoryAsDone(qId)
+                logToFile(logFile, 'INFO', f'Successfully processed category {catlink(catName, False)} ({qId}) with {len(files)} files.')
+            except Exception as e:
+                stuck = True
+                console.print(f'[red]Failed to mark category {catlink(catName)} as done:[/red] {escape(str(e))}')
+                logToFile(logFile, 'ERROR', f'Failed to mark category {catlink(catName, False)} as done: {str(e)}')
+                break
+            console.print(f'Processed {catlink(catName)} with {len(files)} files.')
+            categories += 1
+            offset.advance(markerLine + 1)
+    finally:
+        offset.save()
+
+    message = f'Marked {marked} files and {categories} categories in {formatDuration(time.monotonic() - start)}'
+    if failed:
+        message += f', {failed} files failed'
+    if ih.interrupted or stuck:
+        message += f'. Run `execute` again to continue from line {offset.value + 1}'
+    console.print(message + '.')
+    logToFile(logFile, 'INFO', message + '.')
@@ -0,0 +1,114 @@
+from threading import Lock
+from typing import Iterable
+import sqlite3
+import time
+
+
+class WorkQueue:
+    '''
+    A queue of lines of the category file, shared by worker processes through an SQLite
+    database. Workers lease lines for a limited time and renew the leases while they
+    work; lines whose lease has expired (e.g. because the worker crashed) are leased
+    again by another worker.
+    '''
+
+    def __init__(self, path: str, leaseSeconds: float = 300):
+        self.leaseSeconds = leaseSeconds
+        self._lock = Lock()
+        # Transactions are started explicitly, so that leasing is atomic across processes
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS work ('
+                'position INTEGER PRIMARY KEY, line TEXT, state TEXT, worker INTEGER, '
+                'lease_until REAL, attempts INTEGER, completed_seq INTEGER)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS work_state ON work (state, position)')
+
+
+    def reset(self, lines: Iterable[str]):
+        '''Replaces the contents of the queue with the given lines.'''
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            self._connection.execute('DELETE FROM work')
+            self._connection.executemany(
+                'INSERT INTO work (position, line, state, attempts) VALUES (?, ?, \'pending\', 0)',
+                enumerate(lines),
+            )
+            self._connection.execute('COMMIT')
+
+
+    def lease(self, worker: int, limit: int = 50) -> list[tuple[int, str]]:
+        '''
+        Leases up to `limit` lines that are pending or whose lease has expired.
+
+        :return: A list of (position, line) tuples; empty if there is no work left.
+        '''
+        now = time.time()
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute(
+                    'SELECT position, line FROM work '
+                    'WHERE state = \'pending\' OR (state = \'leased\' AND lease_until < ?) '
+                    'ORDER BY position LIMIT ?',
+                    (now, limit),
+                ).fetchall()
+                self._connection.executemany(
+                    'UPDATE work SET state = \'leased\', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE position = ?',
+                    ((worker, now + self.leaseSeconds, position) for position, _ in rows),
+                )
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        return rows
+
+
+    def renew(self, worker: int):
+        '''Extends the leases of all lines held by the worker.'''
+        with self._lock:
+            self._connection.execute(
+                'UPDATE work SET lease_until = ? WHERE state = \'leased\' AND worker = ?',
+                (time.time() + self.leaseSeconds, worker),
+            )
+
+
+    def complete(self, position: int, worker: int):
+        with self._lock:
+            self._connection.execute(
+                'UPDATE work SET state = \'done\', completed_seq = (SELECT COALESCE(MAX(completed_seq), 0) + 1 FROM work) '
+                'WHERE position = ? AND state = \'leased\' AND worker = ?',
+                (position, worker),
+            )
+
+
+    def release(self, worker: int):
+        '''Returns all lines leased by the worker to the queue, e.g. after it was interrupted or crashed.'''
+        with self._lock:
+            self._connection.execute(
+                'UPDATE work SET state = \'pending\', worker = NULL, lease_until = NULL WHERE state = \'leased\' AND worker = ?',
+                (worker,),
+            )
+
+
+    def getCounts(self) -> dict[str, int]:
+        '''Returns the number of lines in each state: pending, leased and done.'''
+        with self._lock:
+            rows = self._connection.execute('SELECT state, COUNT(*) FROM work GROUP BY state').fetchall()
+        return { 'pending': 0, 'leased': 0, 'done': 0, **dict(rows) }
+
+
+    def getCompleted(self, afterSeq: int) -> list[tuple[int, str, int]]:
+        '''Returns (sequence number, line, worker) of lines completed after the given sequence number, in order.'''
+        with self._lock:
+            return self._connection.execute(
+                'SELECT completed_seq, line, worker FROM work WHERE state = \'done\' AND completed_seq > ? ORDER BY completed_seq',
+                (afterSeq,),
+            ).fetchall()
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import unittest
+
+from no_depictor.data import CategoryDescriptor, FileCollection
+from no_depictor.journal import Journal
+
+
+CATEGORY = CategoryDescriptor('Q1', 'Category_1')
+OTHER_CATEGORY = CategoryDescriptor('Q2', 'Category_2')
+
+
+def _files(*pageIds: int) -> FileCollection:
+    files = FileCollection()
+    for pageId in pageIds:
+        files.add(pageId, f'File:{pageId}.jpg')
+    return files
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'journal')
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def test_replay_ignores_a_truncated_last_line(self):
+        with Journal(self.path) as journal:
+            journal.planCategory(CATEGORY, _files(1, 2, 3), 3)
+            journal.fileDone(CATEGORY, 'M1')
+        # The process was killed while writing the confirmation of the second file
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write('{"op": "add-file", "qid": "Q1", "categ')
+
+        with Journal(self.path) as journal:
+            pending = journal.getPending()
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0].category, CATEGORY)
+        self.assertEqual(pending[0].files.mIds, ['M2', 'M3'])
+        self.assertEqual(pending[0].newestPageId, 3)
+
+
+    def test_compaction_keeps_only_unfinished_files_of_pending_categories(self):
+        with Journal(self.path) as journal:
+            journal.planCategory(CATEGORY, _files(1, 2), 2)
+            journal.planCategory(OTHER_CATEGORY, _files(3), 3)
+            journal.fileDone(CATEGORY, 'M1')
+            journal.fileDone(OTHER_CATEGORY, 'M3')
+            journal.categoryDone(OTHER_CATEGORY)
+
+        Journal(self.path).close()
+        with open(self.path, 'r', encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(records, [{
+            'op': 'plan', 'qid': 'Q1', 'category': 'Category_1', 'files': [[2, 'File:2.jpg']], 'newest': 2,
+        }])
+
+        # Confirmations after the compaction apply to the rewritten plan
+        with Journal(self.path) as journal:
+            journal.fileDone(CATEGORY, 'M2')
+            journal.categoryDone(CATEGORY)
+        with Journal(self.path) as journal:
+            self.assertEqual(journal.pendingCount, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+import json
+import os
+import tempfile
+import unittest
+
+from no_depictor.clients import PetScan, RateLimitedSession, RateLimiter, ResponseCache
+
+
+ITEMS = [{ 'q': f'Q{i}', 'title': f'Category_{i}' } for i in range(1, 5001)]
+BODY = json.dumps({ '*': [{ 'a': { '*': ITEMS } }] }).encode('utf-8')
+# More than the 64 KiB chunk read by the client, ending in the middle of an item
+SPLIT = 100 * 1024
+
+
+class _PetScanHandler(BaseHTTPRequestHandler):
+    '''Sends the beginning of the body, and the rest only after the test releases it.'''
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY[:SPLIT])
+        self.wfile.flush()
+        if not server.release.wait(timeout=10):
+            return
+        if server.truncate:
+            # The connection is closed before the announced length
+            self.wfile.write(BODY[SPLIT:-10])
+            self.close_connection = True
+            return
+        self.wfile.write(BODY[SPLIT:])
+        server.finished.set()
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _PetScanHandler)
+        self.server.requests = 0
+        self.server.release = Event()
+        self.server.finished = Event()
+        self.server.truncate = False
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(os.path.join(self.directory.name, 'cache.sqlite3'))
+        limits = { 'petscan.wmcloud.org': { 'rate': 100, 'burst': 100 } }
+        self.session = RateLimitedSession(RateLimiter(limits), responseCache=self.cache, maxTransientRetries=0)
+        self.session.mountPools({}, { 'petscan.wmcloud.org': f'http://127.0.0.1:{self.server.server_port}' })
+        self.petscan = PetScan(self.session)
+
+
+    def tearDown(self):
+        self.server.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.session.close()
+        self.cache.close()
+        self.directory.cleanup()
+
+
+    def test_first_item_is_yielded_before_the_body_is_read_with_the_cache_enabled(self):
+        categories = self.petscan.iterSubcategories('Root', 0)
+        first = next(categories)
+        self.assertEqual(first.title, 'Category_1')
+        self.assertFalse(self.server.finished.is_set())
+
+        self.server.release.set()
+        self.assertEqual(len(list(categories)), len(ITEMS) - 1)
+
+        # The whole response was cached after it was read, so it isn't requested again
+        cached = self.petscan.getSubcategories('Root', 0)
+        self.assertEqual([category.title for category in cached], [item['title'] for item in ITEMS])
+        self.assertEqual(self.server.requests, 1)
+
+
+    def test_truncated_response_is_not_cached(self):
+        self.server.truncate = True
+        self.server.release.set()
+        with self.assertRaises(Exception):
+            self.petscan.getSubcategories('Root', 0)
+
+        self.server.truncate = False
+        self.assertEqual(len(self.petscan.getSubcategories('Root', 0)), len(ITEMS))
+        self.assertEqual(self.server.requests, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from rich.console import Console
+import os
+import tempfile
+import unittest
+
+from no_depictor.data import CategoryDescriptor, FileCollection
+from no_depictor.interrupt_handler import InterruptHandler
+from no_depictor.work_file import executeWorkFile, WorkFileWriter
+
+
+class _FakeDepictor:
+    '''Records the writes, and fails every file of the categories in `failing`.'''
+
+    def __init__(self):
+        self.failing: set[str] = set()
+        self.markedFiles: list[str] = []
+        self.doneItems: list[str] = []
+
+
+    def getUndoneFiles(self, files: FileCollection) -> FileCollection:
+        return files.without(set(self.markedFiles))
+
+
+    def markFilesAsNotDepictingSubject(self, mIds, category, isInterrupted):
+        for mId in mIds:
+            if category.qId in self.failing:
+                yield mId, Exception('Failed')
+            else:
+                self.markedFiles.append(mId)
+                yield mId, None
+
+
+    def markCategoryAsDone(self, qId: str):
+        self.doneItems.append(qId)
+
+
+class _FakeStatus:
+
+    def update(self, status: str):
+        pass
+
+
+class _FakeLogWriter:
+
+    def log(self, type: str, message: str):
+        pass
+
+
+class WorkFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'work.jsonl.gz')
+        self.depictor = _FakeDepictor()
+
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+    def plan(self, *categories: tuple[str, list[int]]):
+        with WorkFileWriter(self.path) as workFile:
+            for qId, pageIds in categories:
+                files = FileCollection()
+                for pageId in pageIds:
+                    files.add(pageId, '')
+                workFile.addCategory(CategoryDescriptor(qId, f'Category of {qId}'), files)
+
+
+    def execute(self):
+        with InterruptHandler() as ih:
+            executeWorkFile(self.path, self.depictor, _FakeStatus(), Console(quiet=True), ih, _FakeLogWriter())
+
+
+    def test_execution_continues_after_the_last_completed_category(self):
+        self.plan(('Q1', [1, 2]), ('Q2', [3]), ('Q3', [4]))
+        self.depictor.failing = { 'Q2' }
+        self.execute()
+        self.assertEqual(self.depictor.doneItems, ['Q1'])
+
+        self.depictor.failing = set()
+        self.execute()
+        # Nothing is sent twice
+        self.assertEqual(self.depictor.markedFiles, ['M1', 'M2', 'M3', 'M4'])
+        self.assertEqual(self.depictor.doneItems, ['Q1', 'Q2', 'Q3'])
+
+
+    def test_offset_of_a_previous_plan_is_not_used(self):
+        self.plan(('Q1', [1, 2]), ('Q2', [3]))
+        self.execute()
+        self.assertEqual(self.depictor.doneItems, ['Q1', 'Q2'])
+
+        self.plan(('Q4', [5]), ('Q5', [6]), ('Q6', [7]))
+        self.execute()
+        self.assertEqual(self.depictor.markedFiles, ['M1', 'M2', 'M3', 'M5', 'M6', 'M7'])
+        self.assertEqual(self.depictor.doneItems, ['Q1', 'Q2', 'Q4', 'Q5', 'Q6'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import time
+import unittest
+
+from no_depictor.work_queue import WorkQueue
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'queue.sqlite3')
+        self.queue = WorkQueue(self.path, leaseSeconds=0.2)
+        self.queue.reset(['A|1', 'B|1', 'C|1'])
+
+
+    def tearDown(self):
+        self.queue.close()
+        self.directory.cleanup()
+
+
+    def test_leased_lines_are_not_leased_again(self):
+        self.assertEqual(self.queue.lease(0, 2), [(0, 'A|1'), (1, 'B|1')])
+        self.assertEqual(self.queue.lease(1, 2), [(2, 'C|1')])
+        self.assertEqual(self.queue.lease(2, 2), [])
+
+
+    def test_expired_lease_is_reassigned_to_another_worker(self):
+        self.assertEqual(self.queue.lease(0, 1), [(0, 'A|1')])
+        time.sleep(0.3)
+
+        # Another process takes over the line of the crashed worker
+        other = WorkQueue(self.path, leaseSeconds=60)
+        try:
+            self.assertEqual(other.lease(1, 1), [(0, 'A|1')])
+            other.complete(0, 1)
+        finally:
+            other.close()
+
+        # The late completion of the original worker doesn't count
+        self.queue.complete(0, 0)
+        self.assertEqual(self.queue.getCompleted(0), [(1, 'A|1', 1)])
+        self.assertEqual(self.queue.getCounts(), { 'pending': 2, 'leased': 0, 'done': 1 })
+
+
+    def test_renewed_lease_is_kept(self):
+        self.queue.lease(0, 1)
+        time.sleep(0.15)
+        self.queue.renew(0)
+        time.sleep(0.1)
+        self.assertEqual(self.queue.lease(1, 1), [(1, 'B|1')])
+
+
+    def test_released_lines_are_leased_again(self):
+        self.queue.lease(0, 2)
+        self.queue.release(0)
+        self.assertEqual(self.queue.lease(1, 3), [(0, 'A|1'), (1, 'B|1'), (2, 'C|1')])
+
+
+if __name__ == '__main__':
+    unittest.main()